@@ -0,0 +1,720 @@
+"""
+Micro-benchmarks for the cleaning and extraction code.
+
+Run with: python benchmark.py [osm file]
+      or: python benchmark.py --suite [--sizes 10000,100000] [--seed 0] [--results benchmark_results.json]
+
+The suite runs on seeded synthetic extracts (see generate_osm) and appends its timings to the results
+file, tagged with the git commit, so a run can be compared with the ones of earlier commits.
+"""
+
+import argparse
+import codecs
+import collections
+import csv
+import filecmp
+import functools
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import xml.etree.cElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import columnar
+import data_audit
+import data_cleaning_extraction as dce
+
+SUITE_SIZES = (10000, 100000)
+RESULTS_PATH = 'benchmark_results.json'
+
+# share of the street, phone, postcode, county and pharmacy values generate_osm writes in a form the
+# cleaners have to fix
+DIRTY_RATES = {'street': 0.2, 'phone': 0.5, 'postcode': 0.1, 'county': 0.5, 'pharmacy': 0.5}
+
+STREETS = ['Georgia', 'Connecticut', 'Wisconsin', 'Stanton', 'New Hampshire', 'Rhode Island', 'Columbia']
+CLEAN_STREET_TYPES = ['Street', 'Avenue', 'Road', 'Boulevard', 'Drive', 'Place']
+DIRTY_STREET_TYPES = ['St', 'St.', 'Ave', 'Ave.', 'Rd', 'Blvd', 'Dr', 'Pl', 'Ave NW', 'St NE']
+DIRTY_PHONES = ['+1 (202) 555-%04d', '202.555.%04d', 'tel:+1-202-555-%04d', '(301) 555 %04d']
+COUNTIES = ['Montgomery', 'Prince George\'s', 'District of Columbia', 'Fairfax']
+PHARMACIES = ['CVS', 'Walgreens', 'Rite Aid', 'Giant']
+
+
+def in_temp_dir(bench):
+  """Run a benchmark of an osm file in a temporary directory, the outputs it writes would replace the user's"""
+  @functools.wraps(bench)
+  def run(osm_file, *args, **kwargs):
+    osm_file = os.path.abspath(osm_file)
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+      return bench(osm_file, *args, **kwargs)
+    finally:
+      os.chdir(cwd)
+      shutil.rmtree(workdir)
+  return run
+
+
+def make_node(tag_count):
+  """Build a node element carrying tag_count secondary tags, a few of which get cleaned"""
+  node = ET.Element('node', {'id': '1', 'lat': '38.9', 'lon': '-77.0', 'user': 'bench', 'uid': '1',
+                             'version': '1', 'changeset': '1', 'timestamp': '2017-01-01T00:00:00Z'})
+  ET.SubElement(node, 'tag', {'k': 'amenity', 'v': 'pharmacy'})
+  ET.SubElement(node, 'tag', {'k': 'name', 'v': 'CVS/Pharmacy'})
+  ET.SubElement(node, 'tag', {'k': 'phone', 'v': '+1 (202) 555-0101'})
+  for i in range(tag_count - 3):
+    ET.SubElement(node, 'tag', {'k': 'note:%d' % i, 'v': 'value %d' % i})
+  return node
+
+
+def bench_shape_element_scaling(tag_counts=(4, 16, 64, 256), repeat=5):
+  """Time shape_element on nodes of growing tag counts, the time per tag should stay flat"""
+  print('shape_element scaling with tags per node')
+  for tag_count in tag_counts:
+    node = make_node(tag_count)
+    number = max(1, 20000 // tag_count)
+    best = min(timeit.repeat(lambda: dce.shape_element(node), number=number, repeat=repeat)) / number
+    print('  %4d tags: %9.1f us/node %7.3f us/tag' % (tag_count, best * 1e6, best * 1e6 / tag_count))
+
+
+def substring_update_name(name, mapping):
+  """The substring based update_name the street normalizer replaced, kept for comparison"""
+  for key in mapping:
+    if mapping[key] in name:
+      return name
+    elif key in name:
+      name = name.replace(key, mapping[key])
+  return name
+
+
+def bench_street_names(distinct=500, total=200000):
+  """Time street name cleaning on total values drawn from a few distinct names, as in real extracts"""
+  print('street names: %d values, %d distinct' % (total, distinct))
+  types = sorted(dce.mapping) + ['Street', 'Avenue']
+  names = ['%d %s %s' % (i, 'Stanton' if i % 2 else 'Georgia', types[i % len(types)]) for i in range(distinct)]
+  values = [names[(i * 7919) % distinct] for i in range(total)]
+
+  for label, clean in (('substring', lambda name: substring_update_name(name, dce.mapping)),
+                       ('compiled', dce.street_normalizer(dce.mapping))):
+    start = time.time()
+    for value in values:
+      clean(value)
+    print('  %-10s %7.2f us/value' % (label, (time.time() - start) * 1e6 / total))
+
+
+def sequential_rule(rule):
+  """A cleaner making the overrides and rewrites of rule one after another, like the hand written cleaners
+  did with str.replace, kept for comparison"""
+  overrides = dict((override['value'], override['fix']) for override in rule.get('overrides', ()))
+  rewrites = [(rewrite['literal'], rewrite['replace']) if 'literal' in rewrite else
+              (re.compile(rewrite['pattern']), rewrite['replace']) for rewrite in rule.get('rewrites', ())]
+  max_length = rule.get('max_length')
+
+  def clean(value):
+    value = overrides.get(value, value)
+    for rewrite, replacement in rewrites:
+      if isinstance(rewrite, basestring):
+        value = value.replace(rewrite, replacement)
+      else:
+        value = rewrite.sub(replacement, value)
+    return value[:max_length]
+  return clean
+
+
+def time_cleaners(cleaners, values):
+  """Best of three us/value of every cleaner, called unmemoized on values"""
+  timings = []
+  for clean in cleaners:
+    def clean_all():
+      for value in values:
+        clean(value)
+    timings.append(min(timeit.repeat(clean_all, number=1, repeat=3)) * 1e6 / len(values))
+  return timings
+
+
+def bench_rules(rule_counts=(10, 100, 1000, 5000), total=20000):
+  """Time the cleaners of the default rules and a phone cleaner with rule_counts overrides and labels to
+  remove against the same rules made one after another, the compiled cost should stay flat
+
+  The cleaners are called unmemoized on total distinct values. Both sides make the same rewrites: the
+  sequential cleaner replaces each literal with str.replace and substitutes each pattern on its own."""
+  print('cleaning rules: %d distinct values' % total)
+  rng = random.Random(0)
+  samples = {'fix_phone': [rng.choice(DIRTY_PHONES) % i for i in range(total)],
+             'fix_pharmacy': [rng.choice(PHARMACIES) + rng.choice(['/Pharmacy', ' Pharmacy', '-pharmacy', ''])
+                              for _ in range(total)]}
+  for rule in dce.RULES['cleaners']:
+    if rule['name'] in samples:
+      compiled, sequential = time_cleaners((dce.compile_rule(rule), sequential_rule(rule)), samples[rule['name']])
+      print('  %-13s compiled %6.2f us/value, sequential %8.2f us/value' % (rule['name'], compiled, sequential))
+
+  for count in rule_counts:
+    labels = ['Office %d: ' % i for i in range(count)]
+    values = [(rng.choice(labels) if i % 3 == 0 else '') + rng.choice(DIRTY_PHONES) % i for i in range(total)]
+    rule = {'name': 'fix_phone', 'keys': ['phone'], 'max_length': 10,
+            'overrides': [{'value': '555 %04d' % i, 'fix': '202555%04d' % i} for i in range(count)],
+            'rewrites': [{'literal': label, 'replace': ''} for label in labels] + [
+              {'pattern': '[- .()+]', 'replace': ''}]}
+
+    start = time.time()
+    compiled = dce.compile_rule(rule)
+    compile_time = time.time() - start
+
+    timings = time_cleaners((compiled, sequential_rule(rule)), values)
+    print('  %5d rules:   compiled %6.2f us/value, sequential %8.2f us/value, compile %6.3f s' % (
+      count, timings[0], timings[1], compile_time))
+
+
+def split_shape_tags(element_id, tag_pairs, problem_chars=dce.PROBLEMCHARS, default_tag_type='regular',
+                     cleaners=dce.CLEANERS):
+  """The shape_tags that searched and split the key of every tag, kept for comparison"""
+  tags = []
+  tag_lookup = None
+  for k, v in tag_pairs:
+    if problem_chars.search(k):
+      continue
+    cleaner = cleaners.get(k)
+    if cleaner is not None:
+      clean, when = cleaner
+      if when is not None and tag_lookup is None:
+        tag_lookup = dict(tag_pairs)
+      if when is None or tag_lookup.get(when[0]) == when[1]:
+        v = clean(v)
+    tag_dict = {'id': element_id, 'value': v}
+    if ':' not in k:
+      tag_dict['key'] = k
+      tag_dict['type'] = default_tag_type
+    else:
+      tag_dict['type'], tag_dict['key'] = k.split(':', 1)
+    tags.append(tag_dict)
+  return tags
+
+
+def string_bytes(rows):
+  """Bytes of the distinct string objects the key, value and type fields of the tag rows point to"""
+  sizes = {}
+  for row in rows:
+    for field in ('key', 'value', 'type'):
+      sizes[id(row[field])] = sys.getsizeof(row[field])
+  return sum(sizes.values())
+
+
+def bench_tag_interning(osm_file, batch=dce.CSV_BATCH_SIZE, repeat=3):
+  """Time the tag loop with and without memoized key splits, and with tag statistics, and the string
+  memory of a batch of shaped tag rows"""
+  print('tag key splits on %s' % osm_file)
+  elements = [(element.attrib['id'], dce.read_tags(element)) for element in dce.get_element(osm_file, backend='expat')]
+  tag_count = sum(len(tags) for _, tags in elements)
+
+  key_stats = {}
+  for label, shape_tags in (('split per tag', split_shape_tags), ('memoized', dce.shape_tags),
+                            ('memoized+stats', lambda element_id, tags: dce.shape_tags(element_id, tags,
+                                                                                       key_stats=key_stats))):
+    def shape_all():
+      for element_id, tags in elements:
+        shape_tags(element_id, tags)
+    elapsed = min(timeit.repeat(shape_all, number=1, repeat=repeat))
+
+    # a second pass holds the rows of a sink batch, like the sinks do, to measure their strings
+    rows = []
+    held = 0
+    for element_id, tags in elements:
+      rows.extend(shape_tags(element_id, tags))
+      if len(rows) >= batch:
+        held = max(held, string_bytes(rows))
+        del rows[:]
+    print('  %-15s %7.3f us/tag %8.2f MB of strings per %d rows' % (label, elapsed * 1e6 / tag_count, held / 1e6,
+                                                                    batch))
+
+
+@in_temp_dir
+def bench_backends(osm_file):
+  """Time every parser backend in elements per second and check they all write identical csv(s)"""
+  print('parser backends on %s' % osm_file)
+  for backend in sorted(dce.PARSER_BACKENDS):
+    start = time.time()
+    count = 0
+    for element in dce.get_element(osm_file, tags=('node', 'way'), backend=backend):
+      dce.shape_element(element)
+      count += 1
+    elapsed = time.time() - start
+    print('  %-6s %9.0f elements/s' % (backend, count / elapsed))
+
+  suffixes = ['.' + backend for backend in sorted(dce.PARSER_BACKENDS)]
+  for backend, suffix in zip(sorted(dce.PARSER_BACKENDS), suffixes):
+    sink = dce.CsvSink(suffix=suffix)
+    dce.write_elements(osm_file, False, sink, backend)
+    sink.close()
+
+  for _, path, _ in dce.OUTPUT_TABLES:
+    same = all(filecmp.cmp(path + suffixes[0], path + suffix, shallow=False) for suffix in suffixes[1:])
+    print('  %-16s %s' % (path, 'identical' if same else 'DIFFERENT'))
+    for suffix in suffixes:
+      os.remove(path + suffix)
+
+
+def import_csvs(db_path):
+  """The manual path: import the csv(s) with default settings into a database with its indexes"""
+  if os.path.exists(db_path):
+    os.remove(db_path)
+  conn = sqlite3.connect(db_path)
+  conn.executescript(dce.SQL_SCHEMA + dce.SQL_INDEXES)
+
+  for table, path, fields in dce.OUTPUT_TABLES:
+    with open(path, 'rb') as table_file:
+      rows = [tuple(row[field].decode('utf-8') for field in fields) for row in csv.DictReader(table_file)]
+    conn.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+      dce.SQL_TABLES[table], ', '.join(fields), ', '.join('?' * len(fields))), rows)
+    conn.commit()
+  conn.close()
+
+
+@in_temp_dir
+def bench_sqlite(osm_file):
+  """Compare writing csv(s) then importing them with loading SQLite directly through SqliteSink
+
+  The elements are parsed and shaped once beforehand, so only the load is timed."""
+  print('sqlite load of %s' % osm_file)
+  start = time.time()
+  shaped = [dce.shape_element(element) for element in dce.get_element(osm_file)]
+  print('  parse and shape %7.2f s' % (time.time() - start))
+
+  timings = []
+  for load in (import_shaped, sink_shaped):
+    start = time.time()
+    load(shaped)
+    timings.append(time.time() - start)
+  print('  csv then import %7.2f s' % timings[0])
+  print('  sqlite sink     %7.2f s  %5.1fx' % (timings[1], timings[0] / timings[1]))
+
+
+def import_shaped(shaped):
+  sink = dce.CsvSink()
+  for el in shaped:
+    sink.write(el)
+  sink.close()
+  import_csvs(dce.SQLITE_PATH)
+
+
+def sink_shaped(shaped):
+  sink = dce.SqliteSink()
+  for el in shaped:
+    sink.write(el)
+  sink.close()
+
+
+class UnicodeDictWriter(csv.DictWriter, object):
+  """The row at a time writer CsvSink replaced, kept for comparison"""
+
+  def writerow(self, row):
+    super(UnicodeDictWriter, self).writerow({
+      k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
+      })
+
+  def writerows(self, rows):
+    for row in rows:
+      self.writerow(row)
+
+
+class DictWriterSink(object):
+  """Sink writing every element straight through UnicodeDictWriter, like the extractor used to"""
+
+  def __init__(self, suffix=''):
+    self.files = []
+    self.writers = {}
+    for table, path, fields in dce.OUTPUT_TABLES:
+      table_file = codecs.open(path + suffix, 'w')
+      self.files.append(table_file)
+      self.writers[table] = UnicodeDictWriter(table_file, fields)
+      self.writers[table].writeheader()
+
+  def write(self, el):
+    for table, rows in el.items():
+      if isinstance(rows, dict):
+        self.writers[table].writerow(rows)
+      else:
+        self.writers[table].writerows(rows)
+
+  def close(self):
+    for table_file in self.files:
+      table_file.close()
+
+
+@in_temp_dir
+def bench_csv_writers(osm_file):
+  """Time writing the shaped elements of osm_file in rows per second and check the csv(s) are identical"""
+  print('csv writers on %s' % osm_file)
+  shaped = [dce.shape_element(element) for element in dce.get_element(osm_file)]
+  rows = sum(len(value) if isinstance(value, list) else 1 for el in shaped for value in el.values())
+
+  for label, suffix, make_sink in (('DictWriter', '.dict', DictWriterSink), ('CsvSink', '.batch', dce.CsvSink)):
+    start = time.time()
+    sink = make_sink(suffix=suffix)
+    for el in shaped:
+      sink.write(el)
+    sink.close()
+    print('  %-10s %9.0f rows/s' % (label, rows / (time.time() - start)))
+
+  for _, path, _ in dce.OUTPUT_TABLES:
+    same = filecmp.cmp(path + '.dict', path + '.batch', shallow=False)
+    print('  %-22s %s' % (path, 'identical' if same else 'DIFFERENT'))
+    os.remove(path + '.dict')
+    os.remove(path + '.batch')
+
+
+def scan_csv(nodes_path, tags_path):
+  """The analytics query of bench_columnar over the csv(s): mean node latitude and tag count per key"""
+  with open(nodes_path, 'rb') as nodes:
+    lats = [float(row['lat']) for row in csv.DictReader(nodes)]
+  with open(tags_path, 'rb') as tags:
+    keys = collections.Counter(row['key'].decode('utf-8') for row in csv.DictReader(tags))
+  return sum(lats) / max(1, len(lats)), keys
+
+
+def scan_columnar(nodes_path, tags_path):
+  """The same query over the column files, only the lat and key columns are read"""
+  nodes = columnar.ColumnReader(nodes_path)
+  tags = columnar.ColumnReader(tags_path)
+  try:
+    lats = list(nodes.column('lat'))
+    keys = collections.Counter(tags.column('key'))
+  finally:
+    nodes.close()
+    tags.close()
+  return sum(lats) / max(1, len(lats)), keys
+
+
+@in_temp_dir
+def bench_columnar(osm_file):
+  """Compare the size of the csv and columnar outputs and the time of a scan over each"""
+  print('columnar output of %s' % osm_file)
+  dce.process_map(osm_file, False)
+  dce.process_map(osm_file, False, output='columnar')
+
+  csv_size = col_size = 0
+  for _, path, _ in dce.OUTPUT_TABLES:
+    csv_size += os.path.getsize(path)
+    col_size += os.path.getsize(os.path.splitext(path)[0] + dce.COLUMNAR_EXTENSION)
+  print('  size      csv %8.2f MB  columnar %8.2f MB' % (csv_size / 1e6, col_size / 1e6))
+
+  results = {}
+  timings = {}
+  for label, scan, extension in (('csv', scan_csv, '.csv'), ('columnar', scan_columnar, dce.COLUMNAR_EXTENSION)):
+    start = time.time()
+    results[label] = scan(os.path.splitext(dce.NODES_PATH)[0] + extension,
+                          os.path.splitext(dce.NODE_TAGS_PATH)[0] + extension)
+    timings[label] = time.time() - start
+  print('  scan      csv %8.2f s   columnar %8.2f s' % (timings['csv'], timings['columnar']))
+
+  (csv_lat, csv_keys), (col_lat, col_keys) = results['csv'], results['columnar']
+  same = abs(csv_lat - col_lat) < 1e-9 and dict(csv_keys) == dict(col_keys)
+  print('  results   %s' % ('identical' if same else 'DIFFERENT'))
+
+
+def history_osm(path, source, versions=3):
+  """Write every element of source versions times, a day apart, like the versions of a history dump"""
+  with open(path, 'wb') as out:
+    out.write(b"<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\">\n")
+    for element in dce.get_element(source, backend='etree'):
+      for version in range(1, versions + 1):
+        element.set('version', str(version))
+        element.set('timestamp', '2017-01-%02dT00:00:00Z' % version)
+        out.write(ET.tostring(element, encoding='utf-8'))
+    out.write(b'</osm>\n')
+
+
+@in_temp_dir
+def bench_dedup(osm_file, versions=3):
+  """Compare the output size and the time of a scan over it for every version, the latest ones and history"""
+  print('deduplication of %d versions per element of %s' % (versions, osm_file))
+  history_osm('history.osm', osm_file, versions)
+
+  for label, dedup in (('every version', None), ('latest', 'latest'), ('history', 'history')):
+    start = time.time()
+    dce.process_map('history.osm', False, dedup=dedup)
+    elapsed = time.time() - start
+    size = sum(os.path.getsize(path) for _, path, _ in dce.OUTPUT_TABLES)
+
+    start = time.time()
+    scan_csv(dce.NODES_PATH, dce.NODE_TAGS_PATH)
+    print('  %-14s %7.2f s %8.2f MB  scan %6.2f s' % (label, elapsed, size / 1e6, time.time() - start))
+
+
+def scattered_ids(count, max_id, seed=0):
+  """count sorted ids drawn from 1 to max_id, like the nodes of a regional extract among all OSM nodes"""
+  return sorted(random.Random(seed).sample(xrange(1, max_id + 1), count))
+
+
+def bench_id_sets(count=200000, max_id=12 * 10 ** 9):
+  """Time adding and looking up count ids in an IdSet and compare its memory with a Python set, for ids
+  scattered over the OSM id range and for the dense ids of a single import"""
+  print('id sets: %d ids' % count)
+  for label, ids in (('scattered', scattered_ids(count, max_id)),
+                     ('dense', [4000000000 + i * 3 for i in range(count)])):
+    id_set = dce.IdSet()
+    start = time.time()
+    for element_id in ids:
+      id_set.add(element_id)
+    add_time = time.time() - start
+
+    start = time.time()
+    for element_id in ids:
+      element_id in id_set
+    lookup_time = time.time() - start
+
+    python_set = set(ids)
+    set_bytes = sys.getsizeof(python_set) + sum(sys.getsizeof(element_id) for element_id in ids)
+    print('  %-9s add %5.2f us/id  lookup %5.2f us/id  %6.2f bytes/id, set %6.2f bytes/id' % (
+      label, add_time * 1e6 / count, lookup_time * 1e6 / count, float(id_set.nbytes()) / count,
+      float(set_bytes) / count))
+
+
+def bench_node_locations(count=1000000, max_id=12 * 10 ** 9):
+  """Time storing and looking up count node locations through GeometryBuilder, for ids scattered over the OSM
+  id range and the dense ids of a single import, and the memory or disk its store takes"""
+  print('node locations: %d nodes' % count)
+  for label, ids in (('scattered', scattered_ids(count, max_id)),
+                     ('dense', [4000000000 + i * 3 // 2 for i in range(count)])):
+    builder = dce.GeometryBuilder()
+    try:
+      start = time.time()
+      for i, node_id in enumerate(ids):
+        builder.set_location(node_id, 38.8 + i * 1e-7, -77.1 + i * 1e-7)
+      set_time = time.time() - start
+
+      start = time.time()
+      for node_id in ids:
+        builder.locations.get(node_id)
+      get_time = time.time() - start
+
+      store = builder.locations
+      if isinstance(store, dce.NodeLocationStore):
+        store.map.flush()
+        size = 'disk %7.2f MB' % (os.fstat(store.file.fileno()).st_blocks * 512 / 1e6)
+      else:
+        size = 'memory %5.2f MB' % (store.nbytes() / 1e6)
+      print('  %-9s %-19s set %5.2f us/node  get %5.2f us/node  %s' % (
+        label, type(store).__name__, set_time * 1e6 / count, get_time * 1e6 / count, size))
+    finally:
+      builder.close()
+
+
+class NullSink(object):
+  """Sink that drops every element, so only parsing, shaping and validation are timed"""
+
+  def write(self, el):
+    pass
+
+  def close(self):
+    pass
+
+
+def bench_validation(osm_file):
+  """Time the shaping loop with validation off, on every element and on a sample of them"""
+  print('validation overhead on %s' % osm_file)
+  for label, validate, sample in (('off', False, None), ('every element', True, None),
+                                  ('every 10th', True, 10), ('random 1%', True, 0.01)):
+    start = time.time()
+    dce.write_elements(osm_file, validate, NullSink(), sample=sample)
+    print('  %-14s %7.2f s' % (label, time.time() - start))
+
+
+def dirty(rng, kind, dirty_rates):
+  return rng.random() < dirty_rates[kind]
+
+
+def synthetic_tags(rng, element_type, tags_per_element, dirty_rates):
+  """Draw the (k, v) tags of one synthetic element, the cleaned keys first and filler notes after them"""
+  tags = []
+  if element_type == 'node':
+    if rng.random() < 0.05:
+      name = rng.choice(PHARMACIES)
+      tags.append(('amenity', 'pharmacy'))
+      tags.append(('name', name + rng.choice(['/Pharmacy', ' Pharmacy', '-pharmacy']) if
+                   dirty(rng, 'pharmacy', dirty_rates) else name))
+
+    number = rng.randint(0, 9999)
+    choices = [
+      ('addr:street', '%s %s' % (rng.choice(STREETS), rng.choice(
+        DIRTY_STREET_TYPES if dirty(rng, 'street', dirty_rates) else CLEAN_STREET_TYPES))),
+      ('phone', rng.choice(DIRTY_PHONES) % number if dirty(rng, 'phone', dirty_rates) else '202555%04d' % number),
+      ('addr:postcode', '200%02d-%04d' % (number % 100, number) if dirty(rng, 'postcode', dirty_rates)
+       else '200%02d' % (number % 100)),
+    ]
+  else:
+    county = rng.choice(COUNTIES)
+    choices = [
+      ('highway', rng.choice(['residential', 'primary', 'service'])),
+      ('tiger:county', county + ', MD' if dirty(rng, 'county', dirty_rates) else county),
+      ('addr:street', '%s %s' % (rng.choice(STREETS), rng.choice(
+        DIRTY_STREET_TYPES if dirty(rng, 'street', dirty_rates) else CLEAN_STREET_TYPES))),
+    ]
+
+  for k, v in choices:
+    if len(tags) < tags_per_element:
+      tags.append((k, v))
+  for i in range(tags_per_element - len(tags)):
+    tags.append(('note:%d' % i, 'value %d' % rng.randint(0, 99)))
+  return tags
+
+
+def generate_osm(path, nodes=10000, ways=None, tags_per_element=3, way_length=8, dirty_rates=None, seed=0):
+  """Write a synthetic OSM XML extract, the same one for the same arguments
+
+  ways defaults to one per six nodes and a relation is added per ten ways. Every element carries
+  tags_per_element tags, ways reference way_length random nodes, and dirty_rates overrides the
+  DIRTY_RATES share of values the cleaners have to fix."""
+  rng = random.Random(seed)
+  ways = nodes // 6 if ways is None else ways
+  rates = dict(DIRTY_RATES, **(dirty_rates or {}))
+  attrib = 'user="bench" uid="1" version="1" changeset="1" timestamp="2017-01-01T00:00:00Z"'
+
+  def write_tags(osm, tags):
+    for k, v in tags:
+      osm.write('  <tag k=%s v=%s/>\n' % (quoteattr(k), quoteattr(v)))
+
+  with open(path, 'w') as osm:
+    osm.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n')
+    for node_id in range(1, nodes + 1):
+      osm.write(' <node id="%d" lat="%.7f" lon="%.7f" %s>\n' % (
+        node_id, 38.8 + rng.random() * 0.2, -77.1 + rng.random() * 0.2, attrib))
+      write_tags(osm, synthetic_tags(rng, 'node', tags_per_element, rates))
+      osm.write(' </node>\n')
+
+    for way_id in range(1, ways + 1):
+      osm.write(' <way id="%d" %s>\n' % (way_id, attrib))
+      for _ in range(way_length):
+        osm.write('  <nd ref="%d"/>\n' % rng.randint(1, nodes))
+      write_tags(osm, synthetic_tags(rng, 'way', tags_per_element, rates))
+      osm.write(' </way>\n')
+
+    for relation_id in range(1, ways // 10 + 1):
+      osm.write(' <relation id="%d" %s>\n' % (relation_id, attrib))
+      osm.write('  <member type="way" ref="%d" role="outer"/>\n' % rng.randint(1, ways))
+      osm.write('  <member type="node" ref="%d" role=""/>\n' % rng.randint(1, nodes))
+      write_tags(osm, [('type', 'multipolygon')])
+      osm.write(' </relation>\n')
+    osm.write('</osm>\n')
+
+
+def timed(func):
+  start = time.time()
+  func()
+  return time.time() - start
+
+
+def git_commit():
+  """Return the short hash of the checked out commit, None outside a git work tree"""
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                   cwd=os.path.dirname(os.path.abspath(__file__))).strip().decode('ascii')
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def schema_available():
+  """True if the schema module process_map validates with can be imported"""
+  try:
+    dce.load_schema()
+  except ImportError:
+    return False
+  return True
+
+
+def bench_suite(sizes=SUITE_SIZES, seed=0, results_path=RESULTS_PATH):
+  """Time the pipeline stages on synthetic extracts of every size and append the timings to results_path
+
+  Each size is a node count. get_element only parses, shape_element runs on the parsed elements,
+  every registered auditor runs on its own and process_map does a full csv run, without validation so
+  the timings compare across checkouts. process_map_validated adds it when the schema module imports."""
+  results_path = os.path.abspath(results_path)
+  workdir = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  os.chdir(workdir)
+
+  results = {}
+  try:
+    for size in sizes:
+      osm_file = 'synthetic_%d.osm' % size
+      generate_osm(osm_file, nodes=size, seed=seed)
+      print('suite: %d nodes, %.1f MB' % (size, os.path.getsize(osm_file) / 1e6))
+
+      timings = collections.OrderedDict()
+      timings['get_element'] = timed(lambda: collections.deque(dce.get_element(osm_file), maxlen=0))
+      # the Element backends clear every element once the next one is read, the expat records stay whole
+      elements = list(dce.get_element(osm_file, backend='expat'))
+      timings['shape_element'] = timed(lambda: [dce.shape_element(element) for element in elements])
+      elements = None
+      for name in sorted(data_audit.AUDITORS):
+        auditor = data_audit.AUDITORS[name]
+        timings['audit_' + name] = timed(lambda: data_audit.run_audits(osm_file, [auditor()]))
+      timings['process_map'] = timed(lambda: dce.process_map(osm_file, False))
+      if schema_available():
+        timings['process_map_validated'] = timed(lambda: dce.process_map(osm_file, True))
+
+      for stage, seconds in timings.items():
+        print('  %-21s %8.3f s' % (stage, seconds))
+      results[str(size)] = timings
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+
+  history = []
+  if os.path.exists(results_path):
+    with open(results_path) as results_file:
+      history = json.load(results_file)
+  record = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': seed,
+            'python': sys.version.split()[0], 'results': results}
+
+  if history:
+    compare_results(history[-1], record)
+  history.append(record)
+  with open(results_path, 'w') as results_file:
+    json.dump(history, results_file, indent=2)
+
+
+def compare_results(previous, current):
+  """Print the ratio of every timing of current to the same timing of previous"""
+  print('compared with %s of %s' % (previous['commit'], previous['date']))
+  for size, timings in sorted(current['results'].items(), key=lambda item: int(item[0])):
+    before = previous['results'].get(size, {})
+    for stage, seconds in timings.items():
+      if before.get(stage):
+        print('  %8s %-21s %8.3f s  %6.2fx' % (size, stage, seconds, seconds / before[stage]))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the cleaning and extraction code')
+  parser.add_argument('osm_file', nargs='?', default=dce.OSM_PATH)
+  parser.add_argument('--suite', action='store_true', help='run the suite on synthetic extracts instead')
+  parser.add_argument('--sizes', default=','.join(str(size) for size in SUITE_SIZES),
+                      help='comma separated node counts of the synthetic extracts')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--results', default=RESULTS_PATH, help='json file the suite results are appended to')
+  args = parser.parse_args()
+
+  if args.suite:
+    bench_suite([int(size) for size in args.sizes.split(',')], args.seed, args.results)
+    sys.exit()
+
+  bench_shape_element_scaling()
+  bench_street_names()
+  bench_rules()
+  bench_id_sets()
+  bench_node_locations()
+  osm_file = args.osm_file
+  bench_tag_interning(osm_file)
+  bench_backends(osm_file)
+  bench_csv_writers(osm_file)
+  bench_columnar(osm_file)
+  bench_dedup(osm_file)
+  bench_validation(osm_file)
+  bench_sqlite(osm_file)
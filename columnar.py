@@ -0,0 +1,205 @@
+"""
+Typed column files for the tables written by data_cleaning_extraction.
+
+A column file holds one table. Rows are cut into chunks of CHUNK_ROWS and every column of a chunk is
+encoded by its type and zlib compressed on its own, so a scan only inflates the columns it reads:
+
+- int32/int64/float64 columns are little endian fixed width arrays
+- string columns are the uint32 byte lengths of the values followed by their utf-8 bytes
+- dict columns hold the distinct values of the chunk like a string column, then one uint32 index
+  per row into them, for the user names, tag keys and types that repeat all over a map
+
+Layout: MAGIC, the column blocks, a JSON footer with the fields, types and the (offset, size) of
+every block, the uint64 size of the footer and MAGIC again. ColumnReader memory maps the file and
+reads the footer from its end, blocks are inflated straight from the map.
+"""
+
+import json
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'OSMCOL1\n'
+
+# rows per chunk, a chunk of every column is encoded and held in memory at once
+CHUNK_ROWS = 65536
+
+FIXED_WIDTH = {'int32': 'i', 'int64': 'q', 'float64': 'd'}
+CONVERT = {'int32': int, 'int64': int, 'float64': float}
+TYPES = set(FIXED_WIDTH) | set(['string', 'dict'])
+
+
+# ================================================== #
+#               Encoding                             #
+# ================================================== #
+def to_bytes(value):
+  """utf-8 bytes of a unicode or byte string value, other values are formatted first"""
+  if isinstance(value, bytes):
+    return value
+  if not isinstance(value, type(u'')):
+    value = u'%s' % value
+  return value.encode('utf-8')
+
+
+def encode_strings(values):
+  data = [to_bytes(value) for value in values]
+  return struct.pack('<%dI' % len(data), *[len(value) for value in data]) + b''.join(data)
+
+
+def decode_strings(buf, count, pos=0):
+  """Decode count strings of an encode_strings block starting at buf[pos], return them with the end position"""
+  lengths = struct.unpack_from('<%dI' % count, buf, pos)
+  pos += 4 * count
+  values = []
+  for length in lengths:
+    values.append(buf[pos:pos + length].decode('utf-8'))
+    pos += length
+  return values, pos
+
+
+def encode_column(column_type, values):
+  """Encode the values of one column of a chunk"""
+  if column_type in FIXED_WIDTH:
+    convert = CONVERT[column_type]
+    return struct.pack('<%d%s' % (len(values), FIXED_WIDTH[column_type]), *[convert(value) for value in values])
+
+  if column_type == 'string':
+    return encode_strings(values)
+
+  index = {}
+  codes = [index.setdefault(value, len(index)) for value in values]
+  dictionary = sorted(index, key=index.get)
+  return (struct.pack('<I', len(dictionary)) + encode_strings(dictionary) +
+          struct.pack('<%dI' % len(codes), *codes))
+
+
+def decode_column(column_type, buf, count):
+  """Decode the count values of one column of a chunk"""
+  if column_type in FIXED_WIDTH:
+    return struct.unpack('<%d%s' % (count, FIXED_WIDTH[column_type]), buf)
+
+  if column_type == 'string':
+    return decode_strings(buf, count)[0]
+
+  size = struct.unpack_from('<I', buf)[0]
+  dictionary, pos = decode_strings(buf, size, 4)
+  return [dictionary[code] for code in struct.unpack_from('<%dI' % count, buf, pos)]
+
+
+# ================================================== #
+#               Files                                #
+# ================================================== #
+class ColumnWriter(object):
+  """Write rows given as tuples in the order of fields to a column file at path
+
+  resume takes what checkpoint() returned and continues the file after the chunks written by then."""
+
+  def __init__(self, path, fields, types, chunk_rows=CHUNK_ROWS, resume=None):
+    unknown = set(types) - TYPES
+    if unknown:
+      raise ValueError('unknown column types: %s' % ', '.join(sorted(unknown)))
+
+    self.fields = list(fields)
+    self.types = list(types)
+    self.chunk_rows = chunk_rows
+    self.rows = []
+
+    if resume is None:
+      self.chunks = []
+      self.file = open(path, 'wb')
+      self.file.write(MAGIC)
+      self.offset = len(MAGIC)
+    else:
+      self.chunks = resume['chunks']
+      self.offset = resume['offset']
+      self.file = open(path, 'r+b')
+      self.file.truncate(self.offset)
+      self.file.seek(self.offset)
+
+  def append(self, row):
+    self.rows.append(row)
+    if len(self.rows) >= self.chunk_rows:
+      self.flush()
+
+  def extend(self, rows):
+    self.rows.extend(rows)
+    while len(self.rows) >= self.chunk_rows:
+      self.flush()
+
+  def flush(self):
+    """Encode, compress and write up to chunk_rows buffered rows as one chunk
+
+    Chunks always hold chunk_rows rows but the last and those cut short by checkpoint(), so the file does
+    not depend on how rows were added."""
+    rows = self.rows[:self.chunk_rows]
+    if not rows:
+      return
+
+    blocks = []
+    for column_type, values in zip(self.types, zip(*rows)):
+      block = zlib.compress(encode_column(column_type, values))
+      self.file.write(block)
+      blocks.append((self.offset, len(block)))
+      self.offset += len(block)
+
+    self.chunks.append({'rows': len(rows), 'columns': blocks})
+    del self.rows[:len(rows)]
+
+  def checkpoint(self):
+    """Write the buffered rows and return the state resume continues from"""
+    while self.rows:
+      self.flush()
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    return {'offset': self.offset, 'chunks': list(self.chunks)}
+
+  def close(self):
+    while self.rows:
+      self.flush()
+    footer = json.dumps({'fields': self.fields, 'types': self.types, 'chunks': self.chunks}).encode('utf-8')
+    self.file.write(footer + struct.pack('<Q', len(footer)) + MAGIC)
+    self.file.close()
+
+
+class ColumnReader(object):
+  """Memory map a column file and decode its columns chunk by chunk"""
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    tail = len(MAGIC) + 8
+    if self.map[:len(MAGIC)] != MAGIC or self.map[-len(MAGIC):] != MAGIC:
+      raise ValueError('%s is not a column file' % path)
+    size = struct.unpack_from('<Q', self.map, len(self.map) - tail)[0]
+    footer = json.loads(self.map[len(self.map) - tail - size:len(self.map) - tail].decode('utf-8'))
+
+    self.fields = footer['fields']
+    self.types = footer['types']
+    self.chunks = footer['chunks']
+    self.rows = sum(chunk['rows'] for chunk in self.chunks)
+
+  def read_chunk(self, index, field):
+    """Decode the values of field in chunk index"""
+    chunk = self.chunks[index]
+    column = self.fields.index(field)
+    offset, size = chunk['columns'][column]
+    return decode_column(self.types[column], zlib.decompress(self.map[offset:offset + size]), chunk['rows'])
+
+  def column(self, field):
+    """Yield every value of field, in row order"""
+    for index in range(len(self.chunks)):
+      for value in self.read_chunk(index, field):
+        yield value
+
+  def iter_rows(self, fields=None):
+    """Yield the rows as tuples of the values of fields, all fields by default"""
+    fields = fields or self.fields
+    for index in range(len(self.chunks)):
+      for row in zip(*[self.read_chunk(index, field) for field in fields]):
+        yield row
+
+  def close(self):
+    self.map.close()
+    self.file.close()
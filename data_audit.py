@@ -1,110 +1,314 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
+import hashlib
+import json
+import math
 import re
 import pprint
+import struct
+
+from data_cleaning_extraction import CLEANERS, RULES, get_element, read_tags
 
 
 OSM_PATH = "sample.osm"
+AUDIT_REPORT_PATH = "audit_report.json"
+
+# distinct values counted per audited field, the most frequent ones reported and the size of the
+# distinct count sketch (2 ** SKETCH_PRECISION one byte registers), together they cap the memory of an audit
+AUDIT_CAPACITY = 1000
+AUDIT_TOP_K = 20
+SKETCH_PRECISION = 12
 
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
 
-expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
-            "Trail", "Parkway", "Commons"]
+# the street types of the cleaning rules, the ones the extractor does not expand
+expected = RULES['expected_street_types']
+
+AUDITORS = {}
+
+class HeavyHitters(object):
+    '''counts values in at most capacity counters (Misra-Gries)
+
+    while no more than capacity distinct values were seen the counts are exact. after that a value which
+    does not fit decrements every counter instead, so the counts kept are at most dropped too low and
+    every value seen more than total / capacity times is still among them'''
+
+    def __init__(self, capacity=AUDIT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.dropped = 0
+
+    def add(self, value):
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < self.capacity:
+            counts[value] = 1
+        else:
+            # each counter removed here was incremented as often before, which keeps add() amortized O(1)
+            self.dropped += 1
+            for key in list(counts):
+                if counts[key] == 1:
+                    del counts[key]
+                else:
+                    counts[key] -= 1
+
+    def top(self, k=AUDIT_TOP_K):
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+class DistinctSketch(object):
+    '''HyperLogLog estimate of the number of distinct values, in 2 ** precision bytes'''
+
+    def __init__(self, precision=SKETCH_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        hashed = struct.unpack('<Q', hashlib.sha1(value).digest()[:8])[0]
+
+        # the first precision bits pick the register, which keeps the longest run of leading zeros of the rest
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(b'\x00')
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate while many registers are still empty
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+class ValueStats(object):
+    '''streaming summary of the values of a field: their total, most frequent values and distinct count
+
+    cleaner is the compiled cleaning rule the extractor runs on the field, every value is checked against it so
+    the report tells how many values and which of the frequent ones cleaning would change'''
+
+    def __init__(self, cleaner=None, capacity=AUDIT_CAPACITY):
+        self.cleaner = cleaner
+        self.total = 0
+        self.changed = 0
+        self.counts = HeavyHitters(capacity)
+        self.sketch = DistinctSketch()
+
+    def add(self, value):
+        self.total += 1
+        self.counts.add(value)
+        self.sketch.add(value)
+        if self.cleaner is not None and self.cleaner(value) != value:
+            self.changed += 1
+
+    def result(self, top_k=AUDIT_TOP_K):
+        exact = self.counts.dropped == 0
+        top = []
+        for value, count in self.counts.top(top_k):
+            entry = {'value': value, 'count': count}
+            if self.cleaner is not None:
+                entry['cleaned'] = self.cleaner(value)
+                entry['changed'] = entry['cleaned'] != value
+            top.append(entry)
+
+        result = {'total': self.total,
+                  'distinct': len(self.counts.counts) if exact else self.sketch.estimate(),
+                  'distinct_exact': exact,
+                  'top': top}
+        if self.cleaner is not None:
+            result['changed'] = self.changed
+        return result
+
+def registered_cleaner(key):
+    '''returns the cleaner the extractor runs on the values of a tag key, None if there is none'''
+    if key in CLEANERS:
+        return CLEANERS[key][0]
+    return None
+
+def register_auditor(cls):
+    '''adds an auditor class to the registry used by audit_all'''
+    AUDITORS[cls.name] = cls
+    return cls
+
+class Auditor(object):
+    '''base class for an audit run inside the single pass of run_audits
+
+    subclasses declare the element types and tag keys they are interested in, audit() is then
+    called once per matching element with a dictionary holding only those tag keys and values.
+    result() returns a JSON serializable summary whose size does not grow with the input'''
+    name = None
+    element_types = ()
+    tag_keys = ()
+
+    def audit(self, element_type, tags):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def report(self):
+        pprint.pprint(self.result())
+
+@register_auditor
+class StreetAuditor(Auditor):
+    '''counts the unexpected street types and the street names which have them'''
+    name = 'streets'
+    element_types = ('node', 'way')
+    tag_keys = ('addr:street',)
+
+    def __init__(self):
+        self.street_types = ValueStats()
+        self.street_names = ValueStats(registered_cleaner('addr:street'))
+
+    def audit(self, element_type, tags):
+        street_name = tags.get('addr:street')
+        if street_name is None:
+            return
+
+        match = street_type_re.search(street_name)
+
+        if match:
+            street_type = match.group()
+
+            if street_type not in expected:
+                self.street_types.add(street_type)
+                self.street_names.add(street_name)
+
+    def result(self):
+        return {'street_types': self.street_types.result(), 'street_names': self.street_names.result()}
+
+@register_auditor
+class PharmacyAuditor(Auditor):
+    '''counts the names of pharmacies'''
+    name = 'pharmacy'
+    element_types = ('node',)
+    tag_keys = ('amenity', 'name')
+
+    def __init__(self):
+        self.pharmacy_values = ValueStats(registered_cleaner('name'))
+
+    def audit(self, element_type, tags):
+        if tags.get('amenity') == 'pharmacy' and 'name' in tags:
+            self.pharmacy_values.add(tags['name'])
+
+    def result(self):
+        return self.pharmacy_values.result()
+
+@register_auditor
+class CountyAuditor(Auditor):
+    '''counts the county values of ways'''
+    name = 'county'
+    element_types = ('way',)
+    tag_keys = ('tiger:county',)
+
+    def __init__(self):
+        self.county_values = ValueStats(registered_cleaner('tiger:county'))
+
+    def audit(self, element_type, tags):
+        if 'tiger:county' in tags:
+            self.county_values.add(tags['tiger:county'])
+
+    def result(self):
+        return self.county_values.result()
+
+@register_auditor
+class PhoneAuditor(Auditor):
+    '''counts the phone values of nodes'''
+    name = 'phone'
+    element_types = ('node',)
+    tag_keys = ('phone', 'contact:phone', 'phone:pharmacy')
+
+    def __init__(self):
+        self.phone_values = ValueStats(registered_cleaner('phone'))
+
+    def audit(self, element_type, tags):
+        for key in self.tag_keys:
+            if key in tags:
+                self.phone_values.add(tags[key])
+
+    def result(self):
+        return self.phone_values.result()
+
+@register_auditor
+class PostcodeAuditor(Auditor):
+    '''counts the postal code values of nodes'''
+    name = 'postcode'
+    element_types = ('node',)
+    tag_keys = ('addr:postcode',)
+
+    def __init__(self):
+        self.postcode_values = ValueStats(registered_cleaner('addr:postcode'))
+
+    def audit(self, element_type, tags):
+        if 'addr:postcode' in tags:
+            self.postcode_values.add(tags['addr:postcode'])
+
+    def result(self):
+        return self.postcode_values.result()
+
+def run_audits(filename, auditors, backend=None):
+    '''parses the file once and hands every element to each auditor interested in its type'''
+    interested = defaultdict(list)
+    tag_keys = defaultdict(set)
+
+    for auditor in auditors:
+        for element_type in auditor.element_types:
+            interested[element_type].append(auditor)
+            tag_keys[element_type].update(auditor.tag_keys)
+
+    for elem in get_element(filename, tags=tuple(interested), backend=backend):
+        # collect only the tag keys some auditor asked for, reading the element's tags once
+        keys = tag_keys[elem.tag]
+        tags = {}
+        for k, v in read_tags(elem):
+            if k in keys:
+                tags[k] = v
+
+        if tags:
+            for auditor in interested[elem.tag]:
+                auditor.audit(elem.tag, tags)
+
+    return auditors
+
+def audit_all(filename, names=None, report_path=AUDIT_REPORT_PATH):
+    '''runs the registered auditors (or only the named ones) in a single pass, outputs their summaries
+    and writes them to a JSON report at report_path'''
+    if names is None:
+        names = sorted(AUDITORS)
+
+    report = {}
+    for auditor in run_audits(filename, [AUDITORS[name]() for name in names]):
+        print(auditor.name)
+        auditor.report()
+        report[auditor.name] = auditor.result()
+
+    if report_path is not None:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
 
 def audit_streets(filename):
     '''outputs specific street values to be reviewed for potential future correction'''
-    bad_streets = defaultdict(set)
-
-    for event, elem in ET.iterparse(filename):
-        if elem.tag == "node" or elem.tag == "way":
-
-            for attr in elem.iter("tag"):
-                k = attr.attrib["k"]
-
-                '''Finds if attribute is a street name'''
-                if k == "addr:street":
-                    '''finds street names which have unexpected street types and then creates a dictionary with the unknown street type 
-                        and then the entire street name. '''
-                    street_name = attr.attrib["v"]
-                    match = street_type_re.search(street_name)
-
-                    if match:
-                        street_type = match.group()
-
-                        if street_type not in expected:
-                            bad_streets[street_type].add(street_name)
-    pprint.pprint(bad_streets)
+    run_audits(filename, [StreetAuditor()])[0].report()
 
 def audit_pharmacy(osmfile):
     '''outputs specific values to be reviewed for potential future correction'''
-
-    pharmacy_values = []
-
-    for _, elem in ET.iterparse(osmfile):
-
-        if elem.tag == "node": 
-            n = {}
-
-            for tag in elem.iter("tag"):
-                n[tag.attrib['k']] = tag.attrib['v']
-
-            if 'amenity' in n.keys() and n['amenity'] == 'pharmacy' and 'name' in n.keys(): 
-                pharmacy_values.append(n['name'])
-
-    pprint.pprint(pharmacy_values)
+    run_audits(osmfile, [PharmacyAuditor()])[0].report()
 
 def audit_county(osmfile):
     '''outputs specific county values to be reviewed for potential future correction'''
-
-    county_values = []
-
-    for _, elem in ET.iterparse(osmfile):
-
-        if elem.tag == "way": 
-            w = {}
-
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] == 'tiger:county':
-                    county_values.append(tag.attrib['v'])
-
-    pprint.pprint(county_values)
+    run_audits(osmfile, [CountyAuditor()])[0].report()
 
 def audit_phone(osmfile):
     '''outputs specific phone values to be reviewed for potential future correction'''
-
-    phone_values = []
-
-    for _, elem in ET.iterparse(osmfile):
-
-        if elem.tag == "node": 
-            n = {}
-
-            for tag in elem.iter("tag"):
-                n[tag.attrib['k']] = tag.attrib['v']
-
-            if 'phone' in n.keys():
-                phone_values.append(n['phone'])
-
-            if 'contact:phone' in n.keys():
-                phone_values.append(n['contact:phone'])
-
-            if 'phone:pharmacy' in n.keys():
-                phone_values.append(n['phone:pharmacy'])
-
-    pprint.pprint(phone_values)
+    run_audits(osmfile, [PhoneAuditor()])[0].report()
 
 def audit_postcode(osmfile):
     '''outputs specific postal code values to be reviewed for potential future correction'''
+    run_audits(osmfile, [PostcodeAuditor()])[0].report()
 
-    postcode_values = []
-
-    for _, elem in ET.iterparse(osmfile):
-
-        if elem.tag == "node": 
-            n = {}
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] == 'addr:postcode':
-                    postcode_values.append(tag.attrib['v'])
 
-    pprint.pprint(postcode_values)
+if __name__ == '__main__':
+    audit_all(OSM_PATH)
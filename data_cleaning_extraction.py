@@ -154,13 +154,52 @@ The final return value for a "way" element should look something like:
                'value': '366409'}]}
 """
 
+import argparse
+import array
+import binascii
+import bisect
+import bz2
 import csv
-import codecs
+import gzip
+import heapq
+import json
+import marshal
+import multiprocessing
+import os
+import mmap
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import xml.etree.cElementTree as ET
-import cerberus
+import zlib
+from collections import namedtuple
+from operator import itemgetter
+from xml.parsers import expat
 
-import schema
+import columnar
+import pbf_reader
+
+try:
+  from lxml import etree as lxml_etree
+except ImportError:
+  lxml_etree = None
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+try:
+  import Queue as queue
+except ImportError:
+  import queue
 
 OSM_PATH = "sample.osm"
 
@@ -169,11 +208,97 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+WAY_GEOMETRY_PATH = "ways_geometry.csv"
+TAG_STATS_PATH = "tag_stats.csv"
+ELEMENT_HISTORY_PATH = "element_history.csv"
+SQLITE_PATH = "osm.db"
+STATS_PATH = "stats.json"
+CHECKPOINT_PATH = "checkpoint.json"
+
+# bytes handed to the XML parser per read, elements are released after every read
+READ_SIZE = 64 * 1024
+
+# compressed input: extension -> (external decompressor, python opener used when it is not installed)
+DECOMPRESSORS = {'.bz2': ('bzip2', bz2.BZ2File), '.gz': ('gzip', gzip.open),
+                 '.xz': ('xz', lzma.open if lzma is not None else None)}
+
+# reads the background decompression thread may run ahead of the parser
+DECOMPRESS_QUEUE_SIZE = 16
+
+# children of the <osm> root, the lxml backend clears each of them once it is finished
+OSM_TOP_LEVEL_TAGS = ('bounds', 'node', 'way', 'relation')
+
+# parallel runs cut the file into this many shards per worker so slow shards even out
+SHARDS_PER_WORKER = 4
+SHARD_BOUNDARY = re.compile(br'<(?:node|way|relation)[\s/>]|</osm>')
+
+# checkpointed runs save their progress after every segment of about this many input bytes
+CHECKPOINT_BYTES = 256 * 1024 * 1024
+
+# DedupSink: elements sorted in memory per run spilled to disk, and runs merged at once
+DEDUP_MODES = ('latest', 'history')
+DEDUP_RUN_SIZE = 50000
+DEDUP_MERGE_FANIN = 64
+
+# what the expat backend yields instead of an Element: tags holds the (k, v) pairs, nds the nd refs and
+# members the (type, ref, role) of every relation member
+OSMRecord = namedtuple('OSMRecord', ['tag', 'attrib', 'tags', 'nds', 'members'])
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
-SCHEMA = schema.schema
+# schema.schema only describes nodes and ways, the other tables are checked with the same kind of rules.
+# schema is only imported to validate (see load_schema) and cerberus is the validator callers of validate_element
+# pass in, data_audit reads without them
+RELATION_SCHEMA = {
+  'relation': {'type': 'dict', 'schema': {
+    'id': {'required': True, 'type': 'integer', 'coerce': int},
+    'user': {'required': True, 'type': 'string'},
+    'uid': {'required': True, 'type': 'integer', 'coerce': int},
+    'version': {'required': True, 'type': 'string'},
+    'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+    'timestamp': {'required': True, 'type': 'string'}}},
+  'relation_members': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+    'id': {'required': True, 'type': 'integer', 'coerce': int},
+    'member_id': {'required': True, 'type': 'integer', 'coerce': int},
+    'member_type': {'required': True, 'type': 'string'},
+    'role': {'required': True, 'type': 'string'},
+    'position': {'required': True, 'type': 'integer', 'coerce': int}}}},
+  'relation_tags': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+    'id': {'required': True, 'type': 'integer', 'coerce': int},
+    'key': {'required': True, 'type': 'string'},
+    'value': {'required': True, 'type': 'string'},
+    'type': {'required': True, 'type': 'string'}}}},
+}
+EXTRA_SCHEMA = dict(RELATION_SCHEMA)
+
+EXTRA_SCHEMA['way_geometry'] = {'type': 'dict', 'schema': {
+  'id': {'required': True, 'type': 'integer', 'coerce': int},
+  'geometry': {'required': True, 'type': 'string'}}}
+
+EXTRA_SCHEMA['tag_stats'] = {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+  'element_type': {'required': True, 'type': 'string'},
+  'key': {'required': True, 'type': 'string'},
+  'type': {'required': True, 'type': 'string'},
+  'count': {'required': True, 'type': 'integer', 'coerce': int},
+  'distinct_values': {'required': True, 'type': 'integer', 'coerce': int}}}}
+
+EXTRA_SCHEMA['element_history'] = {'type': 'dict', 'schema': {
+  'element_type': {'required': True, 'type': 'string'},
+  'id': {'required': True, 'type': 'integer', 'coerce': int},
+  'version': {'required': True, 'type': 'integer', 'coerce': int},
+  'changeset': {'required': True, 'type': 'integer', 'coerce': int},
+  'user': {'required': True, 'type': 'string'},
+  'uid': {'required': True, 'type': 'integer', 'coerce': int},
+  'valid_from': {'required': True, 'type': 'string'},
+  'valid_to': {'required': True, 'type': 'string'}}}
+
+# python types accepted by the cerberus type names used in the schema
+SCHEMA_TYPES = {'integer': (int, long), 'float': (float, int, long), 'number': (float, int, long),
+                'string': basestring, 'boolean': bool, 'dict': dict, 'list': list}
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -181,278 +306,1101 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'member_type', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+WAY_GEOMETRY_FIELDS = ['id', 'geometry']
+TAG_STATS_FIELDS = ['element_type', 'key', 'type', 'count', 'distinct_values']
+ELEMENT_HISTORY_FIELDS = ['element_type', 'id', 'version', 'changeset', 'user', 'uid', 'valid_from', 'valid_to']
+
+# shaped element key, csv path and fields of every output table
+OUTPUT_TABLES = [('node', NODES_PATH, NODE_FIELDS),
+                 ('node_tags', NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+                 ('way', WAYS_PATH, WAY_FIELDS),
+                 ('way_nodes', WAY_NODES_PATH, WAY_NODES_FIELDS),
+                 ('way_tags', WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+                 ('relation', RELATIONS_PATH, RELATION_FIELDS),
+                 ('relation_members', RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS),
+                 ('relation_tags', RELATION_TAGS_PATH, RELATION_TAGS_FIELDS),
+                 ('way_geometry', WAY_GEOMETRY_PATH, WAY_GEOMETRY_FIELDS),
+                 ('tag_stats', TAG_STATS_PATH, TAG_STATS_FIELDS),
+                 ('element_history', ELEMENT_HISTORY_PATH, ELEMENT_HISTORY_FIELDS)]
+
+# column types of the columnar output (see columnar), fields not listed are stored as plain strings
+COLUMNAR_EXTENSION = '.col'
+ELEMENT_COLUMNS = {'id': 'int64', 'user': 'dict', 'uid': 'int64', 'version': 'dict', 'changeset': 'int64'}
+TAG_COLUMNS = {'id': 'int64', 'key': 'dict', 'type': 'dict'}
+COLUMN_TYPES = {'node': dict(ELEMENT_COLUMNS, lat='float64', lon='float64'),
+                'node_tags': TAG_COLUMNS,
+                'way': ELEMENT_COLUMNS,
+                'way_nodes': {'id': 'int64', 'node_id': 'int64', 'position': 'int32'},
+                'way_tags': TAG_COLUMNS,
+                'relation': ELEMENT_COLUMNS,
+                'relation_members': {'id': 'int64', 'member_id': 'int64', 'member_type': 'dict', 'role': 'dict',
+                                     'position': 'int32'},
+                'relation_tags': TAG_COLUMNS,
+                'way_geometry': {'id': 'int64'},
+                'tag_stats': {'element_type': 'dict', 'key': 'dict', 'type': 'dict', 'count': 'int64',
+                              'distinct_values': 'int64'},
+                'element_history': {'element_type': 'dict', 'id': 'int64', 'version': 'int32', 'changeset': 'int64',
+                                    'user': 'dict', 'uid': 'int64'}}
+
+# SQLite table of every shaped element key, with the schema the csv(s) are usually imported into
+SQL_TABLES = {'node': 'nodes', 'node_tags': 'nodes_tags', 'way': 'ways', 'way_nodes': 'ways_nodes',
+              'way_tags': 'ways_tags', 'relation': 'relations', 'relation_members': 'relations_members',
+              'relation_tags': 'relations_tags', 'way_geometry': 'ways_geometry', 'tag_stats': 'tag_stats',
+              'element_history': 'element_history'}
+
+SQL_SCHEMA = """
+CREATE TABLE nodes (id INTEGER PRIMARY KEY NOT NULL, lat REAL, lon REAL, user TEXT, uid INTEGER,
+                    version INTEGER, changeset INTEGER, timestamp TEXT);
+CREATE TABLE nodes_tags (id INTEGER, key TEXT, value TEXT, type TEXT, FOREIGN KEY (id) REFERENCES nodes(id));
+CREATE TABLE ways (id INTEGER PRIMARY KEY NOT NULL, user TEXT, uid INTEGER, version TEXT, changeset INTEGER,
+                   timestamp TEXT);
+CREATE TABLE ways_tags (id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, type TEXT,
+                        FOREIGN KEY (id) REFERENCES ways(id));
+CREATE TABLE ways_nodes (id INTEGER NOT NULL, node_id INTEGER NOT NULL, position INTEGER NOT NULL,
+                         FOREIGN KEY (id) REFERENCES ways(id), FOREIGN KEY (node_id) REFERENCES nodes(id));
+CREATE TABLE relations (id INTEGER PRIMARY KEY NOT NULL, user TEXT, uid INTEGER, version TEXT,
+                        changeset INTEGER, timestamp TEXT);
+CREATE TABLE relations_tags (id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, type TEXT,
+                             FOREIGN KEY (id) REFERENCES relations(id));
+CREATE TABLE relations_members (id INTEGER NOT NULL, member_id INTEGER NOT NULL, member_type TEXT NOT NULL,
+                                role TEXT, position INTEGER NOT NULL, FOREIGN KEY (id) REFERENCES relations(id));
+CREATE TABLE ways_geometry (id INTEGER PRIMARY KEY NOT NULL, geometry TEXT NOT NULL,
+                            FOREIGN KEY (id) REFERENCES ways(id));
+CREATE TABLE tag_stats (element_type TEXT NOT NULL, key TEXT NOT NULL, type TEXT NOT NULL,
+                        count INTEGER NOT NULL, distinct_values INTEGER NOT NULL,
+                        PRIMARY KEY (element_type, type, key));
+CREATE TABLE element_history (element_type TEXT NOT NULL, id INTEGER NOT NULL, version INTEGER NOT NULL,
+                              changeset INTEGER, user TEXT, uid INTEGER, valid_from TEXT NOT NULL, valid_to TEXT);
+"""
+
+# tables holding the rows of each element type, the element's own table first
+ELEMENT_TABLES = {'node': ('node', 'node_tags'), 'way': ('way', 'way_nodes', 'way_tags', 'way_geometry'),
+                  'relation': ('relation', 'relation_members', 'relation_tags')}
+
+# built once the load is finished, maintaining them during the inserts would slow every batch down
+SQL_INDEXES = """
+CREATE INDEX nodes_tags_id ON nodes_tags (id);
+CREATE INDEX ways_tags_id ON ways_tags (id);
+CREATE INDEX ways_nodes_id ON ways_nodes (id, position);
+CREATE INDEX ways_nodes_node_id ON ways_nodes (node_id);
+CREATE INDEX relations_tags_id ON relations_tags (id);
+CREATE INDEX relations_members_id ON relations_members (id, position);
+CREATE INDEX relations_members_member_id ON relations_members (member_type, member_id);
+CREATE INDEX element_history_id ON element_history (element_type, id, version);
+"""
+
+# optional R-tree over the node coordinates, query it with
+#   SELECT id FROM nodes_rtree WHERE min_lat >= ? AND max_lat <= ? AND min_lon >= ? AND max_lon <= ?
+# it keeps 32 bit floats rounded outwards, join nodes for the exact coordinates at the edges
+SQL_SPATIAL_INDEX = """
+CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes;
+"""
+
+# IdSet: a sorted array of 8 byte ids ('q' is missing from Python 2 arrays, where 'l' has 8 bytes on 64 bit
+# Linux and macOS), and bitmap pages of 2 ** 16 ids in 8 KB for the pages holding as many bytes of ids.
+# Ids added out of order are merged into the array in batches of at least ID_PENDING
+ID_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+ID_PAGE_SHIFT = 16
+ID_PAGE_MASK = (1 << ID_PAGE_SHIFT) - 1
+ID_PAGE_BYTES = (1 << ID_PAGE_SHIFT) // 8
+ID_DENSE_IDS = ID_PAGE_BYTES // 8
+ID_PENDING = 65536
+
+# ReferenceCheck: what it does with ways that reference nodes which were not written, and how many of
+# the dangling way and relation ids it lists in the stats
+INTEGRITY_MODES = ('report', 'drop')
+DANGLING_SAMPLE = 100
+
+# node locations: coordinates are kept as 1e-7 degree integers and the file of NodeLocationStore grows by
+# LOCATION_GROW_BYTES. GeometryBuilder keeps them in a SparseLocationStore, 16 bytes per node, and every time
+# the node count doubles from LOCATION_CHECK_NODES checks whether the ids span less than LOCATION_DENSE_SPAN
+# ids per node, so the 8 bytes per id of a NodeLocationStore take less
+LOCATION_SCALE = 10 ** 7
+LOCATION_GROW_BYTES = 64 * 1024 * 1024
+LOCATION_CHECK_NODES = 1 << 16
+LOCATION_DENSE_SPAN = 2
+
+# tag_stats: distinct values per key are counted exactly up to this many, then estimated from the smallest
+# this many 32 bit hashes of the values
+TAG_STATS_SKETCH = 256
+
+# seconds between the progress lines of PipelineStats
+PROGRESS_EVERY = 30
+
+# rows buffered by the SQLite sink before an executemany and commit
+SQLITE_BATCH_SIZE = 50000
+
+# rows buffered by the csv sink before a writerows, and the write buffer of each csv file
+CSV_BATCH_SIZE = 20000
+CSV_BUFFER_SIZE = 1024 * 1024
 
-mapping = { "St": "Street",
-            "St.": "Street",
-            "Ave": "Avenue",
-            "Ave.": "Avenue",
-            "ave": "Avenue",
-            "Rd.": "Road",
-            "rd": "Road",
-            "Rd\\": "Road",
-            "Rd": "Road",
-            "RD": "Road",
-            "NE": "Northeast",
-            "N.W.": "Northwast",
-            "n.w.": "Northwast",
-            "NW": "Northwast",
-            "Cir": "Circle",
-            "Dr": "Drive",
-            "Dr.": "Drive",
-            "Ct": "Court",
-            "E": "East",
-            "W": "West",
-            "N": "West",
-            "Ln.": "Lane",
-            "Blvd": "Boulevard",
-            "Pl": "Place",
-            "Ter": "Terrace"
-            }
+# distinct values memoized per cleaner, real extracts repeat the same street names thousands of times
+CACHE_SIZE = 10000
+
+# street types, overrides and rewrites of the cleaners, shared with data_audit
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cleaning_rules.json')
+
+def load_rules(path=RULES_PATH):
+  """Read a cleaning rules file: the street types, their abbreviations and the cleaners, see compile_rule"""
+  with open(path) as rules_file:
+    return json.load(rules_file)
+
+RULES = load_rules()
+
+# street type abbreviations expanded by update_name
+mapping = RULES['street_type_mapping']
+
+# compass directions and quadrants which may follow a street type, mapped or not: "N", "SW", "N.W."
+STREET_DIRECTION = r'[NSEWnsew]\.?(?:[NSEWnsew]\.?)?'
 
 def is_street_name(elem):
-    '''Finds if attribute is a street name'''
-    return (elem.attrib['k'] == "addr:street")
+  """Finds if attribute is a street name"""
+  return (elem.attrib['k'] == "addr:street")
 
-def update_name(name, mapping):
-    '''corrects street type in street name'''
-    for map in mapping:
 
-        if mapping[map] in name:
-            return name
+class BoundedCache(object):
+  """Memoizes a one-argument function in at most maxsize entries
 
-        elif map in name:
-            name = name.replace(map, mapping[map])
+  Entries live in two generations: a hit in the old generation is promoted to the new one, and when the
+  new generation is full the old one is dropped. Recently used values therefore stay cached like in an
+  LRU, without reordering anything on every hit. changes counts the calls whose result differs from
+  their argument, the values a cleaner actually fixed."""
 
-    return name
+  def __init__(self, func, maxsize=CACHE_SIZE, name=None):
+    self.func = func
+    self.name = name or func.__name__
+    self.maxsize = maxsize
+    self.new = {}
+    self.old = {}
+    self.hits = 0
+    self.misses = 0
+    self.changes = 0
 
-def fix_pharmacy(value):
-  # remove non-letters and pharmacy from names of pharmacies
-  value = value.replace('/', '')
-  value = value.replace('-', '')
-  value = value.replace('Pharmacy', '')
-  value = value.replace('pharmacy', '')
-  value = value.replace(' ', '')
-  
-  return value
+  def __call__(self, value):
+    if value in self.new:
+      self.hits += 1
+      result = self.new[value]
+      if result != value:
+        self.changes += 1
+      return result
+
+    if value in self.old:
+      self.hits += 1
+      result = self.old[value]
+    else:
+      self.misses += 1
+      result = self.func(value)
+
+    if result != value:
+      self.changes += 1
+    if len(self.new) >= self.maxsize // 2:
+      self.old = self.new
+      self.new = {}
+    self.new[value] = result
+    return result
+
+
+def literal_pattern(words):
+  """Builds a regular expression matching any of words, the longest one first
+
+  The words are laid out as a trie, so a prefix they share is matched once and the cost of a match
+  hardly grows with the number of words, unlike an alternation of all of them."""
+  trie = {}
+  for word in words:
+    node = trie
+    for char in word:
+      node = node.setdefault(char, {})
+    node[''] = {}
+  return trie_pattern(trie)
+
+
+def trie_pattern(node):
+  """Pattern of the words below a node of the trie built by literal_pattern, '' marks a word ending there"""
+  branches = [re.escape(char) + trie_pattern(child) for char, child in sorted(node.items()) if char]
+  if not branches:
+    return ''
+  if '' in node:
+    # the word ending here is only taken when no longer one matches
+    return '(?:%s)?' % '|'.join(branches)
+  if len(branches) == 1:
+    return branches[0]
+  return '(?:%s)' % '|'.join(branches)
+
+
+def street_normalizer(mapping, maxsize=CACHE_SIZE):
+  """Compiles mapping into one memoized function expanding the street type at the end of a name
 
-def fix_county(value):
+  A mapped token is only replaced when it is the last word of the name or only followed by another
+  mapped word or a direction (as in "Georgia Ave NW" or "Main St SW"), so "St" inside "Stanton" is left
+  alone."""
+  alternation = literal_pattern(mapping)
+  street_types = re.compile(r'(?<=\s)(%s)(?=$|\s+(?:%s|%s)$)' % (alternation, alternation, STREET_DIRECTION))
+
+  def expand(match):
+    return mapping[match.group(1)]
+
+  normalizer = BoundedCache(lambda name: street_types.sub(expand, name), maxsize, name='update_name')
+  normalizer.mapping = mapping
+  return normalizer
+
+
+normalize_street = street_normalizer(mapping)
+
+
+def update_name(name, mapping):
+  """Corrects street type in street name"""
+  if mapping is normalize_street.mapping:
+    return normalize_street(name)
+  return street_normalizer(mapping)(name)
+
+# ================================================== #
+#               Cleaning Rules                       #
+# ================================================== #
+def first_county(value):
   # if only one county listed, remove state abbreviation
   if value.find(':') == -1 and value.find(';') == -1 :
     value = value.split(',', 1)[0]
-  
-  return value
 
-def fix_phone(value):
-  # modify all phone numbers so they are simply 10 digits
-  
-  # +1 866-RIDMTA should be 1-866-RIDE-MTA
-  # https://mta.maryland.gov/ride-mta-to-african-american-festival
-  if value == '+1 866-RIDMTA':
-    value = '8667433682'
-  
-  # +13192881 should be 2023192881
-  # https://www.yelp.com/biz/jolie-jewelry-washington
-  if value == '+13192881':
-    value =  '2023192881'
-  
-  # 649 3555 should be 3016493555
-  # https://standrewapostle.org/School-WP/contact/
-  if value == '649 3555':
-    value =  '3016493555'
-  
-  value = value.replace('+1 ', '')
-  value = value.replace('-', '')
-  value = value.replace(' ', '')
-  value = value.replace('.', '')
-  value = value.replace('(', '')
-  value = value.replace(')', '')
-  value = value.replace('+1', '')
-  value = value.replace('New Customer: ', '')
-  value = value.replace('Susanna Farm Nursery: ', '')
-  value = value.replace('tel:', '')
-  
-  if len(value)>10:
-    value = value[0:10]
-  
   return value
 
-def fix_postcode(value):
-  # modify all postcode numbers so they are simply 5 digits
-  
-  # 2011 should be 20011
-  # https://www.yelp.com/biz/epiphany-open-pit-beef-and-subs-washington
-  if value == '2011':
-    value = '20011'
-  
-  # 2005 should be 20005
-  # https://www.google.com/maps/place/7-Eleven/@38.9084384,-77.0322289,21z/data=!4m18!1m12!4m11!1m3!2m2!1d-77.0321551!2d38.9085401!1m6!1m2!1s0x89b7b7ea61f0d259:0x8fc5b8b0c95d49af!2s7-Eleven+Washington,+DC!2m2!1d-77.0321722!2d38.9085452!3m4!1s0x89b7b7ea61f0d259:0x8fc5b8b0c95d49af!8m2!3d38.9085452!4d-77.0321722
-  if value == '2005':
-    value = '20005'
-  
-  if len(value)!=5:
-    value = value[0:5]
-  
-  return value
+# functions the cleaners of a rules file can name as their "normalizer", besides "street_type"
+NORMALIZERS = {'first_county': first_county}
+
+RULE_FIELDS = set(['name', 'keys', 'when', 'overrides', 'rewrites', 'normalizer', 'max_length'])
+
+
+def compile_rewrites(rewrites, name='rewrites'):
+  """Compile the rewrites of a cleaner into one function making them all in a single pass, None if there are none
+
+  A rewrite replaces a "literal" string or the matches of a regular expression "pattern" with "replace",
+  in which the groups of a pattern can be referred to like in re.sub. Patterns are joined into one
+  expression with the literals, so they cannot set global flags like (?i).
+  The literals become one trie (see literal_pattern) and the patterns are added to it as alternatives, so
+  at every position the longest literal is tried first, then the patterns in their order. Literals cost
+  about the same however many there are, every pattern adds its own test at every position.
+  When every rewrite has the same replacement without group references the expression is substituted
+  with it directly, else each alternative is a named group and the name of the one that matched picks
+  the replacement, no pattern is matched twice. The numbered backreferences of a pattern are renumbered
+  like the groups of its replacement, the names of its groups must differ from those of the others.
+  name, the name of the cleaning rule, is given in the ValueError raised for invalid rewrites."""
+  literals = {}
+  patterns = []
+  group_names = {}
+  for rewrite in rewrites:
+    if 'literal' in rewrite:
+      literals[rewrite['literal']] = rewrite['replace']
+    else:
+      compiled = re.compile(rewrite['pattern'])
+      if compiled.flags & ~re.UNICODE:
+        raise ValueError("the rewrite pattern '%s' of cleaning rule '%s' sets flags, which would apply to every "
+                         "rewrite" % (rewrite['pattern'], name))
+      for group in compiled.groupindex:
+        if group in group_names or REWRITE_GROUP.match(group):
+          raise ValueError("the rewrite pattern '%s' of cleaning rule '%s' names a group '%s' which is already "
+                           "used by %s" % (rewrite['pattern'], name, group,
+                                           "'%s'" % group_names[group] if group in group_names else 'the rewrites'))
+        group_names[group] = rewrite['pattern']
+      patterns.append((compiled, rewrite['replace']))
+  if not literals and not patterns:
+    return None
+
+  replacements = set(literals.values()) | set(replacement for _, replacement in patterns)
+  if len(replacements) == 1 and not any(compiled.groups for compiled, _ in patterns):
+    replacement = replacements.pop()
+    if '\\' not in replacement:
+      alternatives = ['(?:%s)' % expression.pattern for expression, _ in patterns]
+      if literals:
+        alternatives.insert(0, literal_pattern(literals))
+      combined = re.compile('|'.join(alternatives))
+      return lambda value: combined.sub(replacement, value)
+
+  # name of a pattern's group -> its replacement, or its template with the group numbers of the combined
+  # expression when it refers to groups, to expand
+  constants = {}
+  templates = {}
+  alternatives = []
+  if literals:
+    alternatives.append('(?P<literal>%s)' % literal_pattern(literals))
+  for index, (compiled, replacement) in enumerate(patterns):
+    group = 'rewrite%d' % index
+    # the groups of the pattern are numbered after the group wrapping it and those of the patterns before it
+    offset = 1 + len(alternatives) + sum(other.groups for other, _ in patterns[:index])
+    alternatives.append('(?P<%s>%s)' % (group, renumber_backreferences(compiled.pattern, offset, name)))
+    if '\\' in replacement:
+      templates[group] = renumber_template(replacement, offset)
+    else:
+      constants[group] = replacement
+  combined = re.compile('|'.join(alternatives))
+
+  def replace(match):
+    name = match.lastgroup
+    if name == 'literal':
+      return literals[match.group()]
+    replacement = constants.get(name)
+    if replacement is not None:
+      return replacement
+    return match.expand(templates[name])
+
+  return lambda value: combined.sub(replace, value)
+
+
+# the names compile_rewrites gives the groups wrapping the literals and each pattern
+REWRITE_GROUP = re.compile(r'literal$|rewrite\d+$')
+
+# an octal, backreference or other escape, a character class or a conditional on a group of a pattern
+PATTERN_TOKEN = re.compile(r'\\(?:[0-7]{3}|([1-9]\d?)|.)|\[\^?\]?(?:\\.|[^\]\\])*\]|\(\?\((\d+)\)', re.DOTALL)
+
+def renumber_backreferences(pattern, offset, name='rewrites'):
+  """Shift the numbered backreferences and group conditionals of pattern by offset, named ones are kept"""
+  def renumber(match):
+    reference, condition = match.group(1), match.group(2)
+    if reference is None and condition is None:
+      return match.group()
+    number = int(reference or condition) + offset
+    if number > 99:
+      raise ValueError("the rewrite pattern '%s' of cleaning rule '%s' refers to a group past the 99 the "
+                       "rewrites can number, use a named group" % (pattern, name))
+    return '(?:\\%d)' % number if reference else '(?(%d)' % number
+  return PATTERN_TOKEN.sub(renumber, pattern)
+
+
+# a group reference or another escape of a re.sub template, \0 starts an octal escape and is no reference
+TEMPLATE_ESCAPE = re.compile(r'\\(?:g<(\d+)>|([1-9]\d?)|.)', re.DOTALL)
+
+def renumber_template(template, offset):
+  """Shift the numbered group references of a re.sub template by offset, named ones are kept"""
+  def renumber(match):
+    number = match.group(1) or match.group(2)
+    if number is None:
+      return match.group()
+    return '\\g<%d>' % (int(number) + offset)
+  return TEMPLATE_ESCAPE.sub(renumber, template)
+
+
+def compile_rule(rule, normalizers=NORMALIZERS):
+  """Compile a cleaner of a rules file into one function of a value
+
+  The value is looked up in the exact "overrides" of the rule, a dictionary, then goes through its
+  "rewrites" (see compile_rewrites), its "normalizer" and is cut to "max_length", each step optional."""
+  unknown = set(rule) - RULE_FIELDS
+  if unknown:
+    raise ValueError("unknown fields in cleaning rule '%s': %s" % (rule['name'], ', '.join(sorted(unknown))))
+
+  steps = []
+  overrides = dict((override['value'], override['fix']) for override in rule.get('overrides', ()))
+  if overrides:
+    steps.append(lambda value: overrides.get(value, value))
+
+  rewrite = compile_rewrites(rule.get('rewrites', ()), rule['name'])
+  if rewrite is not None:
+    steps.append(rewrite)
+
+  if 'normalizer' in rule:
+    if rule['normalizer'] not in normalizers:
+      raise ValueError("unknown normalizer '%s' in cleaning rule '%s'" % (rule['normalizer'], rule['name']))
+    steps.append(normalizers[rule['normalizer']])
+
+  if 'max_length' in rule:
+    max_length = rule['max_length']
+    steps.append(lambda value: value[:max_length])
+
+  if len(steps) == 1 and isinstance(steps[0], BoundedCache):
+    # a memoized normalizer on its own, like the street_type one, is registered as it is
+    return steps[0]
+
+  def clean(value):
+    for step in steps:
+      value = step(value)
+    return value
+
+  clean.__name__ = str(rule['name'])
+  return clean
+
+
+# ================================================== #
+#               Tag Interning                        #
+# ================================================== #
+class TagInterner(object):
+  """Shared tag keys and types for shape_tags
+
+  splits memoizes the (type, key) of every raw "k", or () when the key has problem characters, so each
+  key is searched and split once instead of once per tag and all of its rows share the same two strings.
+  It starts over once it holds maxsize keys, memory stays bounded on unique keys and the frequent ones
+  are back after a few elements. Values are not interned, looking every one up cost more than the loop
+  saved."""
+
+  def __init__(self, problem_chars=PROBLEMCHARS, default_tag_type='regular', maxsize=CACHE_SIZE):
+    self.problem_chars = problem_chars
+    self.default_tag_type = default_tag_type
+    self.maxsize = maxsize
+    self.splits = {}
+
+  def split(self, k):
+    if len(self.splits) >= self.maxsize:
+      self.splits = {}
+
+    if self.problem_chars.search(k):
+      split = ()
+    # if there are no ':' in the key value then the tag type is the default one, else the characters
+    # before the first ":" are the tag type and the rest, additional ":" included, the tag key
+    elif ':' not in k:
+      split = (self.default_tag_type, k)
+    else:
+      split = tuple(k.split(':', 1))
+
+    self.splits[k] = split
+    return split
+
+
+TAG_INTERNER = TagInterner()
+
+
+def tag_value_hash(value):
+  """32 bits of the crc32 of the utf-8 bytes of value mixed by a multiplication, see KeyStatistics"""
+  if not isinstance(value, bytes):
+    value = value.encode('utf-8')
+  return (zlib.crc32(value) & 0xffffffff) * 0x9E3779B97F4A7C15 >> 32 & 0xffffffff
+
+
+class KeyStatistics(object):
+  """Tag count of a key and a k minimum values sketch of its distinct values
+
+  hashes keeps the TAG_STATS_SKETCH smallest value hashes seen, see tag_value_hash. They are computed from
+  the bytes of the value rather than with hash(), which hash randomization changes from process to process.
+  Until that many distinct values were seen it holds all of them and the count is exact, after that
+  the largest hash kept estimates it. Sketches of different shards merge into the sketch of the whole
+  input."""
+
+  __slots__ = ('count', 'hashes', 'threshold')
+
+  def __init__(self, count=0, hashes=()):
+    self.count = count
+    self.hashes = set()
+    self.threshold = None
+    for value_hash in hashes:
+      self.insert(value_hash)
+
+  def insert(self, value_hash):
+    hashes = self.hashes
+    if value_hash in hashes:
+      return
+    if len(hashes) < TAG_STATS_SKETCH:
+      hashes.add(value_hash)
+      if len(hashes) == TAG_STATS_SKETCH:
+        self.threshold = max(hashes)
+    elif value_hash < self.threshold:
+      hashes.remove(self.threshold)
+      hashes.add(value_hash)
+      self.threshold = max(hashes)
+
+  def distinct(self):
+    if self.threshold is None:
+      return len(self.hashes)
+    return min(self.count, int(round((TAG_STATS_SKETCH - 1) * 2.0 ** 32 / (self.threshold + 1))))
+
+
+class TagStatistics(object):
+  """Number of tags and distinct values of every tag type and key, per element type
+
+  shape_element counts the tags it shapes into keys[element type], rows() returns them as the rows
+  of the tag_stats table. state() is JSON serializable, for checkpoints and the shards of parallel runs,
+  and merge() adds such a state to the counts."""
+
+  def __init__(self):
+    self.keys = {'node': {}, 'way': {}, 'relation': {}}
+
+  def state(self):
+    return [[element_type, tag_type, key, counts.count, sorted(counts.hashes)]
+            for element_type, keys in self.keys.items() for (tag_type, key), counts in keys.items()]
+
+  def merge(self, state):
+    for element_type, tag_type, key, count, hashes in state:
+      keys = self.keys[element_type]
+      counts = keys.get((tag_type, key))
+      if counts is None:
+        keys[(tag_type, key)] = KeyStatistics(count, hashes)
+      else:
+        counts.count += count
+        for value_hash in hashes:
+          counts.insert(value_hash)
+
+  def add_rows(self, element_type, tag_rows):
+    """Count tag rows shaped without key_stats"""
+    keys = self.keys[element_type]
+    for row in tag_rows:
+      split = (row['type'], row['key'])
+      counts = keys.get(split)
+      if counts is None:
+        counts = keys[split] = KeyStatistics()
+      counts.count += 1
+      counts.insert(tag_value_hash(row['value']))
+
+  def rows(self):
+    rows = []
+    for element_type in sorted(self.keys):
+      for (tag_type, key), counts in sorted(self.keys[element_type].items()):
+        rows.append({'element_type': element_type, 'key': key, 'type': tag_type, 'count': counts.count,
+                     'distinct_values': counts.distinct()})
+    return rows
+
+
+# ================================================== #
+#               Cleaner Registry                     #
+# ================================================== #
+# tag "k" value -> (memoized cleaner, None or the (k, v) tag the element must also carry)
+CLEANERS = {}
+
+def register_cleaner(keys, cleaner, when=None):
+  """Route the values of every tag key in keys through cleaner, memoized in a BoundedCache
+
+  when=(k, v) only cleans the values of elements which also carry the tag k=v. The same registry is
+  used for nodes and ways."""
+  if not isinstance(cleaner, BoundedCache):
+    cleaner = BoundedCache(cleaner)
+  for key in keys:
+    CLEANERS[key] = (cleaner, when)
+  return cleaner
+
+def register_rules(rules):
+  """Replace the registered cleaners by the compiled cleaners of rules, read by load_rules
+
+  The street_type normalizer expands the street_type_mapping of rules at the end of street names."""
+  street_types = rules['street_type_mapping']
+  normalizers = dict(NORMALIZERS, street_type=normalize_street if street_types == mapping
+                     else street_normalizer(street_types))
+
+  CLEANERS.clear()
+  for rule in rules['cleaners']:
+    when = rule.get('when')
+    register_cleaner(rule['keys'], compile_rule(rule, normalizers), when=tuple(when) if when is not None else None)
+
+register_rules(RULES)
+
+# the cleaners of the default rules, for callers cleaning single values
+fix_pharmacy = CLEANERS['name'][0]
+fix_phone = CLEANERS['phone'][0]
+fix_postcode = CLEANERS['addr:postcode'][0]
+fix_county = CLEANERS['tiger:county'][0]
+
+def cleaner_stats(cleaners=CLEANERS):
+  """Return {cleaner name: (hits, misses)} for the memoized cleaners of the registry"""
+  stats = {}
+  for cleaner, _ in cleaners.values():
+    stats[cleaner.name] = (cleaner.hits, cleaner.misses)
+  return stats
+
+def read_tags(element):
+  """Read the (k, v) pairs of an element's secondary tags once, in document order"""
+  if isinstance(element, OSMRecord):
+    return element.tags
+  return [(tag.attrib['k'], tag.attrib['v']) for tag in element.iter("tag")]
+
+
+def read_nds(element):
+  """Read the node refs of a way's nd tags, in document order"""
+  if isinstance(element, OSMRecord):
+    return element.nds
+  return [nd.attrib['ref'] for nd in element.iter("nd")]
+
+
+def read_members(element):
+  """Read the (type, ref, role) of a relation's member tags, in document order"""
+  if isinstance(element, OSMRecord):
+    return element.members
+  return [(member.attrib['type'], member.attrib['ref'], member.attrib.get('role', ''))
+          for member in element.iter("member")]
+
+
+def shape_tags(element_id, tag_pairs, problem_chars=PROBLEMCHARS, default_tag_type='regular', cleaners=CLEANERS,
+               interner=TAG_INTERNER, key_stats=None):
+  """Clean and split the (k, v) pairs read by read_tags into "node_tags"/"way_tags" dictionaries
+
+  Keys and types come from interner, see TagInterner. key_stats, one of the TagStatistics.keys dictionaries,
+  counts the tags and their values, None skips the counting."""
+  tags = []
+  tag_lookup = None
+  if interner.problem_chars is not problem_chars or interner.default_tag_type != default_tag_type:
+    interner = tag_interner(problem_chars, default_tag_type)
+  splits = interner.splits
+
+  for k, v in tag_pairs:
+    # a memoized (type, key) split, empty if we find problem characters in the key and skip this tag
+    split = splits.get(k)
+    if split is None:
+      split = interner.split(k)
+    if not split:
+      continue
+
+    # one dictionary lookup finds the cleaner registered for the key, if any
+    cleaner = cleaners.get(k)
+    if cleaner is not None:
+      clean, when = cleaner
+      if when is not None and tag_lookup is None:
+        tag_lookup = dict(tag_pairs)
+      if when is None or tag_lookup.get(when[0]) == when[1]:
+        v = clean(v)
+
+    tags.append({'id': element_id, 'key': split[1], 'value': v, 'type': split[0]})
+
+    if key_stats is not None:
+      counts = key_stats.get(split)
+      if counts is None:
+        counts = key_stats[split] = KeyStatistics()
+      counts.count += 1
+      value_hash = tag_value_hash(v)
+      if value_hash not in counts.hashes and (counts.threshold is None or value_hash < counts.threshold):
+        counts.insert(value_hash)
+
+  return tags
+
+
+# interners of the problem_chars and default_tag_type shape_tags was called with besides the default ones
+TAG_INTERNERS = {}
+
+def tag_interner(problem_chars, default_tag_type):
+  interner = TAG_INTERNERS.get((problem_chars, default_tag_type))
+  if interner is None:
+    interner = TAG_INTERNERS[(problem_chars, default_tag_type)] = TagInterner(problem_chars, default_tag_type)
+  return interner
+
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-  """Clean and shape node or way XML element to Python dict"""
-
-  node_attribs = {}
-  way_attribs = {}
-  way_nodes = []
-  tags = []  # Handle secondary tags the same way for both node and way elements
-  
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular', relation_attr_fields=RELATION_FIELDS,
+                  tag_stats=None):
+  """Clean and shape node, way or relation XML element to Python dict, counting its tags into tag_stats
+  (a TagStatistics) if given"""
+  key_stats = tag_stats.keys.get(element.tag) if tag_stats is not None else None
+
   if element.tag == 'node':
     # create a dictionary of all attributes of a specific node element
+    node_attribs = {}
     for node_field in node_attr_fields:
       node_attribs[node_field] = element.attrib[node_field]
-    
-    # iterate through all "tag" attributes set underneath the specific node selected
-    for tag in element.iter("tag"):
-      tag_dict = {}
-      n = {}
-      
-      # creates dictionary of all "tag" attributes keys and values set underneath the specific node selected
-      for tag in element.iter("tag"):
-        n[tag.attrib['k']] = tag.attrib['v']
-      
-      # sends all pharmacy names values through the fix_pharmacy function to clean their values then saves the cleaned
-      # value in the tag_dict dictionary
-      if tag.attrib['k'] == "name" and 'amenity' in n.keys() and n['amenity'] == 'pharmacy' and 'name' in n.keys(): 
-        tag_dict['value'] = fix_pharmacy(tag.attrib['v'])
-      
-      # sends all pharmacy names values through the fix_pharmacy function to clean their values then saves the cleaned
-      # value in the tag_dict dictionary
-      elif tag.attrib['k'] == 'phone':
-        tag_dict['value'] = fix_phone(tag.attrib['v'])
-      
-      # sends all phone number values through the fix_phone function to clean their values then saves the cleaned
-      # value in the tag_dict dictionary
-      elif tag.attrib['k'] == 'contact:phone':
-        tag_dict['value'] = fix_phone(tag.attrib['v'])
-      
-      # sends all pharmacy phone number values through the fix_phone function to clean their values then saves the 
-      # cleaned value in the tag_dict dictionary
-      elif tag.attrib['k'] == 'phone:pharmacy':
-        tag_dict['value'] = fix_phone(tag.attrib['v'])
-      
-      # sends all postal code values through the fix_postcode function to clean their values then saves the 
-      # cleaned value in the tag_dict dictionary
-      elif tag.attrib['k'] == 'addr:postcode':
-        tag_dict['value'] = fix_postcode(tag.attrib['v'])
-      
-      # Saves key value into the tag_dict dictionary if the value does not need to be cleaned
-      else:
-        tag_dict['value'] = tag.attrib['v']
-      
-      tag_dict['id'] = node_attribs['id']
-      
-
-      catch = problem_chars.search(tag.attrib['k'])
-      # if we find problem characters in the key then skip this element
-      if catch:
-        continue
-      
-      # if there are no problem characters or ':' in the key value then process element
-      elif ':' not in tag.attrib['k']:
-        tag_dict['key'] = tag.attrib['k']
-        tag_dict['type'] = 'regular'
-      
-      # if the tag "k" value contains a ":" the characters before the ":" is set as the tag type
-      # and characters after the ":" isset as the tag key
-      # if there are additional ":" in the "k" value they are ignored and kept as part of
-      # the tag key
-      elif ':' in tag.attrib['k']:
-        tag_dict['key'] = tag.attrib['k'].split(':', 1)[1]
-        tag_dict['type'] = tag.attrib['k'].split(':', 1)[0]
-      
-      tags.append(tag_dict)
-  
+
+    # the "tag" children are read a single time, all cleaning and key splitting works from that list
+    tags = shape_tags(node_attribs['id'], read_tags(element), problem_chars, default_tag_type, key_stats=key_stats)
+
+    return {'node': node_attribs, 'node_tags': tags}
+
   elif element.tag == 'way':
-    index = 0
     # create a dictionary of all attributes of a specific way element
+    way_attribs = {}
     for way_field in way_attr_fields:
       way_attribs[way_field] = element.attrib[way_field]
-    
 
-    for tag in element.iter("tag"):
-      tag_dict = {}
-
-      # sends all county values through the fix_county function to clean their values then save the 
-      # cleaned value in the tag_dict dictionary
-      if tag.attrib['k'] == 'tiger:county':
-        tag_dict['value'] = fix_county(tag.attrib['v'])
-      
-      # sends all street name values through the update_name function to clean their values then save the 
-      # cleaned value in the tag_dict dictionary
-      elif is_street_name(tag):
-        tag_dict['value'] = update_name(tag.attrib['v'], mapping)
-      
-      # Saves key value into the tag_dict dictionary if the value does not need to be cleaned
-      else:
-        tag_dict['value'] = tag.attrib['v']
-      
-      tag_dict['id'] = way_attribs['id']
-      
-      catch = problem_chars.search(tag.attrib['k'])
-      # if we find problem characters in the key then skip this element
-      if catch:
-        continue
-      
-      # if there are no problem characters or ':' in the key value then process element
-      elif ':' not in tag.attrib['k']:
-        tag_dict['key']= tag.attrib['k']
-        tag_dict['type']= 'regular'
-      
-      # if the tag "k" value contains a ":" the characters before the ":" is set as the tag type
-      # and characters after the ":" isset as the tag key
-      # if there are additional ":" in the "k" value they are ignored and kept as part of
-      # the tag key
-      elif ':' in tag.attrib['k']:
-        tag_dict['key'] = tag.attrib['k'].split(':', 1)[1]
-        tag_dict['type'] = tag.attrib['k'].split(':', 1)[0]
-      
-      tags.append(tag_dict)
-    
-    # Creates "way_nodes" list which holds a list of dictionaries, one for each nd child tag.  
+    tags = shape_tags(way_attribs['id'], read_tags(element), problem_chars, default_tag_type, key_stats=key_stats)
+
+    # Creates "way_nodes" list which holds a list of dictionaries, one for each nd child tag.
     # Each dictionary has the fields:
     # id: the top level element (way) id
     # node_id: the ref attribute value of the nd tag
     # position: the index starting at 0 of the nd tag i.e. what order the nd tag appears within the way element
-    for tag in element.iter("nd"):
-      tag_dict = {}
-      tag_dict['id'] = way_attribs['id']
-      tag_dict['node_id'] = tag.attrib['ref']
-      tag_dict['position'] = index
-      index += 1
-      way_nodes.append(tag_dict)
+    way_nodes = []
+    for index, ref in enumerate(read_nds(element)):
+      way_nodes.append({'id': way_attribs['id'], 'node_id': ref, 'position': index})
 
-  if element.tag == 'node':
-    return {'node': node_attribs, 'node_tags': tags}
-  
-  elif element.tag == 'way':
     return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
+  elif element.tag == 'relation':
+    relation_attribs = {}
+    for relation_field in relation_attr_fields:
+      relation_attribs[relation_field] = element.attrib[relation_field]
+
+    tags = shape_tags(relation_attribs['id'], read_tags(element), problem_chars, default_tag_type,
+                      key_stats=key_stats)
+
+    # one dictionary per member child, position is the order the member appears within the relation
+    relation_members = []
+    for index, (member_type, ref, role) in enumerate(read_members(element)):
+      relation_members.append({'id': relation_attribs['id'], 'member_id': ref, 'member_type': member_type,
+                               'role': role, 'position': index})
+
+    return {'relation': relation_attribs, 'relation_members': relation_members, 'relation_tags': tags}
+
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-  """Yield element if it is the right type of tag"""
-
-  context = ET.iterparse(osm_file, events=('start', 'end'))
-  _, root = next(context)
-  
-  for event, elem in context:
-  
-    if event == 'end' and elem.tag in tags:
+class TopLevelBuilder(object):
+  """XMLParser target that builds the wanted top level elements one at a time
+
+  Only the elements at depth level (2 for the children of the <osm> root) are built, and only if their
+  tag is wanted. Their ancestors are never built, so a finished element is not referenced by anything
+  once the caller drops it. Below the root, as in the <create>/<modify>/<delete> blocks of an OsmChange
+  file, the tag of the enclosing element is yielded along with each element."""
+
+  def __init__(self, tags, level=2):
+    self.tags = tags
+    self.level = level
+    self.depth = 0
+    self.parent = None
+    self.builder = None
+    self.finished = []
+
+  def start(self, tag, attrib):
+    self.depth += 1
+    if self.depth == self.level - 1:
+      self.parent = tag
+    elif self.depth == self.level and tag in self.tags:
+      self.builder = ET.TreeBuilder()
+    if self.builder is not None:
+      self.builder.start(tag, attrib)
+
+  def end(self, tag):
+    if self.builder is not None:
+      elem = self.builder.end(tag)
+      if self.depth == self.level:
+        self.finished.append(elem if self.level == 2 else (self.parent, elem))
+        self.builder = None
+    self.depth -= 1
+
+  def data(self, data):
+    # OSM keeps everything in attributes, the whitespace between elements is not needed
+    pass
+
+  def close(self):
+    return None
+
+
+class RecordBuilder(object):
+  """expat handlers that collect the wanted top level elements into OSMRecords without building Elements"""
+
+  def __init__(self, tags, level=2):
+    self.tags = tags
+    self.level = level
+    self.depth = 0
+    self.parent = None
+    self.record = None
+    self.finished = []
+
+  def start(self, tag, attrib):
+    self.depth += 1
+    if self.depth == self.level - 1:
+      self.parent = tag
+    elif self.depth == self.level:
+      if tag in self.tags:
+        self.record = OSMRecord(tag, attrib, [], [], [])
+    elif self.depth == self.level + 1 and self.record is not None:
+      if tag == 'tag':
+        self.record.tags.append((attrib['k'], attrib['v']))
+      elif tag == 'nd':
+        self.record.nds.append(attrib['ref'])
+      elif tag == 'member':
+        self.record.members.append((attrib['type'], attrib['ref'], attrib.get('role', '')))
+
+  def end(self, tag):
+    if self.depth == self.level and self.record is not None:
+      self.finished.append(self.record if self.level == 2 else (self.parent, self.record))
+      self.record = None
+    self.depth -= 1
+
+
+def feed_parser(source, read_size, feed, close, builder):
+  """Feed source to a parser read_size bytes at a time, yielding what builder finished after every read"""
+  while True:
+    chunk = source.read(read_size)
+    if not chunk:
+      break
+    feed(chunk)
+    finished, builder.finished = builder.finished, []
+    for elem in finished:
+      yield elem
+
+  close()
+  for elem in builder.finished:
+    yield elem
+
+
+def iter_etree(source, tags, read_size, level=2):
+  """cElementTree backend, yields Elements"""
+  target = TopLevelBuilder(tags, level)
+  parser = ET.XMLParser(target=target)
+  return feed_parser(source, read_size, parser.feed, parser.close, target)
+
+
+def iter_expat(source, tags, read_size, level=2):
+  """expat backend, yields OSMRecords straight from the attribute dictionaries"""
+  builder = RecordBuilder(tags, level)
+  parser = expat.ParserCreate()
+  parser.StartElementHandler = builder.start
+  parser.EndElementHandler = builder.end
+  return feed_parser(source, read_size, lambda chunk: parser.Parse(chunk, False),
+                     lambda: parser.Parse(b'', True), builder)
+
+
+def iter_lxml(source, tags, read_size, level=2):
+  """lxml backend, yields lxml Elements and deletes each one from the tree once it is processed"""
+  for _, elem in lxml_etree.iterparse(source, events=('end',), tag=OSM_TOP_LEVEL_TAGS):
+    if elem.tag in tags:
+      yield elem if level == 2 else (elem.getparent().tag, elem)
+
+    elem.clear()
+    while elem.getprevious() is not None:
+      del elem.getparent()[0]
+
+
+PARSER_BACKENDS = {'etree': iter_etree, 'expat': iter_expat}
+if lxml_etree is not None:
+  PARSER_BACKENDS['lxml'] = iter_lxml
+
+DEFAULT_BACKEND = 'lxml' if 'lxml' in PARSER_BACKENDS else 'etree'
+
+
+class DecompressorProcess(object):
+  """File-like object reading the output of an external decompressor, which runs in its own process
+  and stays at most one pipe buffer ahead of the parser"""
+
+  def __init__(self, program, path):
+    self.program = program
+    self.process = subprocess.Popen([program, '-dc', path], stdout=subprocess.PIPE, bufsize=READ_SIZE)
+
+  def read(self, size):
+    chunk = self.process.stdout.read(size)
+    if not chunk and self.process.wait() != 0:
+      raise IOError('%s failed with exit code %d' % (self.program, self.process.returncode))
+    return chunk
+
+  def close(self):
+    if self.process.poll() is None:
+      self.process.terminate()
+    self.process.stdout.close()
+    self.process.wait()
+
+
+class BackgroundReader(object):
+  """File-like object reading a decompressing file object in a daemon thread
+
+  The thread stays at most DECOMPRESS_QUEUE_SIZE reads ahead of the parser, so decompression overlaps
+  with parsing without buffering the whole file."""
+
+  def __init__(self, raw, read_size=READ_SIZE, queue_size=DECOMPRESS_QUEUE_SIZE):
+    self.raw = raw
+    self.chunks = queue.Queue(queue_size)
+    self.error = None
+    self.pending = b''
+    self.done = False
+    self.stopping = False
+    self.thread = threading.Thread(target=self.fill, args=(read_size,))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def fill(self, read_size):
+    try:
+      while not self.stopping:
+        chunk = self.raw.read(read_size)
+        self.chunks.put(chunk)
+        if not chunk:
+          return
+    except Exception as error:
+      self.error = error
+      self.chunks.put(b'')
+
+  def read(self, size):
+    if not self.pending:
+      if self.done:
+        return b''
+
+      self.pending = self.chunks.get()
+      if not self.pending:
+        self.done = True
+        if self.error is not None:
+          raise self.error
+        return b''
+
+    chunk, self.pending = self.pending[:size], self.pending[size:]
+    return chunk
+
+  def close(self):
+    self.stopping = True
+    # empty the queue so a put blocked on a full queue returns and the thread can see stopping
+    while self.thread.is_alive():
+      try:
+        self.chunks.get(timeout=0.1)
+      except queue.Empty:
+        pass
+    self.raw.close()
+
+
+def find_program(name):
+  """Return the path of an executable on the PATH, or None"""
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
+
+
+def is_compressed(osm_file):
+  """True if osm_file is a path with one of the DECOMPRESSORS extensions"""
+  return not hasattr(osm_file, 'read') and os.path.splitext(osm_file)[1] in DECOMPRESSORS
+
+
+def open_input(osm_file):
+  """Return a binary file object for osm_file and whether the caller has to close it
+
+  .bz2, .gz and .xz files are decompressed on the fly, by the external bzip2/gzip/xz program when it is
+  installed and otherwise by the python module in a background thread."""
+  if hasattr(osm_file, 'read'):
+    return osm_file, False
+
+  extension = os.path.splitext(osm_file)[1]
+  if extension in DECOMPRESSORS:
+    program, open_module = DECOMPRESSORS[extension]
+    program_path = find_program(program)
+    if program_path is not None:
+      return DecompressorProcess(program_path, osm_file), True
+    if open_module is None:
+      raise IOError('cannot decompress %s, install %s or the python lzma module' % (osm_file, program))
+    return BackgroundReader(open_module(osm_file, 'rb')), True
+
+  return open(osm_file, 'rb'), True
+
+
+def is_pbf(osm_file):
+  """True if osm_file is the path of an .osm.pbf file"""
+  return not hasattr(osm_file, 'read') and osm_file.endswith('.pbf')
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), read_size=READ_SIZE, backend=None, workers=1):
+  """Yield element if it is the right type of tag
+
+  The file is read through one of PARSER_BACKENDS (lxml when it is installed, etree otherwise) and
+  every top level element is released once it is finished, so memory stays bounded by one read plus
+  the elements it completes. The expat backend yields OSMRecords instead of Elements.
+
+  .osm.pbf files are decoded by pbf_reader into OSMRecords instead, in workers processes."""
+  source, close_source = open_input(osm_file)
+
+  if is_pbf(osm_file):
+    elements = (OSMRecord._make(item) for item in pbf_reader.iter_pbf(source, tags, workers))
+  else:
+    elements = PARSER_BACKENDS[backend or DEFAULT_BACKEND](source, tags, read_size)
+
+  try:
+    for elem in elements:
       yield elem
-      root.clear()
+  finally:
+    if close_source:
+      source.close()
+
+
+def get_changes(osc_file, tags=('node', 'way', 'relation'), read_size=READ_SIZE, backend=None):
+  """Yield (action, element) for the wanted elements of an OsmChange file, action being the enclosing
+  "create", "modify" or "delete" block, with the same memory bound as get_element"""
+  iter_elements = PARSER_BACKENDS[backend or DEFAULT_BACKEND]
+  source, close_source = open_input(osc_file)
+
+  try:
+    for action, elem in iter_elements(source, tags, read_size, level=3):
+      yield action, elem
+  finally:
+    if close_source:
+      source.close()
 
 
-def validate_element(element, validator, schema=SCHEMA):
-  """Raise ValidationError if element does not match schema"""
+def peak_rss():
+  """Return the peak resident memory of this process in bytes, or None where it is not available"""
+  try:
+    import resource
+  except ImportError:
+    return None
+
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def find_boundary(osm_file, offset, read_size=READ_SIZE):
+  """Return the offset of the first top level element start or </osm> at or after offset, None at EOF"""
+  osm_file.seek(offset)
+  base = offset
+  buf = b''
+
+  while True:
+    chunk = osm_file.read(read_size)
+    if not chunk:
+      return None
+    buf += chunk
+
+    match = SHARD_BOUNDARY.search(buf)
+    if match:
+      return base + match.start()
+
+    # keep enough of the tail for a boundary split across two reads
+    tail = buf[-16:]
+    base += len(buf) - len(tail)
+    buf = tail
+
+
+def shard_ranges(file_in, shards):
+  """Cut file_in into at most shards byte ranges which each start at a top level element
+
+  Raises IOError if file_in does not end with </osm>, the shards of a truncated file would lose data."""
+  size = os.path.getsize(file_in)
+
+  with open(file_in, 'rb') as osm_file:
+    osm_file.seek(max(0, size - READ_SIZE))
+    tail = osm_file.read()
+    if tail.rfind(b'</osm>') == -1:
+      raise IOError('%s does not end with </osm>, it is truncated or not an OSM XML file' % file_in)
+    end = size - len(tail) + tail.rfind(b'</osm>')
+
+    cuts = set()
+    for i in range(shards):
+      cut = find_boundary(osm_file, size * i // shards)
+      if cut is not None:
+        cuts.add(min(cut, end))
+
+  cuts = sorted(cuts)
+  return [(start, stop) for start, stop in zip(cuts, cuts[1:] + [end]) if start < stop]
+
+
+class ShardReader(object):
+  """File-like object reading the bytes [start, end) of an OSM file wrapped in an <osm> root of its own"""
+
+  def __init__(self, file_in, start, end):
+    self.file = open(file_in, 'rb')
+    self.file.seek(start)
+    self.remaining = end - start
+    self.pending = [b'</osm>', b'<osm>']
+
+  def read(self, size):
+    if len(self.pending) == 2:
+      return self.pending.pop()
+
+    if self.remaining > 0:
+      chunk = self.file.read(min(size, self.remaining))
+      self.remaining -= len(chunk)
+      if chunk:
+        return chunk
+      self.remaining = 0
+
+    if self.pending:
+      return self.pending.pop()
+    return b''
+
+  def close(self):
+    self.file.close()
+
+
+def load_schema():
+  """Return schema.schema completed with the tables of EXTRA_SCHEMA"""
+  import schema
+  return dict(EXTRA_SCHEMA, **schema.schema)
+
+
+class ValidationError(Exception):
+  """An element does not match the schema, raised by validate_element and CompiledValidator"""
+
+
+def validate_element(element, validator, schema=None):
+  """Raise ValidationError if element does not match schema, by default the one of load_schema"""
+  if schema is None:
+    schema = load_schema()
   if validator.validate(element, schema) is not True:
     field, errors = next(validator.errors.iteritems())
     message_string = "\nElement of type '{0}' has the following errors:\n{1}"
@@ -461,69 +1409,1508 @@ def validate_element(element, validator, schema=SCHEMA):
       for k, v in errors.iteritems()
     )
     
-    raise cerberus.ValidationError(
+    raise ValidationError(
       message_string.format(field, "\n".join(error_strings))
     )
 
 
-class UnicodeDictWriter(csv.DictWriter, object):
-  """Extend csv.DictWriter to handle Unicode input"""
+def compile_fields(field_schemas):
+  """Turn the field rules of a cerberus dict schema into (field, required, coerce, type name) checks"""
+  checks = []
+
+  for field, rules in sorted(field_schemas.items()):
+    unsupported = set(rules) - set(['required', 'type', 'coerce'])
+    if unsupported:
+      raise ValueError("cannot compile rules {0} of field '{1}'".format(sorted(unsupported), field))
+    checks.append((field, rules.get('required', False), rules.get('coerce'), rules['type']))
+
+  return checks
+
+
+# the types a coerce function of the schema returns, a value it coerces needs no type check when they are
+# all of the field's type
+COERCED_TYPES = {int: (int, long), float: (float,)}
+
+def compile_table_check(checks, is_list):
+  """Generate a function testing the rows of a table against all checks, True when they are all valid
+
+  Like cerberus, a row with a field that has no check is invalid. When every field is required their
+  lookups already fail on a missing one, so the row length rules out any other. A list table is looped
+  over in the generated code, so a row costs no function call, and coerced fields are only type checked
+  when the coerce function could return another type. An invalid value can also raise KeyError,
+  TypeError or ValueError."""
+  namespace = {'fields': frozenset(field for field, _, _, _ in checks)}
+  lines = []
+  if all(required for _, required, _, _ in checks):
+    lines.append('if len(row) != %d: return False' % len(checks))
+  else:
+    lines.append('if not fields.issuperset(row): return False')
 
-  def writerow(self, row):
-    super(UnicodeDictWriter, self).writerow({
-      k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-      })
+  for i, (field, required, coerce, type_name) in enumerate(checks):
+    namespace['coerce%d' % i] = coerce
+    namespace['types%d' % i] = types = SCHEMA_TYPES[type_name]
 
-  def writerows(self, rows):
-    for row in rows:
-      self.writerow(row)
+    value = 'row[%r]' % field
+    if coerce is not None:
+      value = 'coerce%d(%s)' % (i, value)
+    if coerce is not None and all(issubclass(result, types) for result in COERCED_TYPES.get(coerce, (object,))):
+      line = value
+    else:
+      line = 'if not isinstance(%s, types%d): return False' % (value, i)
+    if not required:
+      line = 'if %r in row:\n  %s' % (field, line.replace('\n', '\n  '))
+    lines.append(line)
+
+  if is_list:
+    body = 'for row in rows:\n' + ''.join('  %s\n' % line.replace('\n', '\n  ') for line in lines)
+  else:
+    body = 'row = rows\n' + ''.join('%s\n' % line for line in lines)
+  source = 'def check(rows):\n' + ''.join('  %s\n' % line for line in body.splitlines()) + '  return True\n'
+  exec(source, namespace)
+  return namespace['check']
+
+
+class CompiledValidator(object):
+  """Validate shaped elements against a cerberus schema compiled once into plain per-field checks
+
+  Only the required, type and coerce rules used by schema.schema are supported. Each table gets one
+  generated function (see compile_table_check), the per-field loop only runs to describe the errors of an
+  invalid row. sample=None checks every element, an int N every Nth element and a float below 1 a random
+  fraction. Checking every element still adds about a third to the parse and shape time of a generated
+  100k node map (see benchmark.bench_validation), only the sampled modes stay within a fifth of it.
+  schema defaults to the one of load_schema."""
+
+  def __init__(self, schema=None, sample=None, seed=None):
+    if schema is None:
+      schema = load_schema()
+    self.tables = {}
+    for table, rules in schema.items():
+      is_list = rules['type'] == 'list'
+      checks = compile_fields(rules['schema']['schema'] if is_list else rules['schema'])
+      self.tables[table] = (is_list, checks, compile_table_check(checks, is_list))
+
+    self.sample = sample
+    self.random = random.Random(seed)
+    self.seen = 0
+    self.checked = 0
+
+  def validate(self, el):
+    """Raise ValidationError if el is sampled and does not match the schema"""
+    self.seen += 1
+    if self.sample is not None:
+      if isinstance(self.sample, float):
+        if self.random.random() >= self.sample:
+          return
+      elif self.seen % self.sample:
+        return
+    self.checked += 1
+
+    tables = self.tables
+    for table, value in el.items():
+      compiled = tables.get(table)
+      if compiled is None:
+        raise ValidationError("\nElement of type '{0}' has the following errors:\n{0}: unknown field".format(table))
+      is_list, checks, table_check = compiled
+      try:
+        if table_check(value):
+          continue
+      except (KeyError, TypeError, ValueError):
+        pass
+
+      for row in value if is_list else [value]:
+        errors = self.check_row(row, checks)
+        if errors:
+          raise ValidationError(
+            "\nElement of type '{0}' has the following errors:\n{1}".format(table, "\n".join(errors))
+          )
+
+  @staticmethod
+  def check_row(row, checks):
+    fields = set(field for field, _, _, _ in checks)
+    errors = ["{0}: unknown field".format(field) for field in sorted(set(row) - fields)]
+
+    for field, required, coerce, type_name in checks:
+      if field not in row:
+        if required:
+          errors.append("{0}: required field".format(field))
+        continue
+
+      value = row[field]
+      if coerce is not None:
+        try:
+          value = coerce(value)
+        except (TypeError, ValueError):
+          errors.append("{0}: field '{0}' cannot be coerced".format(field))
+          continue
+
+      if not isinstance(value, SCHEMA_TYPES[type_name]):
+        errors.append("{0}: must be of {1} type".format(field, type_name))
+
+    return errors
+
+
+# ================================================== #
+#               Region Filter                        #
+# ================================================== #
+class IdSet(object):
+  """Compact set of integer ids: a sorted array of 8 byte ids, with bitmap pages where the ids are dense
+
+  A regional extract holds ids scattered over the whole id range, which cost 8 bytes each in the array
+  and are found by bisection. Ids are appended to it while they come in ascending order, as in OSM files,
+  and once a page of 2 ** ID_PAGE_SHIFT ids holds ID_DENSE_IDS of them they move to a bitmap of one bit
+  per id of the page, roaring style, so dense ranges cost less than a byte per id.
+  Ids added out of order wait in a set until it holds an eighth of the array, or ID_PENDING of them,
+  then they are merged into the array or the bitmap of their page."""
+
+  def __init__(self):
+    self.ids = array.array(ID_TYPECODE)
+    self.pages = {}
+    self.pending = set()
+    # page of the last id appended and index of its first id in the array
+    self.run_page = None
+    self.run_start = 0
+    self.count = 0
+
+  def add(self, element_id):
+    page_number = element_id >> ID_PAGE_SHIFT
+    page = self.pages.get(page_number)
+    if page is not None:
+      offset = element_id & ID_PAGE_MASK
+      bit = 1 << (offset & 7)
+      if not page[offset >> 3] & bit and element_id not in self.pending:
+        page[offset >> 3] |= bit
+        self.count += 1
+      return
+
+    ids = self.ids
+    if not ids or element_id > ids[-1]:
+      if page_number != self.run_page:
+        self.run_page = page_number
+        self.run_start = bisect.bisect_left(ids, page_number << ID_PAGE_SHIFT)
+      ids.append(element_id)
+      self.count += 1
+      if len(ids) - self.run_start >= ID_DENSE_IDS:
+        self.make_page(page_number)
+    elif element_id not in self:
+      self.pending.add(element_id)
+      self.count += 1
+      if len(self.pending) >= max(ID_PENDING, len(ids) // 8):
+        self.merge_pending()
+
+  def make_page(self, page_number):
+    """Move the ids of the page the array ends with to a bitmap"""
+    page = self.pages[page_number] = bytearray(ID_PAGE_BYTES)
+    for element_id in self.ids[self.run_start:]:
+      offset = element_id & ID_PAGE_MASK
+      page[offset >> 3] |= 1 << (offset & 7)
+    del self.ids[self.run_start:]
+    self.run_page = None
+
+  def merge_pending(self):
+    """Merge the ids added out of order into the array, or the bitmap of their page"""
+    merged = []
+    for element_id in sorted(self.pending):
+      page = self.pages.get(element_id >> ID_PAGE_SHIFT)
+      if page is None:
+        merged.append(element_id)
+      else:
+        offset = element_id & ID_PAGE_MASK
+        page[offset >> 3] |= 1 << (offset & 7)
+    self.ids = array.array(ID_TYPECODE, heapq.merge(self.ids, merged))
+    self.pending = set()
+    self.run_page = None
+
+  def __contains__(self, element_id):
+    page = self.pages.get(element_id >> ID_PAGE_SHIFT)
+    if page is not None:
+      offset = element_id & ID_PAGE_MASK
+      if page[offset >> 3] & (1 << (offset & 7)):
+        return True
+    else:
+      ids = self.ids
+      index = bisect.bisect_left(ids, element_id)
+      if index < len(ids) and ids[index] == element_id:
+        return True
+    return bool(self.pending) and element_id in self.pending
+
+  def __len__(self):
+    return self.count
+
+  def nbytes(self):
+    """Bytes taken by the array and the bitmap pages, without the ids still pending"""
+    return self.ids.buffer_info()[1] * self.ids.itemsize + len(self.pages) * ID_PAGE_BYTES
+
+
+class BBox(object):
+  """Region between two latitudes and two longitudes, in degrees"""
+
+  def __init__(self, min_lat, min_lon, max_lat, max_lon):
+    self.min_lat, self.min_lon, self.max_lat, self.max_lon = min_lat, min_lon, max_lat, max_lon
+
+  def contains(self, lat, lon):
+    return self.min_lat <= lat <= self.max_lat and self.min_lon <= lon <= self.max_lon
+
+
+class Polygon(object):
+  """Region inside a closed ring of (lat, lon) points, tested by ray casting after a bbox check"""
+
+  def __init__(self, points):
+    self.points = [(float(lat), float(lon)) for lat, lon in points]
+    lats = [lat for lat, _ in self.points]
+    lons = [lon for _, lon in self.points]
+    self.bbox = BBox(min(lats), min(lons), max(lats), max(lons))
+    self.edges = list(zip(self.points, self.points[1:] + self.points[:1]))
+
+  def contains(self, lat, lon):
+    if not self.bbox.contains(lat, lon):
+      return False
+
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in self.edges:
+      if (lat1 > lat) != (lat2 > lat) and lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+        inside = not inside
+    return inside
+
+
+def parse_bbox(text):
+  """Read a BBox given on the command line as min_lat,min_lon,max_lat,max_lon"""
+  try:
+    min_lat, min_lon, max_lat, max_lon = [float(value) for value in text.split(',')]
+  except ValueError:
+    raise argparse.ArgumentTypeError("'%s' is not min_lat,min_lon,max_lat,max_lon" % text)
+  if min_lat > max_lat or min_lon > max_lon:
+    raise argparse.ArgumentTypeError("'%s' has a minimum above its maximum" % text)
+  return BBox(min_lat, min_lon, max_lat, max_lon)
+
+
+def read_polygon(path):
+  """Read a Polygon from a file of lat,lon lines, the points of its ring in order"""
+  with open(path) as polygon_file:
+    points = [line.split(',') for line in polygon_file if line.strip()]
+  if len(points) < 3:
+    raise argparse.ArgumentTypeError('%s has fewer than 3 lat,lon points' % path)
+  try:
+    return Polygon(points)
+  except ValueError:
+    raise argparse.ArgumentTypeError('%s has a line that is not lat,lon' % path)
+
+
+class RegionFilter(object):
+  """Decide which streamed elements belong to a BBox or Polygon region
+
+  Nodes are kept when they lie inside the region, ways when any of their nodes was kept and relations
+  when any of their node, way or relation members was. Like in the OSM files, an element has to come
+  after the elements it references, so ways keep all their refs but the nodes outside are not emitted.
+  keep() only decides, add() records an element once it was written: a way kept here can still be
+  dropped by a later check, and relations must not be kept for it."""
+
+  def __init__(self, region):
+    self.region = region
+    self.kept = {'node': IdSet(), 'way': IdSet(), 'relation': IdSet()}
+
+  def keep(self, element):
+    if element.tag == 'node':
+      inside = self.region.contains(float(element.attrib['lat']), float(element.attrib['lon']))
+    elif element.tag == 'way':
+      nodes = self.kept['node']
+      inside = any(int(ref) in nodes for ref in read_nds(element))
+    elif element.tag == 'relation':
+      inside = any(int(ref) in self.kept[member_type] for member_type, ref, _ in read_members(element))
+    else:
+      return False
+    return inside
+
+  def add(self, element):
+    self.kept[element.tag].add(int(element.attrib['id']))
+
+
+# ================================================== #
+#               Referential Integrity                #
+# ================================================== #
+class ReferenceCheck(object):
+  """Check the node refs of ways and the node and way members of relations against the elements written
+  before them
+
+  The written node and way ids are kept in IdSets, 8 bytes per id while they are sparse and one bit per id
+  of the pages they fill. A way with refs to nodes that were not written (clipped by a region, invalid or
+  missing from the input) is dangling, mode='report' counts it and keeps its refs, mode='drop' leaves it out
+  of the output. Relations are only counted, an extract keeps them with the members inside it. Members which
+  are relations are not checked, a relation may come before the relations it contains."""
+
+  def __init__(self, mode='report'):
+    if mode not in INTEGRITY_MODES:
+      raise ValueError("unknown integrity mode '%s', use one of %s" % (mode, ', '.join(INTEGRITY_MODES)))
+    self.drop = mode == 'drop'
+    self.written = {'node': IdSet(), 'way': IdSet()}
+    self.ways = 0
+    self.dangling_ways = 0
+    self.dangling_refs = 0
+    self.sample = []
+    self.relations = 0
+    self.dangling_relations = 0
+    self.dangling_members = 0
+    self.relation_sample = []
+
+  def add(self, element):
+    """Record the id of a node or way that was written"""
+    ids = self.written.get(element.tag)
+    if ids is not None:
+      ids.add(int(element.attrib['id']))
+
+  def keep(self, element):
+    """Check a way or relation, return False if it is a dangling way and dropped"""
+    if element.tag == 'relation':
+      self.check_relation(element)
+      return True
+
+    self.ways += 1
+    nodes = self.written['node']
+    missing = sum(1 for ref in read_nds(element) if int(ref) not in nodes)
+    if not missing:
+      return True
+
+    self.dangling_ways += 1
+    self.dangling_refs += missing
+    if len(self.sample) < DANGLING_SAMPLE:
+      self.sample.append(int(element.attrib['id']))
+    return not self.drop
+
+  def check_relation(self, element):
+    self.relations += 1
+    written = self.written
+    missing = sum(1 for member_type, ref, _ in read_members(element)
+                  if member_type in written and int(ref) not in written[member_type])
+    if missing:
+      self.dangling_relations += 1
+      self.dangling_members += missing
+      if len(self.relation_sample) < DANGLING_SAMPLE:
+        self.relation_sample.append(int(element.attrib['id']))
+
+  def summary(self):
+    return {
+      'nodes': len(self.written['node']),
+      'ways': self.ways,
+      'dangling_ways': self.dangling_ways,
+      'dangling_refs': self.dangling_refs,
+      'dropped_ways': self.dangling_ways if self.drop else 0,
+      'dangling_way_ids': self.sample,
+      'relations': self.relations,
+      'dangling_relations': self.dangling_relations,
+      'dangling_members': self.dangling_members,
+      'dangling_relation_ids': self.relation_sample,
+    }
+
+
+# ================================================== #
+#               Way Geometry                         #
+# ================================================== #
+def encode_location(lat, lon):
+  """Return the latitude + 90 and longitude + 180 degrees in 1e-7 degrees plus one, as two uint32, so a
+  zero never is a location"""
+  return int(round((lat + 90) * LOCATION_SCALE)) + 1, int(round((lon + 180) * LOCATION_SCALE)) + 1
+
+
+def decode_location(lat, lon):
+  return float(lat - 1) / LOCATION_SCALE - 90, float(lon - 1) / LOCATION_SCALE - 180
+
+
+class SparseLocationStore(object):
+  """Node coordinates in memory, a sorted array of node ids and the encode_location pairs in the same order
+
+  It takes 16 bytes per node whatever the ids. Nodes are appended while their ids ascend, as in OSM files,
+  and found by bisection, like the ids of an IdSet. Nodes set out of order wait in a dictionary until it
+  holds an eighth of the nodes, or ID_PENDING of them, then they are merged into the arrays."""
+
+  def __init__(self):
+    self.ids = array.array(ID_TYPECODE)
+    self.locations = array.array('I')
+    self.pending = {}
+
+  def set(self, node_id, lat, lon):
+    ids = self.ids
+    if not ids or node_id > ids[-1]:
+      ids.append(node_id)
+      self.locations.extend(encode_location(lat, lon))
+      return
+
+    index = bisect.bisect_left(ids, node_id)
+    if ids[index] == node_id:
+      self.locations[2 * index:2 * index + 2] = array.array('I', encode_location(lat, lon))
+      return
+    self.pending[node_id] = encode_location(lat, lon)
+    if len(self.pending) >= max(ID_PENDING, len(ids) // 8):
+      self.merge_pending()
+
+  def merge_pending(self):
+    """Merge the nodes set out of order into the arrays, copying the runs of nodes between them at once"""
+    ids, locations = array.array(ID_TYPECODE), array.array('I')
+    start = 0
+    for node_id, location in sorted(self.pending.items()):
+      end = bisect.bisect_left(self.ids, node_id, start)
+      ids.extend(self.ids[start:end])
+      locations.extend(self.locations[2 * start:2 * end])
+      ids.append(node_id)
+      locations.extend(location)
+      start = end
+    ids.extend(self.ids[start:])
+    locations.extend(self.locations[2 * start:])
+    self.ids, self.locations, self.pending = ids, locations, {}
+
+  def get(self, node_id):
+    """Return the (lat, lon) of node_id, None if it was never set"""
+    ids = self.ids
+    index = bisect.bisect_left(ids, node_id)
+    if index < len(ids) and ids[index] == node_id:
+      return decode_location(self.locations[2 * index], self.locations[2 * index + 1])
+    location = self.pending.get(node_id) if self.pending else None
+    return None if location is None else decode_location(*location)
+
+  def items(self):
+    """Yield the (node id, encoded lat, encoded lon) of every node, by id"""
+    self.merge_pending()
+    locations = self.locations
+    for index, node_id in enumerate(self.ids):
+      yield node_id, locations[2 * index], locations[2 * index + 1]
+
+  def __len__(self):
+    return len(self.ids) + len(self.pending)
+
+  def nbytes(self):
+    """Bytes taken by the arrays, without the nodes still pending"""
+    return (self.ids.buffer_info()[1] * self.ids.itemsize +
+            self.locations.buffer_info()[1] * self.locations.itemsize)
+
+  def close(self):
+    self.ids = self.locations = None
+    self.pending = {}
+
+
+class NodeLocationStore(object):
+  """Node coordinates in a memory mapped file indexed by node id - base, 8 bytes per id
+
+  The file holds the encode_location pair of every id, the zeros of ids never set read as missing. It
+  grows as sparse file, where the file system supports it ids that are never set take no disk space, and
+  the page cache holds it instead of Python objects. It only pays off for ids denser than one in two,
+  GeometryBuilder picks it for them. Ids below base are kept in a SparseLocationStore.
+  path keeps the file for later runs, which have to use the same base, by default an anonymous temporary
+  file is used."""
+
+  def __init__(self, path=None, base=0):
+    if path is None:
+      self.file = tempfile.TemporaryFile()
+    else:
+      self.file = open(path, 'a+b')
+    size = os.fstat(self.file.fileno()).st_size
+    if size == 0:
+      size = LOCATION_GROW_BYTES
+      self.file.truncate(size)
+    self.map = mmap.mmap(self.file.fileno(), size)
+    self.base = base
+    self.below = None
+
+  def set(self, node_id, lat, lon):
+    lat, lon = encode_location(lat, lon)
+    self.set_encoded(node_id, lat, lon)
+
+  def set_encoded(self, node_id, lat, lon):
+    offset = (node_id - self.base) * 8
+    if offset < 0:
+      if self.below is None:
+        self.below = SparseLocationStore()
+      self.below.set(node_id, *decode_location(lat, lon))
+      return
+    if offset + 8 > len(self.map):
+      self.map.resize((offset // LOCATION_GROW_BYTES + 1) * LOCATION_GROW_BYTES)
+    struct.pack_into('<II', self.map, offset, lat, lon)
+
+  def get(self, node_id):
+    """Return the (lat, lon) of node_id, None if it was never set"""
+    offset = (node_id - self.base) * 8
+    if offset < 0:
+      return None if self.below is None else self.below.get(node_id)
+    if offset + 8 > len(self.map):
+      return None
+    lat, lon = struct.unpack_from('<II', self.map, offset)
+    if not lat:
+      return None
+    return decode_location(lat, lon)
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+
+def wkt_linestring(points):
+  return 'LINESTRING (%s)' % ', '.join('%s %s' % (pbf_reader.format_degrees(lon), pbf_reader.format_degrees(lat))
+                                       for lat, lon in points)
+
+
+def wkb_linestring(points):
+  """Hex encoded little endian WKB, as PostGIS and SpatiaLite read it"""
+  coordinates = []
+  for lat, lon in points:
+    coordinates.extend((lon, lat))
+  return binascii.hexlify(struct.pack('<BII%dd' % len(coordinates), 1, 2, len(points), *coordinates))
+
+
+GEOMETRY_FORMATS = {'wkt': wkt_linestring, 'wkb': wkb_linestring}
+
+
+class GeometryBuilder(object):
+  """Record node locations as they stream and resolve the node refs of ways into a line geometry
+
+  The locations start in a SparseLocationStore and move to a NodeLocationStore, with path as its file,
+  once their ids are dense enough (see LOCATION_DENSE_SPAN). Regional extracts hold ids scattered over
+  the whole OSM range and keep the sparse store, the dense one is for planet files and single imports.
+  Refs to nodes missing from the input (the edge of an extract) are left out, ways with less than
+  two located nodes get no geometry."""
+
+  def __init__(self, geometry_format='wkb', path=None):
+    self.encode = GEOMETRY_FORMATS[geometry_format]
+    self.path = path
+    self.locations = SparseLocationStore()
+    self.nodes = 0
+    self.next_check = LOCATION_CHECK_NODES
+
+  def add_node(self, element):
+    self.set_location(int(element.attrib['id']), float(element.attrib['lat']), float(element.attrib['lon']))
+
+  def set_location(self, node_id, lat, lon):
+    self.locations.set(node_id, lat, lon)
+    self.nodes += 1
+    if self.nodes == self.next_check:
+      self.check_density()
+
+  def check_density(self):
+    """Move the locations to a NodeLocationStore if it takes less memory than the sparse store"""
+    self.next_check *= 2
+    sparse = self.locations
+    sparse.merge_pending()
+    if (sparse.ids[-1] - sparse.ids[0] + 1) > LOCATION_DENSE_SPAN * len(sparse):
+      return
+
+    dense = NodeLocationStore(self.path, base=sparse.ids[0])
+    for node_id, lat, lon in sparse.items():
+      dense.set_encoded(node_id, lat, lon)
+    sparse.close()
+    self.locations = dense
+    self.next_check = None
+
+  def way_geometry(self, element):
+    """Return the way_geometry row of a way, None if it cannot be built"""
+    get = self.locations.get
+    points = [point for point in (get(int(ref)) for ref in read_nds(element)) if point is not None]
+    if len(points) < 2:
+      return None
+    return {'id': element.attrib['id'], 'geometry': self.encode(points)}
+
+  def close(self):
+    self.locations.close()
+
+
+# ================================================== #
+#               Instrumentation                      #
+# ================================================== #
+class PipelineStats(object):
+  """Per-stage timers and counters of a run, cheap enough to leave on
+
+  write_elements reads the clock once per stage and element and charges the time in between to the
+  parse, filter (region, node locations and ref checks), shape, validate and write stages. Rows are counted per
+  table, the cleaner counters are taken from their BoundedCache relative to the start of the run.
+  tag_stats=True collects the TagStatistics of the shaped tags, which are written as the tag_stats table;
+  it is off by default, counting every tag and hashing its value slows the tag loop down.
+  progress_every > 0 prints a progress line to stderr at most every progress_every seconds."""
+
+  STAGES = ('parse', 'filter', 'shape', 'validate', 'write')
+  TAG_TABLES = ('node_tags', 'way_tags', 'relation_tags')
+
+  def __init__(self, progress_every=0, cleaners=CLEANERS, tag_stats=False):
+    self.stages = dict.fromkeys(self.STAGES, 0.0)
+    self.elements = {'node': 0, 'way': 0, 'relation': 0}
+    self.rows = dict.fromkeys([table for table, _, _ in OUTPUT_TABLES], 0)
+    self.cleaners = {}
+    self.cleaner_start = {}
+    for cleaner, _ in cleaners.values():
+      self.cleaners[cleaner.name] = cleaner
+      self.cleaner_start[cleaner.name] = (cleaner.hits, cleaner.misses, cleaner.changes)
+    self.merged_cleaners = {}
+    self.workers_peak_rss = None
+    self.integrity = None
+    self.dedup = None
+    self.tag_stats = TagStatistics() if tag_stats else None
+
+    self.progress_every = progress_every
+    self.start = time.time()
+    self.next_progress = self.start + progress_every if progress_every > 0 else float('inf')
+
+  def count(self, element_type, el):
+    self.elements[element_type] += 1
+    rows = self.rows
+    for table, value in el.items():
+      rows[table] += 1 if isinstance(value, dict) else len(value)
+
+  def progress(self, now):
+    elapsed = max(now - self.start, 1e-9)
+    elements = sum(self.elements.values())
+    tags = sum(self.rows[table] for table in self.TAG_TABLES)
+    rss = peak_rss()
+    sys.stderr.write('%d elements, %.0f elements/s, %.0f tags/s%s\n' % (
+      elements, elements / elapsed, tags / elapsed, '' if rss is None else ', peak %.1f MB' % (rss / 1e6)))
+    self.next_progress = now + self.progress_every
+
+  def cleaner_counts(self):
+    """Return {cleaner name: [calls, cache hits, changes]} since the start of the run"""
+    counts = {}
+    for name, cleaner in self.cleaners.items():
+      hits, misses, changes = self.cleaner_start[name]
+      counts[name] = [cleaner.hits - hits + cleaner.misses - misses, cleaner.hits - hits, cleaner.changes - changes]
+    for name, merged in self.merged_cleaners.items():
+      counts[name] = [a + b for a, b in zip(counts.get(name, [0, 0, 0]), merged)]
+    return counts
+
+  def merge(self, summary):
+    """Add the summary() of a worker process, its stage times add up to cpu seconds"""
+    for stage, seconds in summary['stages'].items():
+      self.stages[stage] += seconds
+    for element_type, count in summary['elements'].items():
+      if element_type in self.elements:
+        self.elements[element_type] += count
+    for table, count in summary['rows'].items():
+      self.rows[table] += count
+    for name, counts in summary['cleaners'].items():
+      merged = self.merged_cleaners.get(name, [0, 0, 0])
+      self.merged_cleaners[name] = [merged[0] + counts['calls'], merged[1] + counts['cache_hits'],
+                                    merged[2] + counts['changes']]
+    if summary['peak_rss'] is not None:
+      self.workers_peak_rss = max(self.workers_peak_rss or 0, summary['peak_rss'])
+
+  def summary(self):
+    """Return the counters and rates of the run as a JSON serializable dictionary"""
+    elapsed = max(time.time() - self.start, 1e-9)
+    elements = sum(self.elements.values())
+    tags = sum(self.rows[table] for table in self.TAG_TABLES)
+
+    elements_summary = dict(self.elements)
+    elements_summary['total'] = elements
+    return {
+      'elapsed': elapsed,
+      'elements': elements_summary,
+      'elements_per_sec': elements / elapsed,
+      'tags': tags,
+      'tags_per_sec': tags / elapsed,
+      'rows': dict(self.rows),
+      'stages': dict(self.stages),
+      'cleaners': dict((name, {'calls': calls, 'cache_hits': hits, 'changes': changes})
+                       for name, (calls, hits, changes) in self.cleaner_counts().items()),
+      'peak_rss': peak_rss(),
+      'workers_peak_rss': self.workers_peak_rss,
+      'integrity': None if self.integrity is None else self.integrity.summary(),
+      'dedup': None if self.dedup is None else self.dedup.summary(),
+    }
+
+  def write_json(self, path=STATS_PATH):
+    with open(path, 'w') as stats_file:
+      json.dump(self.summary(), stats_file, indent=2, sort_keys=True)
+
+
+# ================================================== #
+#               Output Sinks                         #
+# ================================================== #
+def encode_row(values):
+  """Encode the unicode values of a row to utf-8 for the csv module, which only writes byte strings"""
+  return tuple([v.encode('utf-8') if isinstance(v, unicode) else v for v in values])
+
+
+class CsvSink(object):
+  """Write shaped elements to the csv(s) of OUTPUT_TABLES, suffix is appended to each path
+
+  Rows are kept as tuples in the field order of their table and buffered per table, every
+  CSV_BATCH_SIZE rows the buffers go out in one writerows call per file, through CSV_BUFFER_SIZE
+  file buffers. write_rows() takes such tuples directly.
+  checkpoint() returns the size of every file, resume=those sizes reopens the files cut back to them."""
+
+  def __init__(self, suffix='', header=True, resume=None):
+    self.files = {}
+    self.writers = {}
+    self.getters = {}
+    self.buffers = {}
+
+    for table, path, fields in OUTPUT_TABLES:
+      if resume is None:
+        table_file = open(path + suffix, 'wb', CSV_BUFFER_SIZE)
+      else:
+        # rows written after the checkpoint are dropped, they are shaped again
+        table_file = open(path + suffix, 'r+b', CSV_BUFFER_SIZE)
+        table_file.truncate(resume[table])
+        table_file.seek(resume[table])
+      self.files[table] = table_file
+      self.writers[table] = csv.writer(table_file)
+      self.getters[table] = itemgetter(*fields)
+      self.buffers[table] = []
+      if header and resume is None:
+        self.writers[table].writerow(fields)
+    self.pending = 0
+
+  def write(self, el):
+    for table, rows in el.items():
+      getter = self.getters[table]
+      if isinstance(rows, dict):
+        self.buffers[table].append(encode_row(getter(rows)))
+        self.pending += 1
+      else:
+        self.buffers[table].extend([encode_row(getter(row)) for row in rows])
+        self.pending += len(rows)
+
+    if self.pending >= CSV_BATCH_SIZE:
+      self.flush()
+
+  def write_rows(self, table, rows):
+    """Buffer rows given as tuples in the field order of table"""
+    self.buffers[table].extend([encode_row(row) for row in rows])
+    self.pending += len(rows)
+    if self.pending >= CSV_BATCH_SIZE:
+      self.flush()
+
+  def flush(self):
+    for table, rows in self.buffers.items():
+      if rows:
+        self.writers[table].writerows(rows)
+        del rows[:]
+    self.pending = 0
+
+  def checkpoint(self, marker):
+    """Write everything buffered to disk and return {table: file size}"""
+    self.flush()
+    sizes = {}
+    for table, table_file in self.files.items():
+      table_file.flush()
+      os.fsync(table_file.fileno())
+      sizes[table] = table_file.tell()
+    return sizes
+
+  @staticmethod
+  def recover(state):
+    return state
+
+  def close(self):
+    self.flush()
+    for table_file in self.files.values():
+      table_file.close()
+
+
+class SqliteSink(object):
+  """Bulk load shaped elements into a fresh SQLite database at db_path
+
+  Rows are buffered per table and inserted with executemany, committing every SQLITE_BATCH_SIZE rows.
+  The load runs with WAL and synchronous=OFF, and the indexes are only built by close(), which also puts the
+  database back in its former journal mode, so no -wal file ships with it. With append=True the existing
+  database is kept and upsert()/delete() apply changes to it in place.
+  spatial_index=True also builds the nodes_rtree index of SQL_SPATIAL_INDEX, which upsert()/delete()
+  keep up to date in databases that have it.
+  Once checkpoint() was called rows are only committed by the next checkpoint, together with its marker,
+  resume reopens the database as it was committed by the last one."""
+
+  def __init__(self, db_path=SQLITE_PATH, append=False, spatial_index=False, resume=None):
+    if os.path.exists(db_path) and not append and resume is None:
+      os.remove(db_path)
+
+    self.conn = sqlite3.connect(db_path)
+    # the journal mode persists in the database file, a fresh one gets the default DELETE back
+    self.journal_mode = self.conn.execute('PRAGMA journal_mode').fetchone()[0] if append else 'delete'
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute('PRAGMA synchronous=OFF')
+    if not append and resume is None:
+      self.conn.executescript(SQL_SCHEMA)
+    elif append:
+      spatial_index = self.conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+    self.append = append
+    self.spatial_index = spatial_index
+    self.commit_batches = resume is None
+    self.db_path = db_path
+
+    self.inserts = {}
+    self.fields = {}
+    self.buffers = {}
+    for table, _, fields in OUTPUT_TABLES:
+      self.inserts[table] = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        SQL_TABLES[table], ', '.join(fields), ', '.join('?' * len(fields)))
+      self.fields[table] = fields
+      self.buffers[table] = []
+    self.pending = 0
+
+  def write(self, el):
+    for table, rows in el.items():
+      fields = self.fields[table]
+      if isinstance(rows, dict):
+        rows = [rows]
+      self.buffers[table].extend([tuple(row[field] for field in fields) for row in rows])
+      self.pending += len(rows)
+
+    if self.pending >= SQLITE_BATCH_SIZE:
+      self.flush()
+
+  def load_csv(self, table, path):
+    """Load a header-less csv part written by CsvSink into table"""
+    with open(path, 'rb') as part:
+      for row in csv.reader(part):
+        self.buffers[table].append(tuple(value.decode('utf-8') for value in row))
+        self.pending += 1
+        if self.pending >= SQLITE_BATCH_SIZE:
+          self.flush()
+
+  def insert_buffered(self):
+    for table, rows in self.buffers.items():
+      if rows:
+        self.conn.executemany(self.inserts[table], rows)
+        del rows[:]
+
+  def flush(self):
+    self.insert_buffered()
+    if self.commit_batches:
+      self.conn.commit()
+    self.pending = 0
+
+  def checkpoint(self, marker):
+    """Commit the rows written so far in one transaction with marker, the whole checkpoint but the sink
+    state, see recover()"""
+    self.insert_buffered()
+    self.conn.execute('CREATE TABLE IF NOT EXISTS checkpoint (marker TEXT NOT NULL)')
+    self.conn.execute('DELETE FROM checkpoint')
+    self.conn.execute('INSERT INTO checkpoint VALUES (?)', (json.dumps(marker),))
+    self.conn.commit()
+    self.pending = 0
+    self.commit_batches = False
+    return {}
+
+  @staticmethod
+  def recover(state, db_path=SQLITE_PATH):
+    """Return the checkpoint marker committed to the database, the state saved after it can lag behind"""
+    conn = sqlite3.connect(db_path)
+    try:
+      row = conn.execute("SELECT marker FROM checkpoint").fetchone()
+    except sqlite3.OperationalError:
+      row = None
+    finally:
+      conn.close()
+    if row is None:
+      return state
+    return dict(json.loads(row[0]), sink={})
+
+  def upsert(self, el):
+    """Replace the element of a shaped el, together with its tag and way node rows"""
+    for table, rows in el.items():
+      if isinstance(rows, dict):
+        self.delete(table, rows['id'])
+    self.write(el)
+
+    if self.spatial_index and 'node' in el:
+      node = el['node']
+      self.conn.execute('INSERT INTO nodes_rtree VALUES (?, ?, ?, ?, ?)',
+                        (node['id'], node['lat'], node['lat'], node['lon'], node['lon']))
+
+  def delete(self, element_type, element_id):
+    """Delete a node, way or relation and the rows of its child tables"""
+    # rows still buffered may belong to the element, so they have to reach the database first
+    self.insert_buffered()
+    for table in ELEMENT_TABLES[element_type]:
+      self.conn.execute('DELETE FROM %s WHERE id = ?' % SQL_TABLES[table], (element_id,))
+    if self.spatial_index and element_type == 'node':
+      self.conn.execute('DELETE FROM nodes_rtree WHERE id = ?', (element_id,))
+    self.pending += 1
+
+  def close(self):
+    self.insert_buffered()
+    self.conn.execute('DROP TABLE IF EXISTS checkpoint')
+    self.conn.commit()
+    if not self.append:
+      self.conn.executescript(SQL_INDEXES)
+      if self.spatial_index:
+        self.conn.executescript(SQL_SPATIAL_INDEX)
+    self.conn.execute('PRAGMA journal_mode=%s' % self.journal_mode)
+    self.conn.close()
+
+
+class ColumnarSink(object):
+  """Write shaped elements to typed column files, named like the csv(s) with COLUMNAR_EXTENSION
+
+  ids and counters are stored as integers, coordinates as floats and the user names, tag keys and
+  types dictionary encoded, in zlib compressed chunks which columnar.ColumnReader memory maps.
+  checkpoint() returns the written chunks of every file, resume=them reopens the files after them."""
+
+  def __init__(self, suffix='', resume=None):
+    self.writers = {}
+    self.getters = {}
+    for table, path, fields in OUTPUT_TABLES:
+      types = [COLUMN_TYPES[table].get(field, 'string') for field in fields]
+      column_path = os.path.splitext(path)[0] + COLUMNAR_EXTENSION + suffix
+      self.writers[table] = columnar.ColumnWriter(column_path, fields, types,
+                                                  resume=None if resume is None else resume[table])
+      self.getters[table] = itemgetter(*fields)
+
+  def write(self, el):
+    for table, rows in el.items():
+      getter = self.getters[table]
+      if isinstance(rows, dict):
+        self.writers[table].append(getter(rows))
+      else:
+        self.writers[table].extend([getter(row) for row in rows])
+
+  def load_csv(self, table, path):
+    """Load a header-less csv part written by CsvSink into table"""
+    with open(path, 'rb') as part:
+      for row in csv.reader(part):
+        self.writers[table].append(row)
+
+  def checkpoint(self, marker):
+    return dict((table, writer.checkpoint()) for table, writer in self.writers.items())
+
+  @staticmethod
+  def recover(state):
+    return state
+
+  def close(self):
+    for writer in self.writers.values():
+      writer.close()
+
+
+SINKS = {'csv': CsvSink, 'sqlite': SqliteSink, 'columnar': ColumnarSink}
+
+
+def read_run(run):
+  """Yield the records marshalled to a run file of DedupSink"""
+  while True:
+    try:
+      yield marshal.load(run)
+    except EOFError:
+      return
+
+
+class DedupSink(object):
+  """Keep only the latest version of every element written through it to sink, with mode='history' also
+  the validity of every version in the element_history table
+
+  Elements are sorted by type, id and version in runs of DEDUP_RUN_SIZE, spilled to temporary files (see
+  TMPDIR) and merged, DEDUP_MERGE_FANIN runs at a time, so memory stays bounded whatever the number of
+  elements and versions. merge() writes the latest versions to sink in node, way and relation order, by
+  id, and counts them, and their tags if stats collects tag statistics, into stats instead of the versions
+  read; elements written after it
+  go straight to sink.
+  A version is valid from its timestamp to the timestamp of the next one, the latest has no valid_to.
+  Deleted versions (visible="false" in history dumps) are handed to write_deleted(): they end the
+  validity of the version before them, and an element whose latest version is deleted is not written."""
+
+  ORDER = ('node', 'way', 'relation')
+
+  def __init__(self, sink, mode='latest', stats=None):
+    if mode not in DEDUP_MODES:
+      raise ValueError("unknown dedup mode '%s', use one of %s" % (mode, ', '.join(DEDUP_MODES)))
+    self.sink = sink
+    self.history = mode == 'history'
+    self.stats = stats
+    self.tag_stats = stats is not None and stats.tag_stats is not None
+    self.records = []
+    self.runs = []
+    self.versions = 0
+    self.elements = 0
+    self.deleted = 0
+    self.merged = False
+
+  def write(self, el):
+    if self.merged:
+      self.sink.write(el)
+      return
+
+    for rank, element_type in enumerate(self.ORDER):
+      if element_type in el:
+        break
+    self.add(rank, el)
+
+  def write_deleted(self, element):
+    """Record a deleted version, which has only the id and metadata of the element"""
+    attrib = element.attrib
+    row = {'id': attrib['id'], 'version': attrib['version'], 'visible': 'false'}
+    for field in ('changeset', 'user', 'uid', 'timestamp'):
+      row[field] = attrib.get(field, '')
+    self.add(self.ORDER.index(element.tag), {element.tag: row})
+
+  def add(self, rank, el):
+    row = el[self.ORDER[rank]]
+    # the position in the input breaks ties between equal versions, the one read last wins
+    self.records.append((rank, int(row['id']), int(row['version']), self.versions, el))
+    self.versions += 1
+    if len(self.records) >= DEDUP_RUN_SIZE:
+      self.runs.append(self.spill(sorted(self.records)))
+      self.records = []
+
+  @staticmethod
+  def spill(records):
+    """Write sorted records to a run file, return it rewound"""
+    run = tempfile.TemporaryFile()
+    for record in records:
+      marshal.dump(record, run)
+    run.seek(0)
+    return run
+
+  def sorted_records(self):
+    if not self.runs:
+      return iter(sorted(self.records))
+
+    if self.records:
+      self.runs.append(self.spill(sorted(self.records)))
+      self.records = []
+    while len(self.runs) > DEDUP_MERGE_FANIN:
+      runs, self.runs = self.runs[:DEDUP_MERGE_FANIN], self.runs[DEDUP_MERGE_FANIN:]
+      self.runs.append(self.spill(heapq.merge(*[read_run(run) for run in runs])))
+      for run in runs:
+        run.close()
+    return heapq.merge(*[read_run(run) for run in self.runs])
+
+  def merge(self):
+    """Write the latest version of every element, and the history of all versions, to sink"""
+    tag_stats = None
+    if self.stats is not None:
+      if self.tag_stats:
+        tag_stats = self.stats.tag_stats = TagStatistics()
+      self.stats.elements = dict.fromkeys(self.stats.elements, 0)
+      self.stats.rows = dict.fromkeys(self.stats.rows, 0)
+
+    previous = None
+    for record in self.sorted_records():
+      if previous is not None:
+        latest = previous[:2] != record[:2]
+        self.emit(previous, None if latest else record, tag_stats)
+      previous = record
+    if previous is not None:
+      self.emit(previous, None, tag_stats)
+
+    for run in self.runs:
+      run.close()
+    self.runs = []
+    self.merged = True
+
+  def emit(self, record, following, tag_stats):
+    """Write the version of record, following is the next version of the same element if there is one"""
+    rank, _, _, _, el = record
+    element_type = self.ORDER[rank]
+    row = el[element_type]
+    if row.get('visible') == 'false':
+      # the element does not exist from here on, the version before it already ends at its timestamp
+      if following is None:
+        self.deleted += 1
+      return
+
+    if self.history:
+      valid_to = '' if following is None else following[4][element_type]['timestamp']
+      self.sink.write({'element_history': {
+        'element_type': element_type, 'id': row['id'], 'version': row['version'], 'changeset': row['changeset'],
+        'user': row['user'], 'uid': row['uid'], 'valid_from': row['timestamp'], 'valid_to': valid_to}})
+      if self.stats is not None:
+        self.stats.rows['element_history'] += 1
+
+    if following is None:
+      self.elements += 1
+      self.sink.write(el)
+      if self.stats is not None:
+        self.stats.count(element_type, el)
+        if tag_stats is not None:
+          tag_stats.add_rows(element_type, el[element_type + '_tags'])
+
+  def summary(self):
+    return {'versions': self.versions, 'elements': self.elements, 'deleted': self.deleted,
+            'dropped': self.versions - self.elements}
+
+  def close(self):
+    if not self.merged:
+      self.merge()
+    self.sink.close()
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-  """Iteratively process each XML element and write to csv(s)"""
-
-  with codecs.open(NODES_PATH, 'w') as nodes_file, \
-       codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-       codecs.open(WAYS_PATH, 'w') as ways_file, \
-       codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-       codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-      nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-      node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-      ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-      way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-      way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-      nodes_writer.writeheader()
-      node_tags_writer.writeheader()
-      ways_writer.writeheader()
-      way_nodes_writer.writeheader()
-      way_tags_writer.writeheader()
-
-      validator = cerberus.Validator()
-
-      for element in get_element(file_in, tags=('node', 'way')):
-        el = shape_element(element)
-        
-        if el:
-          
-          if validate is True:
-            validate_element(el, validator)
-
-          if element.tag == 'node':
-            nodes_writer.writerow(el['node'])
-            node_tags_writer.writerows(el['node_tags'])
-          
-          elif element.tag == 'way':
-            ways_writer.writerow(el['way'])
-            way_nodes_writer.writerows(el['way_nodes'])
-            way_tags_writer.writerows(el['way_tags'])
+def write_elements(source, validate, sink, backend=None, sample=None, seed=None, workers=1, region=None,
+                   geometry=None, integrity=None, stats=None):
+  """Shape every node, way and relation of source, validate them if asked and hand them to sink
+
+  With a BBox or Polygon region only the elements a RegionFilter keeps are shaped. geometry ('wkb' or
+  'wkt') adds the line of every way to the way_geometry table, from the locations of all nodes read.
+  integrity ('report' or 'drop') checks way and relation refs against the elements written, see ReferenceCheck.
+  Deleted versions of history dumps are skipped, or recorded by a DedupSink.
+  The time of every stage and the counts are added to stats, a PipelineStats."""
+
+  validator = CompiledValidator(sample=sample, seed=seed) if validate is True else None
+  region_filter = RegionFilter(region) if region is not None else None
+  builder = GeometryBuilder(geometry) if geometry is not None else None
+  if stats is None:
+    stats = PipelineStats()
+  ref_check = None
+  if integrity is not None:
+    ref_check = stats.integrity = ReferenceCheck(integrity)
+  stages = stats.stages
+  clock = time.time
+
+  try:
+    started = clock()
+    for element in get_element(source, tags=('node', 'way', 'relation'), backend=backend, workers=workers):
+      parsed = clock()
+      stages['parse'] += parsed - started
+
+      if element.attrib.get('visible') == 'false':
+        # a deleted version has no location or tags, only the deduplication keeps track of it
+        if hasattr(sink, 'write_deleted'):
+          sink.write_deleted(element)
+        started = clock()
+        stages['filter'] += started - parsed
+        continue
+
+      # nodes outside the region are still located, the ways kept at its edge get their whole line
+      if builder is not None and element.tag == 'node':
+        builder.add_node(element)
+
+      if region_filter is not None and not region_filter.keep(element):
+        started = clock()
+        stages['filter'] += started - parsed
+        continue
+
+      if ref_check is not None and element.tag != 'node' and not ref_check.keep(element):
+        started = clock()
+        stages['filter'] += started - parsed
+        continue
+
+      filtered = clock()
+      stages['filter'] += filtered - parsed
+
+      el = shape_element(element, tag_stats=stats.tag_stats)
+
+      if el:
+
+        if builder is not None and element.tag == 'way':
+          row = builder.way_geometry(element)
+          if row is not None:
+            el['way_geometry'] = row
+
+        shaped = clock()
+        stages['shape'] += shaped - filtered
+
+        if validate is True:
+          validator.validate(el)
+
+        validated = clock()
+        stages['validate'] += validated - shaped
+
+        sink.write(el)
+        stats.count(element.tag, el)
+        if region_filter is not None:
+          region_filter.add(element)
+        if ref_check is not None:
+          ref_check.add(element)
+
+        started = clock()
+        stages['write'] += started - validated
+        if started >= stats.next_progress:
+          stats.progress(started)
+      else:
+        started = clock()
+        stages['shape'] += started - filtered
+  finally:
+    if builder is not None:
+      builder.close()
+
+  return stats
+
+
+def write_tag_stats(sink, stats):
+  """Write the tag_stats rows of the elements counted into stats, once all of them are written, if it
+  collects tag statistics"""
+  if stats.tag_stats is None:
+    return
+  rows = stats.tag_stats.rows()
+  sink.write({'tag_stats': rows})
+  stats.rows['tag_stats'] += len(rows)
+
+
+def process_shard(args):
+  """Worker: shape one byte range of the OSM file into csv parts without headers"""
+  file_in, start, end, index, validate, backend, sample, tag_stats = args
+  suffix = '.part%04d' % index
+
+  reader = ShardReader(file_in, start, end)
+  sink = CsvSink(suffix=suffix, header=False)
+  stats = PipelineStats(tag_stats=tag_stats)
+  try:
+    write_elements(reader, validate, sink, backend, sample, seed=index, stats=stats)
+  finally:
+    sink.close()
+    reader.close()
+
+  return suffix, stats.summary(), stats.tag_stats.state() if tag_stats else None
+
+
+def process_map_parallel(file_in, validate, workers, backend=None, output='csv', sample=None, sink_options={},
+                         stats=None):
+  """Shape the shards of file_in in worker processes and combine their csv parts in file order
+
+  The stats of every shard are merged into stats, combining the parts is charged to its write stage. The
+  tag statistics of the shards, if stats collects them, are merged and written as one more part."""
+  ranges = shard_ranges(file_in, workers * SHARDS_PER_WORKER)
+  tag_stats = stats is not None and stats.tag_stats is not None
+  jobs = [(file_in, start, end, index, validate, backend, sample, tag_stats)
+          for index, (start, end) in enumerate(ranges)]
+  if stats is None:
+    stats = PipelineStats()
+
+  pool = multiprocessing.Pool(workers)
+  try:
+    suffixes = []
+    for suffix, summary, tag_state in pool.imap(process_shard, jobs):
+      suffixes.append(suffix)
+      stats.merge(summary)
+      if tag_state is not None:
+        stats.tag_stats.merge(tag_state)
+      if time.time() >= stats.next_progress:
+        stats.progress(time.time())
+  finally:
+    pool.close()
+    pool.join()
+
+  started = time.time()
+  try:
+    if tag_stats:
+      sink = CsvSink(suffix='.tag_stats', header=False)
+      try:
+        write_tag_stats(sink, stats)
+      finally:
+        sink.close()
+      suffixes.append('.tag_stats')
+    combine_parts(suffixes, output, sink_options)
+  finally:
+    stats.stages['write'] += time.time() - started
+  return stats
+
+
+def combine_parts(suffixes, output='csv', sink_options={}):
+  """Write the csv parts of the shards, in order, to the csv(s) or load them into the output sink"""
+  if output != 'csv':
+    sink = SINKS[output](**sink_options)
+    try:
+      for table, path, _ in OUTPUT_TABLES:
+        for suffix in suffixes:
+          sink.load_csv(table, path + suffix)
+          os.remove(path + suffix)
+    finally:
+      sink.close()
+    return
+
+  for _, path, fields in OUTPUT_TABLES:
+    with open(path, 'wb', CSV_BUFFER_SIZE) as table_file:
+      csv.writer(table_file).writerow(fields)
+
+      for suffix in suffixes:
+        with open(path + suffix, 'rb') as part:
+          shutil.copyfileobj(part, table_file)
+        os.remove(path + suffix)
+
+
+def save_checkpoint(path, state):
+  """Replace the checkpoint at path by state, a crash leaves either the old or the new one"""
+  with open(path + '.tmp', 'w') as checkpoint_file:
+    json.dump(state, checkpoint_file)
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+  os.rename(path + '.tmp', path)
+
+
+def process_map_checkpointed(file_in, validate, backend=None, output='csv', sample=None, sink_options={},
+                             stats=None, resume=False, checkpoint_path=CHECKPOINT_PATH):
+  """Shape file_in one segment of about CHECKPOINT_BYTES at a time and checkpoint after every segment
+
+  Segments start at top level elements like the shards of a parallel run. After each one the sink makes
+  its output durable and the end offset of the segment is saved to checkpoint_path with the state the
+  sink needs to continue from there and the tag statistics so far. resume=True picks up at the offset of
+  the last checkpoint, dropping what was written past it, or starts over if there is none. The checkpoint is removed
+  once the run completes."""
+  size = os.path.getsize(file_in)
+  if stats is None:
+    stats = PipelineStats()
+  marker = {'input': os.path.abspath(file_in), 'size': size, 'output': output, 'offset': None}
+
+  state = None
+  if resume and os.path.exists(checkpoint_path):
+    with open(checkpoint_path) as checkpoint_file:
+      state = SINKS[output].recover(json.load(checkpoint_file))
+    if any(state[key] != marker[key] for key in ('input', 'size', 'output')):
+      raise ValueError('%s was saved by a run on another input or output, remove it to start over' %
+                       checkpoint_path)
+    if (state['tag_stats'] is not None) != (stats.tag_stats is not None):
+      raise ValueError('%s was saved by a run %s tag statistics, resume it with the same option' %
+                       (checkpoint_path, 'with' if state['tag_stats'] is not None else 'without'))
+
+  ranges = shard_ranges(file_in, max(1, -(-size // CHECKPOINT_BYTES)))
+  if state is not None:
+    # the saved offset is an element boundary, cut there so a changed CHECKPOINT_BYTES loses nothing
+    ranges = [(max(start, state['offset']), end) for start, end in ranges if end > state['offset']]
+
+  sink = SINKS[output](resume=None if state is None else state['sink'], **sink_options)
+  if state is not None and stats.tag_stats is not None:
+    stats.tag_stats.merge(state['tag_stats'])
+  # without a finally: after an error the sink is left unclosed, so nothing past the checkpoint is kept
+  for start, end in ranges:
+    reader = ShardReader(file_in, start, end)
+    try:
+      write_elements(reader, validate, sink, backend, sample, stats=stats)
+    finally:
+      reader.close()
+
+    started = time.time()
+    marker['offset'] = end
+    # the sqlite sink commits the marker with its rows, so it carries all the state a resume needs
+    marker['tag_stats'] = stats.tag_stats.state() if stats.tag_stats is not None else None
+    save_checkpoint(checkpoint_path, dict(marker, sink=sink.checkpoint(marker)))
+    stats.stages['write'] += time.time() - started
+
+  started = time.time()
+  write_tag_stats(sink, stats)
+  sink.close()
+  stats.stages['write'] += time.time() - started
+  os.remove(checkpoint_path)
+  return stats
+
+
+def apply_changes(osc_file, validate, db_path=SQLITE_PATH, backend=None, sample=None, stats=None):
+  """Apply the create/modify/delete blocks of an OsmChange file to a database written by SqliteSink
+
+  Created and modified elements are shaped and validated like in a full run and replace any earlier
+  version of themselves, deleted ones are removed with all of their tag and way node rows. Way geometries
+  need every node location and are not rebuilt, a changed way loses its way_geometry row. tag_stats is
+  left as the full run wrote it."""
+  sink = SqliteSink(db_path, append=True)
+  validator = CompiledValidator(sample=sample) if validate is True else None
+  if stats is None:
+    stats = PipelineStats()
+
+  try:
+    for action, element in get_changes(osc_file, backend=backend):
+      if action == 'delete':
+        sink.delete(element.tag, element.attrib['id'])
+        continue
+
+      el = shape_element(element)
+      if el:
+        if validate is True:
+          validator.validate(el)
+        sink.upsert(el)
+        stats.count(element.tag, el)
+  finally:
+    sink.close()
+
+  return stats
+
+
+def process_map(file_in, validate, workers=1, backend=None, output='csv', sample=None, incremental=False,
+                region=None, spatial_index=False, geometry=None, integrity=None, dedup=None, progress_every=0,
+                checkpoint=False, resume=False, tag_stats=False):
+  """Iteratively process each XML element and write to csv(s) or another output of SINKS, return the
+  PipelineStats of the run; each option is described by the helper it enables"""
+
+  stats = PipelineStats(progress_every, tag_stats=tag_stats)
+  sink_options = {}
+  if spatial_index:
+    if output != 'sqlite':
+      raise ValueError("the spatial index is built in the sqlite output, not in '%s'" % output)
+    sink_options['spatial_index'] = True
+
+  if incremental:
+    if output != 'sqlite':
+      raise ValueError("incremental updates are applied to the sqlite output, not to '%s'" % output)
+    if dedup is not None:
+      raise ValueError('incremental updates replace the elements they change, they have no duplicates to remove')
+    return apply_changes(file_in, validate, backend=backend, sample=sample, stats=stats)
+
+  if checkpoint or resume:
+    if workers > 1 or is_pbf(file_in) or is_compressed(file_in):
+      raise ValueError('checkpoints seek into the input, they need uncompressed XML read by a single process')
+    if region is not None or geometry is not None or integrity is not None or dedup is not None:
+      raise ValueError('region extracts, geometries, ref checks and deduplication keep state over the whole file, '
+                       'run them without checkpoints')
+    return process_map_checkpointed(file_in, validate, backend, output, sample, sink_options, stats, resume)
+
+  if workers > 1 and not is_pbf(file_in):
+    if is_compressed(file_in):
+      raise ValueError('parallel runs seek into the input, decompress %s first' % file_in)
+    if region is not None or geometry is not None or integrity is not None or dedup is not None:
+      raise ValueError('ways need the nodes seen before them, region extracts, geometries, ref checks and '
+                       'deduplication run in a single process')
+    return process_map_parallel(file_in, validate, workers, backend, output, sample, sink_options, stats)
+
+  sink = SINKS[output](**sink_options)
+  if dedup is not None:
+    # the tags are counted once the latest versions are known
+    sink = stats.dedup = DedupSink(sink, dedup, stats)
+    stats.tag_stats = None
+  try:
+    write_elements(file_in, validate, sink, backend, sample, workers=workers, region=region, geometry=geometry,
+                   integrity=integrity, stats=stats)
+    started = time.time()
+    if dedup is not None:
+      sink.merge()
+    write_tag_stats(sink, stats)
+    stats.stages['write'] += time.time() - started
+  finally:
+    # the sink flushes its last rows and builds its indexes here
+    started = time.time()
+    sink.close()
+    stats.stages['write'] += time.time() - started
+
+  return stats
 
 
 if __name__ == '__main__':
-  # Note: Validation is ~ 10X slower. For the project consider using a small
-  # sample of the map when validating.
-  process_map(OSM_PATH, validate=True)
+  # Note: validation runs on the schema compiled into plain per-field checks, pass sample=N to only check
+  # every Nth element of a large map.
+  parser = argparse.ArgumentParser(description='Clean an OSM extract into csv(s), a database or column files')
+  parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+  parser.add_argument('--output', choices=sorted(SINKS), default='csv')
+  parser.add_argument('--checkpoint', action='store_true',
+                      help='save the progress to %s so an interrupted run can be resumed' % CHECKPOINT_PATH)
+  parser.add_argument('--resume', action='store_true', help='continue the checkpointed run that was interrupted')
+  parser.add_argument('--integrity', choices=INTEGRITY_MODES,
+                      help='check that ways only reference written nodes, report or drop those that do not')
+  parser.add_argument('--dedup', choices=DEDUP_MODES,
+                      help='keep only the latest version of every element, history also records every version')
+  parser.add_argument('--workers', type=int, default=1, help='shape the map in this many processes')
+  region = parser.add_mutually_exclusive_group()
+  region.add_argument('--bbox', type=parse_bbox, metavar='MIN_LAT,MIN_LON,MAX_LAT,MAX_LON',
+                      help='only keep the elements inside this box, see RegionFilter')
+  region.add_argument('--polygon', type=read_polygon, metavar='FILE',
+                      help='only keep the elements inside the polygon of the lat,lon lines of FILE')
+  parser.add_argument('--spatial-index', action='store_true',
+                      help='add an R*Tree of the node locations and way extents to the sqlite output')
+  parser.add_argument('--geometry', choices=sorted(GEOMETRY_FORMATS),
+                      help='write the line of every way to the way_geometry table')
+  parser.add_argument('--tag-stats', action='store_true',
+                      help='count the tags and distinct values of every key into the tag_stats table')
+  parser.add_argument('--rules', default=RULES_PATH, help='cleaning rules file, see compile_rule')
+  args = parser.parse_args()
+
+  if args.rules != RULES_PATH:
+    register_rules(load_rules(args.rules))
+
+  stats = process_map(args.osm_file, validate=True, workers=args.workers, output=args.output,
+                      region=args.bbox or args.polygon, spatial_index=args.spatial_index, geometry=args.geometry,
+                      integrity=args.integrity, dedup=args.dedup, progress_every=PROGRESS_EVERY,
+                      checkpoint=args.checkpoint, resume=args.resume, tag_stats=args.tag_stats)
+  stats.write_json(STATS_PATH)
+
+  if stats.integrity is not None:
+    print('%(dangling_ways)d of %(ways)d ways reference %(dangling_refs)d nodes that were not written, '
+          '%(dropped_ways)d dropped' % stats.integrity.summary())
+    print('%(dangling_relations)d of %(relations)d relations have %(dangling_members)d node or way members '
+          'that were not written' % stats.integrity.summary())
+
+  for name, (hits, misses) in sorted(cleaner_stats().items()):
+    print('%s: %d values, %.1f%% cache hits' % (name, hits + misses, 100.0 * hits / max(1, hits + misses)))
+
+  rss = peak_rss()
+  if rss is not None:
+    print('peak memory: %.1f MB' % (rss / 1e6))
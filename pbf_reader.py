@@ -0,0 +1,411 @@
+"""
+Pure python reader for OpenStreetMap PBF files (.osm.pbf).
+
+A PBF file is a sequence of blobs, each a zlib compressed protocol buffer message holding a block of
+nodes, ways and relations. The blobs are decoded here without the protobuf library into the same
+(tag, attrib, tags, nds, members) tuples the expat backend of data_cleaning_extraction builds from XML, so
+shape_element handles them unchanged:
+
+- tag is "node", "way" or "relation"
+- attrib holds the id, user, uid, version, changeset and timestamp (and lat/lon for nodes) as strings,
+  metadata missing from the file is filled from METADATA_DEFAULTS, deleted versions of history files
+  have visible="false"
+- tags is the list of (k, v) pairs and nds the list of node refs of a way
+- members is the list of (type, ref, role) of a relation
+
+Decoding is independent for every blob, so iter_pbf can spread it over worker processes.
+
+The format is described at https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+
+import collections
+import multiprocessing
+import struct
+import time
+import zlib
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+# features a file may require which this reader understands
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+
+# Relation.MemberType enum values
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+# blobs decoded ahead of the consumer per worker process
+BLOBS_PER_WORKER = 2
+
+# metadata of elements the file does not carry, public extracts often leave out the user, uid and changeset
+METADATA_DEFAULTS = {'version': '0', 'timestamp': '', 'changeset': '0', 'uid': '0', 'user': ''}
+
+
+# ================================================== #
+#               Protocol Buffer Decoding             #
+# ================================================== #
+def read_varint(buf, pos):
+  """Decode the varint starting at buf[pos], return it with the position after it"""
+  result = 0
+  shift = 0
+  while True:
+    byte = buf[pos]
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+
+
+def zigzag(value):
+  """Decode a zigzag encoded sint32/sint64"""
+  return (value >> 1) ^ -(value & 1)
+
+
+def signed(value):
+  """Reinterpret a varint decoded int32/int64 as signed, negative values are sent as 64 bit two's complement"""
+  return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def iter_fields(buf):
+  """Yield (field number, value) for the fields of a message held in a bytearray
+
+  varints are yielded as ints and length delimited fields as bytearray slices, fixed width fields are
+  not used by the OSM messages and are skipped."""
+  pos = 0
+  end = len(buf)
+
+  while pos < end:
+    key, pos = read_varint(buf, pos)
+    number = key >> 3
+    wire_type = key & 7
+
+    if wire_type == 0:
+      value, pos = read_varint(buf, pos)
+    elif wire_type == 2:
+      size, pos = read_varint(buf, pos)
+      value = buf[pos:pos + size]
+      pos += size
+    elif wire_type == 1:
+      pos += 8
+      continue
+    elif wire_type == 5:
+      pos += 4
+      continue
+    else:
+      raise ValueError('unsupported protocol buffer wire type %d' % wire_type)
+
+    yield number, value
+
+
+def unpack_varints(buf):
+  """Decode a packed repeated varint field"""
+  values = []
+  pos = 0
+  end = len(buf)
+  while pos < end:
+    value, pos = read_varint(buf, pos)
+    values.append(value)
+  return values
+
+
+def unpack_deltas(buf):
+  """Decode a packed repeated sint64 field whose values are delta coded"""
+  values = []
+  last = 0
+  for value in unpack_varints(buf):
+    last += zigzag(value)
+    values.append(last)
+  return values
+
+
+# ================================================== #
+#               Blobs                                #
+# ================================================== #
+def read_exactly(source, size):
+  """Read size bytes from source, which may return less per read"""
+  chunks = []
+  while size > 0:
+    chunk = source.read(size)
+    if not chunk:
+      raise IOError('truncated PBF file')
+    chunks.append(chunk)
+    size -= len(chunk)
+  return b''.join(chunks)
+
+
+def iter_blobs(source):
+  """Yield (blob type, blob message) for every blob of a PBF file object"""
+  while True:
+    length = source.read(4)
+    if not length:
+      return
+    if len(length) < 4:
+      length += read_exactly(source, 4 - len(length))
+
+    header = bytearray(read_exactly(source, struct.unpack('>I', length)[0]))
+    blob_type = None
+    data_size = 0
+    for number, value in iter_fields(header):
+      if number == 1:
+        blob_type = bytes(value).decode('utf-8')
+      elif number == 3:
+        data_size = value
+
+    yield blob_type, read_exactly(source, data_size)
+
+
+def inflate(blob):
+  """Return the uncompressed content of a Blob message as a bytearray"""
+  for number, value in iter_fields(bytearray(blob)):
+    if number == 1:
+      return value
+    elif number == 3:
+      return bytearray(zlib.decompress(bytes(value)))
+    elif number == 4:
+      if lzma is None:
+        raise ValueError('the PBF file uses lzma compression, which needs the python lzma module')
+      return bytearray(lzma.decompress(bytes(value)))
+
+  raise ValueError('unsupported PBF blob compression')
+
+
+def check_header(block):
+  """Raise ValueError if a HeaderBlock requires features this reader does not understand"""
+  required = set(bytes(value).decode('utf-8') for number, value in iter_fields(block) if number == 4)
+  missing = required - SUPPORTED_FEATURES
+  if missing:
+    raise ValueError('unsupported PBF features: %s' % ', '.join(sorted(missing)))
+
+
+# ================================================== #
+#               Primitive Blocks                     #
+# ================================================== #
+def format_degrees(degrees):
+  """Format a coordinate like the XML files do: 7 decimals at most, without trailing zeros"""
+  text = ('%.7f' % degrees).rstrip('0')
+  return text + '0' if text.endswith('.') else text
+
+
+class PrimitiveBlock(object):
+  """String table and coordinate/date scaling of a PrimitiveBlock, used to decode its groups"""
+
+  def __init__(self, block):
+    self.strings = []
+    self.groups = []
+    self.granularity = 100
+    self.date_granularity = 1000
+    self.lat_offset = 0
+    self.lon_offset = 0
+
+    for number, value in iter_fields(block):
+      if number == 1:
+        self.strings = [bytes(string).decode('utf-8') for _, string in iter_fields(value)]
+      elif number == 2:
+        self.groups.append(value)
+      elif number == 17:
+        self.granularity = value
+      elif number == 18:
+        self.date_granularity = value
+      elif number == 19:
+        self.lat_offset = signed(value)
+      elif number == 20:
+        self.lon_offset = signed(value)
+
+  def lat(self, value):
+    return format_degrees(1e-9 * (self.lat_offset + self.granularity * value))
+
+  def lon(self, value):
+    return format_degrees(1e-9 * (self.lon_offset + self.granularity * value))
+
+  def timestamp(self, value):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value * self.date_granularity // 1000))
+
+  def tags(self, keys, vals):
+    strings = self.strings
+    return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+  def info(self, attrib, buf):
+    """Add the fields of an Info message to attrib"""
+    for number, value in iter_fields(buf):
+      if number == 1:
+        attrib['version'] = str(signed(value))
+      elif number == 2:
+        attrib['timestamp'] = self.timestamp(signed(value))
+      elif number == 3:
+        attrib['changeset'] = str(signed(value))
+      elif number == 4:
+        attrib['uid'] = str(signed(value))
+      elif number == 5:
+        attrib['user'] = self.strings[value]
+      elif number == 6 and not value:
+        attrib['visible'] = 'false'
+
+  def decode(self, tags):
+    """Return the (tag, attrib, tags, nds, members) tuples of the wanted element types in the block"""
+    records = []
+    for group in self.groups:
+      for number, value in iter_fields(group):
+        if number == 1 and 'node' in tags:
+          records.append(self.node(value))
+        elif number == 2 and 'node' in tags:
+          records.extend(self.dense_nodes(value))
+        elif number == 3 and 'way' in tags:
+          records.append(self.way(value))
+        elif number == 4 and 'relation' in tags:
+          records.append(self.relation(value))
+    return records
+
+  def node(self, buf):
+    attrib = dict(METADATA_DEFAULTS)
+    keys = vals = ()
+    for number, value in iter_fields(buf):
+      if number == 1:
+        attrib['id'] = str(zigzag(value))
+      elif number == 2:
+        keys = unpack_varints(value)
+      elif number == 3:
+        vals = unpack_varints(value)
+      elif number == 4:
+        self.info(attrib, value)
+      elif number == 8:
+        attrib['lat'] = self.lat(zigzag(value))
+      elif number == 9:
+        attrib['lon'] = self.lon(zigzag(value))
+    return ('node', attrib, self.tags(keys, vals), [], [])
+
+  def dense_nodes(self, buf):
+    ids = lats = lons = keys_vals = ()
+    info = {}
+    for number, value in iter_fields(buf):
+      if number == 1:
+        ids = unpack_deltas(value)
+      elif number == 5:
+        info = self.dense_info(value)
+      elif number == 8:
+        lats = unpack_deltas(value)
+      elif number == 9:
+        lons = unpack_deltas(value)
+      elif number == 10:
+        keys_vals = unpack_varints(value)
+
+    records = []
+    strings = self.strings
+    position = 0
+    for index, node_id in enumerate(ids):
+      attrib = dict(METADATA_DEFAULTS, id=str(node_id), lat=self.lat(lats[index]), lon=self.lon(lons[index]))
+      for field, values in info.items():
+        attrib[field] = values[index]
+
+      # keys_vals holds the key and value string ids of every node, each node's list ends with a 0
+      tags = []
+      while position < len(keys_vals) and keys_vals[position] != 0:
+        tags.append((strings[keys_vals[position]], strings[keys_vals[position + 1]]))
+        position += 2
+      position += 1
+
+      records.append(('node', attrib, tags, [], []))
+    return records
+
+  def dense_info(self, buf):
+    """Decode DenseInfo into {attribute: list of string values, one per node}"""
+    info = {}
+    for number, value in iter_fields(buf):
+      if number == 1:
+        info['version'] = [str(signed(version)) for version in unpack_varints(value)]
+      elif number == 2:
+        info['timestamp'] = [self.timestamp(stamp) for stamp in unpack_deltas(value)]
+      elif number == 3:
+        info['changeset'] = [str(changeset) for changeset in unpack_deltas(value)]
+      elif number == 4:
+        info['uid'] = [str(uid) for uid in unpack_deltas(value)]
+      elif number == 5:
+        info['user'] = [self.strings[sid] for sid in unpack_deltas(value)]
+      elif number == 6:
+        info['visible'] = ['true' if visible else 'false' for visible in unpack_varints(value)]
+    return info
+
+  def way(self, buf):
+    attrib = dict(METADATA_DEFAULTS)
+    keys = vals = refs = ()
+    for number, value in iter_fields(buf):
+      if number == 1:
+        attrib['id'] = str(signed(value))
+      elif number == 2:
+        keys = unpack_varints(value)
+      elif number == 3:
+        vals = unpack_varints(value)
+      elif number == 4:
+        self.info(attrib, value)
+      elif number == 8:
+        refs = unpack_deltas(value)
+    return ('way', attrib, self.tags(keys, vals), [str(ref) for ref in refs], [])
+
+  def relation(self, buf):
+    attrib = dict(METADATA_DEFAULTS)
+    keys = vals = roles = refs = types = ()
+    for number, value in iter_fields(buf):
+      if number == 1:
+        attrib['id'] = str(signed(value))
+      elif number == 2:
+        keys = unpack_varints(value)
+      elif number == 3:
+        vals = unpack_varints(value)
+      elif number == 4:
+        self.info(attrib, value)
+      elif number == 8:
+        roles = unpack_varints(value)
+      elif number == 9:
+        refs = unpack_deltas(value)
+      elif number == 10:
+        types = unpack_varints(value)
+
+    strings = self.strings
+    members = [(MEMBER_TYPES[member_type], str(ref), strings[role])
+               for member_type, ref, role in zip(types, refs, roles)]
+    return ('relation', attrib, self.tags(keys, vals), [], members)
+
+
+def decode_blob(job):
+  """Decode one (blob type, blob, wanted tags) job into element tuples, run in the worker processes"""
+  blob_type, blob, tags = job
+
+  if blob_type == 'OSMHeader':
+    check_header(inflate(blob))
+    return []
+  elif blob_type == 'OSMData':
+    return PrimitiveBlock(inflate(blob)).decode(tags)
+
+  # unknown blob types are meant to be skipped
+  return []
+
+
+def iter_pbf(source, tags=('node', 'way', 'relation'), workers=1):
+  """Yield the (tag, attrib, tags, nds, members) tuples of the wanted elements of a PBF file object, in file order
+
+  With more than one worker the blobs are decoded in a process pool, at most BLOBS_PER_WORKER blobs per
+  worker ahead of the consumer so memory stays bounded."""
+  jobs = ((blob_type, blob, tags) for blob_type, blob in iter_blobs(source))
+
+  if workers <= 1:
+    for job in jobs:
+      for record in decode_blob(job):
+        yield record
+    return
+
+  pool = multiprocessing.Pool(workers)
+  try:
+    pending = collections.deque()
+    for job in jobs:
+      pending.append(pool.apply_async(decode_blob, (job,)))
+      if len(pending) >= workers * BLOBS_PER_WORKER:
+        for record in pending.popleft().get():
+          yield record
+
+    while pending:
+      for record in pending.popleft().get():
+        yield record
+  finally:
+    pool.terminate()
+    pool.join()
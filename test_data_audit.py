@@ -0,0 +1,137 @@
+'''
+Regression tests for data_audit.
+
+Run with: python -m unittest discover
+'''
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import data_audit
+
+AUDIT_FIXTURE = u'''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="38.9" lon="-77.0" user="a" uid="1" version="1" changeset="1" timestamp="2017-01-01T00:00:00Z">
+  <tag k="amenity" v="pharmacy"/>
+  <tag k="name" v="CVS/Pharmacy"/>
+  <tag k="phone" v="+1 (202) 555-0101"/>
+  <tag k="addr:street" v="Georgia Ave"/>
+  <tag k="addr:postcode" v="20011-1234"/>
+ </node>
+ <node id="2" lat="38.9" lon="-77.0" user="a" uid="1" version="1" changeset="1" timestamp="2017-01-01T00:00:00Z">
+  <tag k="contact:phone" v="2025550102"/>
+  <tag k="addr:street" v="Georgia Ave"/>
+ </node>
+ <way id="3" user="a" uid="1" version="1" changeset="1" timestamp="2017-01-01T00:00:00Z">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <tag k="tiger:county" v="Montgomery, MD"/>
+  <tag k="addr:street" v="Stanton Rd"/>
+ </way>
+</osm>
+'''
+
+
+class SinglePassTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.osm_path = os.path.join(self.workdir, 'audit.osm')
+        with open(self.osm_path, 'wb') as osm_file:
+            osm_file.write(AUDIT_FIXTURE.encode('utf-8'))
+        self.get_element = data_audit.get_element
+
+    def tearDown(self):
+        data_audit.get_element = self.get_element
+        shutil.rmtree(self.workdir)
+
+    def test_one_pass_gives_every_auditor_its_own_results(self):
+        names = sorted(data_audit.AUDITORS)
+        alone = dict((name, data_audit.run_audits(self.osm_path, [data_audit.AUDITORS[name]()])[0].result())
+                     for name in names)
+
+        passes = []
+        def get_element(*args, **kwargs):
+            passes.append(kwargs.get('tags'))
+            return self.get_element(*args, **kwargs)
+        data_audit.get_element = get_element
+
+        together = data_audit.run_audits(self.osm_path, [data_audit.AUDITORS[name]() for name in names])
+        self.assertEqual(len(passes), 1)
+        self.assertEqual(dict((auditor.name, auditor.result()) for auditor in together), alone)
+
+    def test_street_auditor_counts_unexpected_types(self):
+        result = data_audit.run_audits(self.osm_path, [data_audit.StreetAuditor()])[0].result()
+        self.assertEqual([(entry['value'], entry['count']) for entry in result['street_types']['top']],
+                         [('Ave', 2), ('Rd', 1)])
+        self.assertEqual(result['street_names']['changed'], 3)
+
+
+class DependencyTest(unittest.TestCase):
+
+    def test_audit_runs_without_cerberus_and_schema(self):
+        # a None entry in sys.modules fails the import as if the module was not installed
+        code = ("import sys; sys.modules['cerberus'] = sys.modules['schema'] = None; import data_audit; "
+                "data_audit.run_audits(sys.argv[1], [data_audit.StreetAuditor()])")
+        workdir = tempfile.mkdtemp()
+        try:
+            osm_path = os.path.join(workdir, 'audit.osm')
+            with open(osm_path, 'wb') as osm_file:
+                osm_file.write(AUDIT_FIXTURE.encode('utf-8'))
+            subprocess.check_call([sys.executable, '-c', code, osm_path],
+                                  cwd=os.path.dirname(os.path.abspath(data_audit.__file__)))
+        finally:
+            shutil.rmtree(workdir)
+
+
+class SummaryTest(unittest.TestCase):
+
+    def test_heavy_hitters_keep_every_frequent_value(self):
+        rng = random.Random(0)
+        values = ['heavy%d' % i for i in range(5) for _ in range(600 * (i + 1))]
+        values += ['rare%d' % rng.randint(0, 10 ** 6) for _ in range(20000)]
+        rng.shuffle(values)
+        counter = data_audit.HeavyHitters(capacity=100)
+        for value in values:
+            counter.add(value)
+
+        bound = len(values) // (counter.capacity + 1)
+        for i in range(5):
+            true_count = 600 * (i + 1)
+            self.assertTrue(true_count - bound <= counter.counts['heavy%d' % i] <= true_count)
+        self.assertEqual([value for value, count in counter.top(5)], ['heavy%d' % i for i in range(4, -1, -1)])
+        self.assertTrue(counter.dropped > 0)
+
+    def test_heavy_hitters_are_exact_within_capacity(self):
+        counter = data_audit.HeavyHitters(capacity=3)
+        for value in 'abacab':
+            counter.add(value)
+        self.assertEqual(counter.top(), [('a', 3), ('b', 2), ('c', 1)])
+        self.assertEqual(counter.dropped, 0)
+
+    def test_distinct_sketch_estimate_within_five_percent(self):
+        for distinct in (100, 3000, 100000):
+            sketch = data_audit.DistinctSketch()
+            for i in range(distinct):
+                sketch.add(u'value %d' % i)
+                sketch.add(u'value %d' % (i // 2))
+            self.assertTrue(abs(sketch.estimate() - distinct) <= 0.05 * distinct,
+                            '%d distinct values estimated as %d' % (distinct, sketch.estimate()))
+
+    def test_value_stats_estimate_once_counters_overflow(self):
+        stats = data_audit.ValueStats(capacity=10)
+        for i in range(1000):
+            stats.add('value %d' % (i % 500))
+        result = stats.result()
+        self.assertEqual(result['total'], 1000)
+        self.assertFalse(result['distinct_exact'])
+        self.assertTrue(475 <= result['distinct'] <= 525)
+
+
+if __name__ == '__main__':
+    unittest.main()
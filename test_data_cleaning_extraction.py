@@ -0,0 +1,1088 @@
+"""
+Regression tests for data_cleaning_extraction.
+
+Run with: python -m unittest discover
+
+Tests that write outputs run in a temporary directory, as the extractor writes them to the current one.
+"""
+
+import argparse
+import bz2
+import calendar
+import filecmp
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import StringIO
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import xml.etree.cElementTree as ET
+import zlib
+
+import benchmark
+import columnar
+import data_cleaning_extraction as dce
+import pbf_reader
+
+try:
+  import cerberus
+except ImportError:
+  cerberus = None
+
+# the tests chdir to temporary directories, so the module path has to be absolute before they run
+SCRIPT = os.path.splitext(os.path.abspath(dce.__file__))[0] + '.py'
+
+FIXTURE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="1" lat="38.9012345" lon="-77.0" user="alice" uid="10" version="2"
+   changeset="100" timestamp="2017-01-01T00:00:00Z">
+  <tag k="amenity" v="pharmacy"/>
+  <tag k="name" v="CVS/Pharmacy"/>
+  <tag k="phone" v="+1 (202) 555-0101"/>
+  <tag k="addr:street" v="Georgia Ave NW"/>
+ </node>
+ <node id="2" lat="38.91" lon="-77.0123" user="b\u00e9a" uid="11" version="1"
+   changeset="101" timestamp="2017-01-02T03:04:05Z">
+  <tag k="name" v="Caf\u00e9 Pharmacy"/>
+  <tag k="bad.key" v="skipped"/>
+  <tag k="tiger:county" v="Montgomery, MD"/>
+ </node>
+ <node id="3" lat="-38.5" lon="77.25" user="alice" uid="10" version="1"
+   changeset="102" timestamp="2017-01-03T00:00:00Z"/>
+ <way id="20" user="alice" uid="10" version="3" changeset="103" timestamp="2017-02-01T00:00:00Z">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <nd ref="3"/>
+  <tag k="highway" v="residential"/>
+  <tag k="addr:street" v="Stanton St"/>
+ </way>
+ <relation id="30" user="b\u00e9a" uid="11" version="1" changeset="104" timestamp="2017-03-01T00:00:00Z">
+  <member type="way" ref="20" role="outer"/>
+  <member type="node" ref="1" role=""/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+</osm>
+"""
+
+COORDINATE = re.compile(r'\b(lat|lon)="([^"]*)"')
+
+
+def write_file(path, text):
+  with open(path, 'wb') as out:
+    out.write(text.encode('utf-8'))
+  return path
+
+
+def read_outputs(output):
+  """Return {table: rows} of the outputs a run wrote to the current directory"""
+  tables = {}
+  if output == 'sqlite':
+    conn = sqlite3.connect(dce.SQLITE_PATH)
+    try:
+      for table, _, fields in dce.OUTPUT_TABLES:
+        tables[table] = conn.execute('SELECT %s FROM %s' % (', '.join(fields), dce.SQL_TABLES[table])).fetchall()
+    finally:
+      conn.close()
+  elif output == 'columnar':
+    for table, path, _ in dce.OUTPUT_TABLES:
+      reader = columnar.ColumnReader(os.path.splitext(path)[0] + dce.COLUMNAR_EXTENSION)
+      try:
+        tables[table] = list(reader.iter_rows())
+      finally:
+        reader.close()
+  else:
+    for table, path, _ in dce.OUTPUT_TABLES:
+      with open(path, 'rb') as table_file:
+        tables[table] = table_file.read()
+  return tables
+
+
+# ================================================== #
+#               PBF Encoding                         #
+# ================================================== #
+def varint(value):
+  if value < 0:
+    value += 1 << 64
+  data = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      data.append(byte | 0x80)
+    else:
+      data.append(byte)
+      return bytes(data)
+
+
+def zigzag(value):
+  return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def deltas(values):
+  return [value - previous for value, previous in zip(values, [0] + values[:-1])]
+
+
+def field(number, value):
+  """Encode a varint field, or a length delimited one for a byte string"""
+  if isinstance(value, bytes):
+    return varint(number << 3 | 2) + varint(len(value)) + value
+  return varint(number << 3) + varint(value)
+
+
+def packed(number, values):
+  return field(number, b''.join(varint(value) for value in values))
+
+
+def blob(blob_type, message):
+  data = field(2, len(message)) + field(3, zlib.compress(message))
+  header = field(1, blob_type.encode('utf-8')) + field(3, len(data))
+  return struct.pack('>I', len(header)) + header + data
+
+
+class PbfEncoder(object):
+  """Encode the elements of an OSM XML file as a PBF file, the reverse of pbf_reader
+
+  dense=False writes the nodes as Node messages instead of DenseNodes and metadata=False leaves out the
+  Info of every element, like public extracts do."""
+
+  def __init__(self, dense=True, metadata=True):
+    self.dense = dense
+    self.metadata = metadata
+    self.strings = {u'': 0}
+
+  def string(self, value):
+    return self.strings.setdefault(value, len(self.strings))
+
+  @staticmethod
+  def seconds(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+  @staticmethod
+  def degrees(value):
+    return int(round(float(value) * 1e7))
+
+  def info(self, attrib):
+    if not self.metadata:
+      return b''
+    return field(4, field(1, int(attrib['version'])) + field(2, self.seconds(attrib['timestamp'])) +
+                 field(3, int(attrib['changeset'])) + field(4, int(attrib['uid'])) +
+                 field(5, self.string(attrib['user'])))
+
+  def tags(self, element):
+    pairs = [(self.string(tag.attrib['k']), self.string(tag.attrib['v'])) for tag in element.iter('tag')]
+    return packed(2, [k for k, _ in pairs]) + packed(3, [v for _, v in pairs])
+
+  def node(self, element):
+    return field(1, field(1, zigzag(int(element.attrib['id']))) + self.tags(element) + self.info(element.attrib) +
+                 field(8, zigzag(self.degrees(element.attrib['lat']))) +
+                 field(9, zigzag(self.degrees(element.attrib['lon']))))
+
+  def dense_nodes(self, elements):
+    def delta_field(number, values):
+      return packed(number, [zigzag(value) for value in deltas(values)])
+
+    attribs = [element.attrib for element in elements]
+    keys_vals = []
+    for element in elements:
+      for tag in element.iter('tag'):
+        keys_vals.extend([self.string(tag.attrib['k']), self.string(tag.attrib['v'])])
+      keys_vals.append(0)
+
+    message = delta_field(1, [int(attrib['id']) for attrib in attribs])
+    if self.metadata:
+      message += field(5, packed(1, [int(attrib['version']) for attrib in attribs]) +
+                       delta_field(2, [self.seconds(attrib['timestamp']) for attrib in attribs]) +
+                       delta_field(3, [int(attrib['changeset']) for attrib in attribs]) +
+                       delta_field(4, [int(attrib['uid']) for attrib in attribs]) +
+                       delta_field(5, [self.string(attrib['user']) for attrib in attribs]))
+    message += (delta_field(8, [self.degrees(attrib['lat']) for attrib in attribs]) +
+                delta_field(9, [self.degrees(attrib['lon']) for attrib in attribs]) + packed(10, keys_vals))
+    return field(2, message)
+
+  def way(self, element):
+    refs = [int(nd.attrib['ref']) for nd in element.iter('nd')]
+    return field(3, field(1, int(element.attrib['id'])) + self.tags(element) + self.info(element.attrib) +
+                 packed(8, [zigzag(ref) for ref in deltas(refs)]))
+
+  def relation(self, element):
+    members = list(element.iter('member'))
+    return field(4, field(1, int(element.attrib['id'])) + self.tags(element) + self.info(element.attrib) +
+                 packed(8, [self.string(member.attrib['role']) for member in members]) +
+                 packed(9, [zigzag(ref) for ref in deltas([int(member.attrib['ref']) for member in members])]) +
+                 packed(10, [pbf_reader.MEMBER_TYPES.index(member.attrib['type']) for member in members]))
+
+  def encode(self, osm_path, pbf_path):
+    root = ET.parse(osm_path).getroot()
+    nodes = root.findall('node')
+    groups = [self.dense_nodes(nodes)] if self.dense else [b''.join(self.node(node) for node in nodes)]
+    groups.append(b''.join(self.way(way) for way in root.findall('way')))
+    groups.append(b''.join(self.relation(relation) for relation in root.findall('relation')))
+
+    strings = sorted(self.strings, key=self.strings.get)
+    block = field(1, b''.join(field(1, string.encode('utf-8')) for string in strings))
+    block += b''.join(field(2, group) for group in groups if group)
+
+    with open(pbf_path, 'wb') as pbf:
+      pbf.write(blob('OSMHeader', field(4, b'OsmSchema-V0.6') + field(4, b'DenseNodes')))
+      pbf.write(blob('OSMData', block))
+    return pbf_path
+
+
+# ================================================== #
+#               Tests                                #
+# ================================================== #
+class TempDirTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.workdir = tempfile.mkdtemp()
+    os.chdir(self.workdir)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.workdir)
+
+
+class ShapeElementTest(unittest.TestCase):
+
+  def shape(self, text):
+    return dce.shape_element(ET.fromstring(text))
+
+  def test_every_tag_goes_through_its_own_cleaner(self):
+    # the nested tag loop shadowed "tag", so the cleaner of one tag ran on the value of another
+    el = self.shape('<node id="1" lat="1" lon="2" user="u" uid="1" version="1" changeset="1" timestamp="t">'
+                    '<tag k="phone" v="+1 (202) 555-0101"/><tag k="amenity" v="pharmacy"/>'
+                    '<tag k="name" v="CVS/Pharmacy"/><tag k="addr:street" v="Georgia Ave"/></node>')
+    self.assertEqual([(tag['type'], tag['key'], tag['value']) for tag in el['node_tags']],
+                     [('regular', 'phone', '2025550101'), ('regular', 'amenity', 'pharmacy'),
+                      ('regular', 'name', 'CVS'), ('addr', 'street', 'Georgia Avenue')])
+
+  def test_conditional_cleaner_needs_its_tag(self):
+    el = self.shape('<node id="1" lat="1" lon="2" user="u" uid="1" version="1" changeset="1" timestamp="t">'
+                    '<tag k="name" v="CVS/Pharmacy"/><tag k="amenity" v="cafe"/></node>')
+    self.assertEqual(el['node_tags'][0]['value'], 'CVS/Pharmacy')
+
+  def test_problem_keys_are_skipped(self):
+    el = self.shape('<way id="5" user="u" uid="1" version="1" changeset="1" timestamp="t"><nd ref="1"/>'
+                    '<nd ref="2"/><tag k="bad.key" v="x"/><tag k="a:b:c" v="y"/></way>')
+    self.assertEqual([(tag['type'], tag['key']) for tag in el['way_tags']], [('a', 'b:c')])
+    self.assertEqual([(nd['node_id'], nd['position']) for nd in el['way_nodes']], [('1', 0), ('2', 1)])
+
+
+class StreetNormalizerTest(unittest.TestCase):
+
+  def test_street_type_at_the_end(self):
+    for name, expected in (('Stanton St', 'Stanton Street'), ('Stanton Park', 'Stanton Park'),
+                           ('St Marys Ct', 'St Marys Court'), ('Georgia Avenue', 'Georgia Avenue'),
+                           ('Rhode Island Ave.', 'Rhode Island Avenue')):
+      self.assertEqual(dce.update_name(name, dce.mapping), expected)
+
+  def test_street_type_before_a_direction(self):
+    for name, expected in (('Main St SW', 'Main Street SW'), ('Main St SE', 'Main Street SE'),
+                           ('Main St S', 'Main Street S'), ('Main St S.W.', 'Main Street S.W.'),
+                           ('St SW Plaza', 'St SW Plaza')):
+      self.assertEqual(dce.update_name(name, dce.mapping), expected)
+
+
+class ValidatorTest(unittest.TestCase):
+
+  NODE = ('<node id="1" lat="1.5" lon="2" user="u" uid="1" version="1" changeset="1" timestamp="t">'
+          '<tag k="a" v="b"/></node>')
+
+  def setUp(self):
+    self.validator = dce.CompiledValidator()
+
+  def shaped(self, table=None, **changes):
+    el = dce.shape_element(ET.fromstring(self.NODE))
+    if table is not None:
+      row = el[table] if isinstance(el[table], dict) else el[table][0]
+      row.update(changes)
+    return el
+
+  def invalid_elements(self):
+    yield self.shaped('node', id='x')
+    yield self.shaped('node', lat='north')
+    yield self.shaped('node', user=None)
+    yield self.shaped('node_tags', value=3)
+    yield self.shaped('node', visible='true')
+    yield self.shaped('node_tags', role='')
+    el = self.shaped()
+    del el['node']['timestamp']
+    yield el
+    el = self.shaped()
+    el['node_notes'] = []
+    yield el
+
+  def test_valid_element(self):
+    self.validator.validate(self.shaped())
+
+  def test_invalid_elements(self):
+    for el in self.invalid_elements():
+      self.assertRaises(dce.ValidationError, self.validator.validate, el)
+
+  @unittest.skipIf(cerberus is None, 'cerberus is not installed')
+  def test_cerberus_agrees(self):
+    self.assertTrue(cerberus.Validator().validate(self.shaped(), dce.load_schema()))
+    for el in self.invalid_elements():
+      self.assertFalse(cerberus.Validator().validate(el, dce.load_schema()), el)
+
+  def test_optional_fields(self):
+    validator = dce.CompiledValidator({'note': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+      'id': {'required': True, 'type': 'integer', 'coerce': int}, 'text': {'type': 'string'},
+      'score': {'type': 'float', 'coerce': float}}}}})
+    validator.validate({'note': [{'id': '1'}, {'id': '2', 'text': u'ok', 'score': '0.5'}]})
+    for row in ({'text': u'no id'}, {'id': '3', 'text': 4}, {'id': '4', 'score': 'high'}, {'id': '5', 'lang': 'en'}):
+      self.assertRaises(dce.ValidationError, validator.validate, {'note': [{'id': '1'}, row]})
+
+  def test_sampling(self):
+    validator = dce.CompiledValidator(sample=3)
+    for seen in range(1, 13):
+      validator.validate(self.shaped() if seen % 3 == 0 else self.shaped('node', id='x'))
+    self.assertEqual((validator.seen, validator.checked), (12, 4))
+
+
+class BoundedCacheTest(unittest.TestCase):
+
+  def test_two_generations(self):
+    calls = []
+
+    def upper(value):
+      calls.append(value)
+      return value.upper()
+    cache = dce.BoundedCache(upper, maxsize=4)
+
+    for value in 'aabcadbcX':
+      self.assertEqual(cache(value), value.upper())
+      self.assertTrue(len(cache.new) + len(cache.old) <= 4)
+    # c pushed a and b to the old generation, a hit there moved back and d then dropped b
+    self.assertEqual(calls, ['a', 'b', 'c', 'd', 'b', 'X'])
+    self.assertEqual((cache.hits, cache.misses, cache.changes), (3, 6, 8))
+    self.assertEqual(cache.name, 'upper')
+
+
+class ParityTest(TempDirTestCase):
+
+  def write_csvs(self, source, suffix, backend=None):
+    sink = dce.CsvSink(suffix=suffix)
+    try:
+      dce.write_elements(source, False, sink, backend)
+    finally:
+      sink.close()
+
+  def assertSameCsvs(self, suffixes):
+    for _, path, _ in dce.OUTPUT_TABLES:
+      for suffix in suffixes[1:]:
+        self.assertTrue(filecmp.cmp(path + suffixes[0], path + suffix, shallow=False),
+                        '%s%s differs from %s%s' % (path, suffix, path, suffixes[0]))
+
+  def sources(self):
+    fixture = write_file('fixture.osm', FIXTURE)
+    benchmark.generate_osm('synthetic.osm', nodes=300)
+    return [fixture, 'synthetic.osm']
+
+  def test_backends_write_identical_csvs(self):
+    for source in self.sources():
+      suffixes = []
+      for backend in sorted(dce.PARSER_BACKENDS):
+        suffixes.append('.%s.%s' % (source, backend))
+        self.write_csvs(source, suffixes[-1], backend)
+      self.assertSameCsvs(suffixes)
+
+  def test_pbf_writes_the_csvs_of_xml(self):
+    for source in self.sources():
+      # OSM files write coordinates without trailing zeros, generate_osm pads them
+      with open(source, 'rb') as osm_file:
+        text = COORDINATE.sub(lambda match: '%s="%s"' % (match.group(1), pbf_reader.format_degrees(
+          float(match.group(2)))), osm_file.read())
+      with open(source, 'wb') as osm_file:
+        osm_file.write(text)
+
+      self.write_csvs(source, '.xml')
+      for dense in (True, False):
+        suffix = '.pbf.%s' % dense
+        self.write_csvs(PbfEncoder(dense).encode(source, source + suffix + '.osm.pbf'), suffix)
+        self.assertSameCsvs(['.xml', suffix])
+
+  def test_pbf_without_metadata(self):
+    pbf = PbfEncoder(metadata=False).encode(write_file('fixture.osm', FIXTURE), 'fixture.osm.pbf')
+    elements = [dce.shape_element(element) for element in dce.get_element(pbf)]
+    self.assertEqual(len(elements), 5)
+    self.assertEqual([elements[0]['node'][field] for field in ('user', 'uid', 'version', 'changeset')],
+                     ['', '0', '0', '0'])
+
+  def test_csv_sink_matches_dict_writer(self):
+    shaped = [dce.shape_element(element) for source in self.sources() for element in dce.get_element(source)]
+    for suffix, make_sink in (('.dict', benchmark.DictWriterSink), ('.batch', dce.CsvSink)):
+      sink = make_sink(suffix=suffix)
+      for el in shaped:
+        sink.write(el)
+      sink.close()
+    self.assertSameCsvs(['.dict', '.batch'])
+
+
+class ParallelTest(TempDirTestCase):
+
+  def test_shards_write_the_csvs_of_a_single_process(self):
+    benchmark.generate_osm('synthetic.osm', nodes=3000)
+    dce.process_map('synthetic.osm', False)
+    expected = read_outputs('csv')
+    stats = dce.process_map('synthetic.osm', False, workers=2)
+    self.assertEqual(read_outputs('csv'), expected)
+    self.assertEqual(stats.elements, {'node': 3000, 'way': 500, 'relation': 50})
+
+
+class SqliteSinkTest(TempDirTestCase):
+
+  def test_sink_loads_the_rows_of_a_csv_import(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False)
+    benchmark.import_csvs('imported.db')
+    dce.process_map('fixture.osm', False, output='sqlite')
+
+    for table in sorted(dce.SQL_TABLES.values()):
+      query = 'SELECT * FROM %s ORDER BY rowid' % table
+      rows = []
+      for db_path in ('imported.db', dce.SQLITE_PATH):
+        conn = sqlite3.connect(db_path)
+        rows.append(conn.execute(query).fetchall())
+        conn.close()
+      self.assertEqual(rows[1], rows[0], '%s differs from the csv import' % table)
+
+  def test_database_ships_without_wal(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False, output='sqlite')
+    self.assertFalse(os.path.exists(dce.SQLITE_PATH + '-wal'))
+
+    conn = sqlite3.connect(dce.SQLITE_PATH)
+    try:
+      self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+      indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+      self.assertIn('ways_nodes_node_id', indexes)
+    finally:
+      conn.close()
+
+
+CHANGES = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+ <create>
+  <node id="4" lat="38.95" lon="-77.05" user="carol" uid="12" version="1" changeset="200"
+    timestamp="2018-01-01T00:00:00Z">
+   <tag k="phone" v="(202) 555-1234"/>
+  </node>
+ </create>
+ <modify>
+  <node id="1" lat="38.9" lon="-77.01" user="carol" uid="12" version="3" changeset="200"
+    timestamp="2018-01-01T00:00:00Z"/>
+  <way id="20" user="carol" uid="12" version="4" changeset="200" timestamp="2018-01-01T00:00:00Z">
+   <nd ref="1"/>
+   <nd ref="4"/>
+   <tag k="highway" v="service"/>
+  </way>
+ </modify>
+ <delete>
+  <node id="2" user="carol" uid="12" version="2" changeset="200" timestamp="2018-01-01T00:00:00Z"/>
+  <relation id="30" user="carol" uid="12" version="2" changeset="200" timestamp="2018-01-01T00:00:00Z"/>
+ </delete>
+</osmChange>
+"""
+
+
+class ChangesTest(TempDirTestCase):
+
+  def test_changes_update_the_database(self):
+    dce.process_map(write_file('fixture.osm', FIXTURE), False, output='sqlite')
+    stats = dce.process_map(write_file('changes.osc', CHANGES), True, output='sqlite', incremental=True)
+    self.assertEqual(stats.elements, {'node': 2, 'way': 1, 'relation': 0})
+
+    tables = read_outputs('sqlite')
+    self.assertEqual([row[:3] for row in tables['node']], [(1, 38.9, -77.01), (3, -38.5, 77.25), (4, 38.95, -77.05)])
+    self.assertEqual(tables['node_tags'], [(4, u'phone', u'2025551234', u'regular')])
+    self.assertEqual(tables['way'], [(20, u'carol', 12, u'4', 200, u'2018-01-01T00:00:00Z')])
+    self.assertEqual(tables['way_nodes'], [(20, 1, 0), (20, 4, 1)])
+    self.assertEqual(tables['way_tags'], [(20, u'highway', u'service', u'regular')])
+    self.assertEqual((tables['relation'], tables['relation_members'], tables['relation_tags']), ([], [], []))
+
+  def test_invalid_changes_are_rejected(self):
+    dce.process_map(write_file('fixture.osm', FIXTURE), False, output='sqlite')
+    invalid = write_file('invalid.osc', CHANGES.replace('uid="12"', 'uid="carol"', 1))
+    self.assertRaises(dce.ValidationError, dce.process_map, invalid, True, output='sqlite', incremental=True)
+
+  def test_changes_need_the_sqlite_output(self):
+    self.assertRaises(ValueError, dce.process_map, write_file('changes.osc', CHANGES), False, incremental=True)
+
+
+class CompressedInputTest(TempDirTestCase):
+
+  def setUp(self):
+    super(CompressedInputTest, self).setUp()
+    self.find_program = dce.find_program
+    benchmark.generate_osm('synthetic.osm', nodes=1000)
+    with open('synthetic.osm', 'rb') as osm_file:
+      self.text = osm_file.read()
+    dce.process_map('synthetic.osm', False)
+    self.expected = read_outputs('csv')
+
+  def tearDown(self):
+    dce.find_program = self.find_program
+    super(CompressedInputTest, self).tearDown()
+
+  def compressed(self):
+    for extension, opener in (('.bz2', bz2.BZ2File), ('.gz', gzip.open)):
+      with opener('synthetic.osm' + extension, 'wb') as out:
+        out.write(self.text)
+      yield 'synthetic.osm' + extension
+    if self.find_program('xz') is not None:
+      subprocess.check_call(['xz', '-k', 'synthetic.osm'])
+      yield 'synthetic.osm.xz'
+
+  def test_external_decompressors(self):
+    for path in self.compressed():
+      dce.process_map(path, False)
+      self.assertEqual(read_outputs('csv'), self.expected, '%s differs' % path)
+
+  def test_python_decompressors(self):
+    dce.find_program = lambda name: None
+    for path in self.compressed():
+      if dce.DECOMPRESSORS[os.path.splitext(path)[1]][1] is None:
+        self.assertRaises(IOError, dce.process_map, path, False)
+        continue
+      dce.process_map(path, False)
+      self.assertEqual(read_outputs('csv'), self.expected, '%s differs' % path)
+
+  def test_reader_stops_early(self):
+    # the decompressing thread blocks on a full queue, closing the input before the end must not hang
+    list(self.compressed())
+    reader = dce.BackgroundReader(gzip.open('synthetic.osm.gz', 'rb'), 1024, 2)
+    reader.read(10)
+    reader.close()
+    self.assertFalse(reader.thread.is_alive())
+
+
+class ColumnarTest(TempDirTestCase):
+
+  FIELDS = ['id', 'lat', 'count', 'name', 'key']
+  TYPES = ['int64', 'float64', 'int32', 'string', 'dict']
+  ROWS = [(1, 38.9, 0, u'Caf\u00e9', u'amenity'), (-2, -77.5, 7, u'', u'name'), (2 ** 40, 0.0, -1, u'a,b', u'amenity'),
+          (4, 1e-7, 3, u'"quoted"', u'name'), (5, 90.0, 2 ** 31 - 1, u'line\nbreak', u'amenity'),
+          (6, -180.0, 5, u'x' * 1000, u'\u00e9'), (7, 1.5, 6, u'last', u'name')]
+
+  def write(self, rows, chunk_rows=3, path='table.col'):
+    writer = columnar.ColumnWriter(path, self.FIELDS, self.TYPES, chunk_rows=chunk_rows)
+    writer.extend(rows)
+    writer.close()
+    return columnar.ColumnReader(path)
+
+  def test_round_trip_over_chunks(self):
+    for chunk_rows in (1, 3, 7, 100):
+      reader = self.write(self.ROWS, chunk_rows)
+      try:
+        self.assertEqual((reader.fields, reader.types, reader.rows), (self.FIELDS, self.TYPES, len(self.ROWS)))
+        self.assertEqual([chunk['rows'] for chunk in reader.chunks],
+                         [min(chunk_rows, len(self.ROWS) - start) for start in range(0, len(self.ROWS), chunk_rows)])
+        self.assertEqual(list(reader.iter_rows()), self.ROWS)
+        self.assertEqual(list(reader.iter_rows(['key', 'id'])), [(row[4], row[0]) for row in self.ROWS])
+        self.assertEqual(list(reader.column('lat')), [row[1] for row in self.ROWS])
+      finally:
+        reader.close()
+
+  def test_empty_table(self):
+    reader = self.write([])
+    try:
+      self.assertEqual((reader.rows, reader.chunks, list(reader.iter_rows())), (0, [], []))
+      self.assertEqual(list(reader.column('name')), [])
+    finally:
+      reader.close()
+
+  def test_resume_after_checkpoint(self):
+    writer = columnar.ColumnWriter('table.col', self.FIELDS, self.TYPES, chunk_rows=3)
+    writer.extend(self.ROWS[:4])
+    state = writer.checkpoint()
+    writer.extend(self.ROWS[4:6])
+    writer.flush()
+    writer.file.close()
+
+    writer = columnar.ColumnWriter('table.col', self.FIELDS, self.TYPES, chunk_rows=3, resume=state)
+    writer.extend(self.ROWS[4:])
+    writer.close()
+    reader = columnar.ColumnReader('table.col')
+    try:
+      self.assertEqual(list(reader.iter_rows()), self.ROWS)
+    finally:
+      reader.close()
+
+  def test_invalid_files_and_types(self):
+    self.assertRaises(ValueError, columnar.ColumnWriter, 'table.col', ['id'], ['int16'])
+    write_file('table.csv', u'id\n1\n')
+    self.assertRaises(ValueError, columnar.ColumnReader, 'table.csv')
+
+  def test_smaller_than_the_csvs(self):
+    benchmark.generate_osm('synthetic.osm', nodes=3000)
+    dce.process_map('synthetic.osm', False)
+    dce.process_map('synthetic.osm', False, output='columnar')
+    csv_bytes = sum(os.path.getsize(path) for _, path, _ in dce.OUTPUT_TABLES)
+    column_bytes = sum(os.path.getsize(os.path.splitext(path)[0] + dce.COLUMNAR_EXTENSION)
+                       for _, path, _ in dce.OUTPUT_TABLES)
+    self.assertTrue(column_bytes < csv_bytes / 2, (column_bytes, csv_bytes))
+
+
+class IdSetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pending = dce.ID_PENDING
+
+  def tearDown(self):
+    dce.ID_PENDING = self.pending
+
+  def test_scattered_ids_take_8_bytes(self):
+    ids = benchmark.scattered_ids(20000, 12 * 10 ** 9)
+    id_set = dce.IdSet()
+    for element_id in ids:
+      id_set.add(element_id)
+    self.assertEqual(len(id_set), len(ids))
+    self.assertTrue(all(element_id in id_set for element_id in ids))
+    self.assertFalse(any(element_id + 1 in id_set for element_id in ids))
+    self.assertEqual(id_set.pages, {})
+    self.assertLessEqual(id_set.nbytes(), 8 * len(ids) * 1.2)
+
+  def test_dense_ids_move_to_bitmaps(self):
+    id_set = dce.IdSet()
+    for element_id in range(4000000000, 4000300000, 3):
+      id_set.add(element_id)
+    self.assertEqual(len(id_set), 100000)
+    self.assertLess(id_set.nbytes(), 100000)
+    self.assertTrue(4000000000 in id_set and 4000299997 in id_set)
+    self.assertFalse(4000000001 in id_set or 4000300000 in id_set)
+
+  def test_ids_out_of_order(self):
+    dce.ID_PENDING = 50
+    rng = random.Random(0)
+    expected = set()
+    id_set = dce.IdSet()
+    top = 0
+    for _ in range(20000):
+      # an ascending run mixed with ids anywhere below it, some of them added twice
+      element_id = rng.choice([rng.randint(0, 200000), rng.randint(0, 3000), top + 1])
+      top = max(top, element_id)
+      expected.add(element_id)
+      id_set.add(element_id)
+      self.assertEqual(len(id_set), len(expected))
+    self.assertTrue(id_set.pages)
+    self.assertEqual(set(element_id for element_id in range(top + 2) if element_id in id_set), expected)
+
+
+class RegionTest(TempDirTestCase):
+
+  def ids(self, output='csv'):
+    tables = read_outputs(output)
+    if output == 'csv':
+      return dict((table, [row.split(',')[0] for row in tables[table].splitlines()[1:]])
+                  for table in ('node', 'way', 'way_nodes', 'relation'))
+    return tables
+
+  def test_bbox_keeps_the_ways_and_relations_of_its_nodes(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False, region=dce.BBox(38.9, -77.01, 38.95, -76.99))
+    self.assertEqual(self.ids(), {'node': ['1'], 'way': ['20'], 'way_nodes': ['20', '20', '20'],
+                                  'relation': ['30']})
+
+  def test_polygon(self):
+    write_file('fixture.osm', FIXTURE)
+    # node 1 lies in the bbox of the triangle but outside of it
+    triangle = dce.Polygon([(38.85, -77.05), (38.97, -77.05), (38.85, -76.97)])
+    dce.process_map('fixture.osm', False, region=triangle)
+    self.assertEqual(self.ids(), {'node': ['2'], 'way': ['20'], 'way_nodes': ['20', '20', '20'],
+                                  'relation': ['30']})
+
+  def test_nothing_inside(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False, region=dce.BBox(0, 0, 1, 1))
+    self.assertEqual(self.ids(), {'node': [], 'way': [], 'way_nodes': [], 'relation': []})
+
+  def test_spatial_index(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False, output='sqlite', spatial_index=True)
+    conn = sqlite3.connect(dce.SQLITE_PATH)
+    try:
+      ids = conn.execute('SELECT id FROM nodes_rtree WHERE min_lat >= ? AND max_lat <= ? AND min_lon >= ? AND '
+                         'max_lon <= ? ORDER BY id', (38.8, 39.0, -77.1, -76.9)).fetchall()
+    finally:
+      conn.close()
+    self.assertEqual(ids, [(1,), (2,)])
+
+  def test_command_line(self):
+    write_file('fixture.osm', FIXTURE)
+    write_file('triangle.txt', u'38.85,-77.05\n38.97,-77.05\n38.85,-76.97\n')
+    subprocess.check_output([sys.executable, SCRIPT, 'fixture.osm', '--bbox', '38.9,-77.01,38.95,-76.99',
+                             '--geometry', 'wkt'], stderr=subprocess.STDOUT)
+    self.assertEqual(self.ids()['node'], ['1'])
+    self.assertEqual(read_outputs('csv')['way_geometry'].splitlines()[1:],
+                     ['20,"LINESTRING (-77.0 38.9012345, -77.0123 38.91, 77.25 -38.5)"'])
+
+    subprocess.check_output([sys.executable, SCRIPT, 'fixture.osm', '--polygon', 'triangle.txt',
+                             '--output', 'sqlite', '--spatial-index'], stderr=subprocess.STDOUT)
+    conn = sqlite3.connect(dce.SQLITE_PATH)
+    try:
+      self.assertEqual(conn.execute('SELECT id FROM nodes').fetchall(), [(2,)])
+      self.assertEqual(conn.execute('SELECT id FROM nodes_rtree').fetchall(), [(2,)])
+    finally:
+      conn.close()
+
+  def test_command_line_regions(self):
+    bbox = dce.parse_bbox('38.9,-77.01,38.95,-76.99')
+    self.assertEqual((bbox.min_lat, bbox.min_lon, bbox.max_lat, bbox.max_lon), (38.9, -77.01, 38.95, -76.99))
+    for text in ('38.9,-77.01,38.95', '38.9,-77.01,38.95,x', '38.95,-77.01,38.9,-76.99'):
+      self.assertRaises(argparse.ArgumentTypeError, dce.parse_bbox, text)
+
+    write_file('triangle.txt', u'38.85,-77.05\n\n38.97,-77.05\n38.85,-76.97\n')
+    self.assertEqual(dce.read_polygon('triangle.txt').points, [(38.85, -77.05), (38.97, -77.05), (38.85, -76.97)])
+    write_file('line.txt', u'38.85,-77.05\n38.97,-77.05\n')
+    write_file('spaces.txt', u'38.85 -77.05\n38.97 -77.05\n38.85 -76.97\n')
+    for path in ('line.txt', 'spaces.txt'):
+      self.assertRaises(argparse.ArgumentTypeError, dce.read_polygon, path)
+
+
+class GeometryTest(TempDirTestCase):
+
+  def setUp(self):
+    super(GeometryTest, self).setUp()
+    self.pending = dce.ID_PENDING
+    self.check_nodes = dce.LOCATION_CHECK_NODES
+
+  def tearDown(self):
+    dce.ID_PENDING = self.pending
+    dce.LOCATION_CHECK_NODES = self.check_nodes
+    super(GeometryTest, self).tearDown()
+
+  def test_way_lines(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False, geometry='wkt')
+    self.assertEqual(read_outputs('csv')['way_geometry'].splitlines()[1:],
+                     ['20,"LINESTRING (-77.0 38.9012345, -77.0123 38.91, 77.25 -38.5)"'])
+
+    dce.process_map('fixture.osm', False, geometry='wkb', region=dce.BBox(38, -78, 39, -76))
+    geometry = read_outputs('csv')['way_geometry'].splitlines()[1].split(',')[1]
+    self.assertEqual(tuple(round(value, 7) for value in struct.unpack('<BII6d', geometry.decode('hex'))),
+                     (1, 2, 3, -77.0, 38.9012345, -77.0123, 38.91, 77.25, -38.5))
+
+  def test_sparse_store(self):
+    dce.ID_PENDING = 10
+    rng = random.Random(0)
+    expected = {}
+    store = dce.SparseLocationStore()
+    for node_id in benchmark.scattered_ids(1000, 12 * 10 ** 9) + [rng.randint(1, 10 ** 10) for _ in range(300)]:
+      expected[node_id] = (round(rng.uniform(-90, 90), 7), round(rng.uniform(-180, 180), 7))
+      store.set(node_id, *expected[node_id])
+    self.assertEqual(len(store), len(expected))
+    for node_id, (lat, lon) in expected.items():
+      self.assertEqual(tuple(round(value, 7) for value in store.get(node_id)), (lat, lon))
+      if node_id + 1 not in expected:
+        self.assertEqual(store.get(node_id + 1), None)
+    store.merge_pending()
+    self.assertEqual(store.nbytes(), 16 * len(store))
+
+  def test_store_follows_the_density_of_the_ids(self):
+    dce.LOCATION_CHECK_NODES = 64
+    for ids, dense in ((benchmark.scattered_ids(1000, 12 * 10 ** 9), False),
+                       ([4000000000 + i * 3 // 2 for i in range(1000)], True)):
+      builder = dce.GeometryBuilder()
+      try:
+        for node_id in ids:
+          builder.set_location(node_id, 38.9, -77.0)
+        # an id below the first one of the dense store
+        builder.set_location(ids[0] - 5, 1.0, 2.0)
+        self.assertEqual(isinstance(builder.locations, dce.NodeLocationStore), dense)
+        self.assertTrue(all(builder.locations.get(node_id) is not None for node_id in ids))
+        self.assertEqual([round(value, 7) for value in builder.locations.get(ids[0] - 5)], [1.0, 2.0])
+        self.assertEqual(builder.locations.get(ids[-1] + 1), None)
+      finally:
+        builder.close()
+
+
+class PipelineStatsTest(TempDirTestCase):
+
+  def test_counts_and_stages(self):
+    write_file('fixture.osm', FIXTURE)
+    stderr = sys.stderr
+    sys.stderr = progress = StringIO.StringIO()
+    try:
+      stats = dce.process_map('fixture.osm', False, progress_every=1e-9)
+    finally:
+      sys.stderr = stderr
+
+    summary = stats.summary()
+    self.assertEqual(summary['elements'], {'node': 3, 'way': 1, 'relation': 1, 'total': 5})
+    self.assertEqual(summary['tags'], 9)
+    self.assertEqual((summary['rows']['node'], summary['rows']['node_tags'], summary['rows']['way_nodes']), (3, 6, 3))
+    self.assertEqual(sorted(summary['stages']), sorted(dce.PipelineStats.STAGES))
+    self.assertTrue(all(seconds >= 0 for seconds in summary['stages'].values()))
+    self.assertEqual(summary['cleaners']['fix_phone']['calls'], 1)
+    self.assertEqual(len(progress.getvalue().splitlines()), 5)
+    self.assertTrue(progress.getvalue().startswith('1 elements, '))
+
+    stats.write_json('stats.json')
+    with open('stats.json') as stats_file:
+      self.assertEqual(json.load(stats_file)['elements'], summary['elements'])
+
+  def test_merge_adds_worker_summaries(self):
+    write_file('fixture.osm', FIXTURE)
+    summary = dce.process_map('fixture.osm', False).summary()
+    stats = dce.PipelineStats()
+    stats.merge(summary)
+    stats.merge(summary)
+    merged = stats.summary()
+    self.assertEqual(merged['elements']['total'], 10)
+    self.assertEqual(merged['rows']['way_tags'], 2 * summary['rows']['way_tags'])
+    self.assertEqual(merged['cleaners']['fix_phone']['calls'], 2)
+    self.assertAlmostEqual(merged['stages']['shape'], 2 * summary['stages']['shape'])
+
+
+class CheckpointTest(TempDirTestCase):
+
+  def setUp(self):
+    super(CheckpointTest, self).setUp()
+    benchmark.generate_osm('synthetic.osm', nodes=2000)
+    self.checkpoint_bytes = dce.CHECKPOINT_BYTES
+    self.write_elements = dce.write_elements
+    dce.CHECKPOINT_BYTES = os.path.getsize('synthetic.osm') // 6
+
+  def tearDown(self):
+    dce.CHECKPOINT_BYTES = self.checkpoint_bytes
+    dce.write_elements = self.write_elements
+    super(CheckpointTest, self).tearDown()
+
+  def crash_at_segment(self, segment, output):
+    calls = []
+
+    def write_elements(*args, **kwargs):
+      calls.append(None)
+      if len(calls) == segment:
+        raise KeyboardInterrupt
+      return self.write_elements(*args, **kwargs)
+    dce.write_elements = write_elements
+    self.assertRaises(KeyboardInterrupt, dce.process_map, 'synthetic.osm', False, output=output, checkpoint=True)
+    dce.write_elements = self.write_elements
+    self.assertTrue(os.path.exists(dce.CHECKPOINT_PATH))
+
+  def test_resume_writes_the_output_of_an_uninterrupted_run(self):
+    for output in sorted(dce.SINKS):
+      dce.process_map('synthetic.osm', False, output=output)
+      expected = read_outputs(output)
+
+      self.crash_at_segment(3, output)
+      dce.process_map('synthetic.osm', False, output=output, resume=True)
+      self.assertEqual(read_outputs(output), expected, 'resumed %s output differs' % output)
+      self.assertFalse(os.path.exists(dce.CHECKPOINT_PATH))
+
+  def test_resume_with_other_segment_size(self):
+    dce.process_map('synthetic.osm', False)
+    expected = read_outputs('csv')
+
+    for checkpoint_bytes in (dce.CHECKPOINT_BYTES * 3 // 2, dce.CHECKPOINT_BYTES // 2):
+      self.crash_at_segment(3, 'csv')
+      dce.CHECKPOINT_BYTES, saved_bytes = checkpoint_bytes, dce.CHECKPOINT_BYTES
+      dce.process_map('synthetic.osm', False, resume=True)
+      dce.CHECKPOINT_BYTES = saved_bytes
+      self.assertEqual(read_outputs('csv'), expected, 'resume with %d byte segments differs' % checkpoint_bytes)
+
+
+class IntegrityTest(TempDirTestCase):
+
+  def setUp(self):
+    super(IntegrityTest, self).setUp()
+    # node 2 is missing from the input and the relation also has a member that does not exist
+    clipped = re.sub(r' <node id="2".*?</node>\n', '', FIXTURE, flags=re.S)
+    write_file('clipped.osm', clipped.replace('<member type="node" ref="1" role=""/>',
+                                              '<member type="node" ref="1" role=""/>\n  '
+                                              '<member type="node" ref="99" role=""/>'))
+
+  def test_report_keeps_dangling_refs(self):
+    summary = dce.process_map('clipped.osm', False, integrity='report').integrity.summary()
+    self.assertEqual(summary, {'nodes': 2, 'ways': 1, 'dangling_ways': 1, 'dangling_refs': 1, 'dropped_ways': 0,
+                               'dangling_way_ids': [20], 'relations': 1, 'dangling_relations': 1,
+                               'dangling_members': 1, 'dangling_relation_ids': [30]})
+    self.assertEqual(read_outputs('csv')['way_nodes'].splitlines()[1:], ['20,1,0', '20,2,1', '20,3,2'])
+
+  def test_drop_leaves_out_dangling_ways(self):
+    summary = dce.process_map('clipped.osm', False, integrity='drop').integrity.summary()
+    self.assertEqual((summary['dropped_ways'], summary['dangling_members']), (1, 2))
+    outputs = read_outputs('csv')
+    self.assertEqual(outputs['way'].splitlines()[1:], [])
+    self.assertEqual(outputs['way_nodes'].splitlines()[1:], [])
+    self.assertEqual(len(outputs['relation'].splitlines()), 2)
+
+
+class TagStatsTest(TempDirTestCase):
+
+  def test_off_by_default(self):
+    write_file('fixture.osm', FIXTURE)
+    stats = dce.process_map('fixture.osm', False)
+    self.assertEqual(stats.tag_stats, None)
+    self.assertEqual(read_outputs('csv')['tag_stats'].splitlines(), ['element_type,key,type,count,distinct_values'])
+
+  def test_counts_the_shaped_tags(self):
+    write_file('fixture.osm', FIXTURE)
+    dce.process_map('fixture.osm', False, tag_stats=True)
+    self.assertEqual(read_outputs('csv')['tag_stats'].splitlines()[1:],
+                     ['node,street,addr,1,1', 'node,amenity,regular,1,1', 'node,name,regular,2,2',
+                      'node,phone,regular,1,1', 'node,county,tiger,1,1', 'relation,type,regular,1,1',
+                      'way,street,addr,1,1', 'way,highway,regular,1,1'])
+
+  def test_value_hashes_do_not_depend_on_the_process(self):
+    values = [u'yes', u'Caf\u00e9', u'']
+    code = ('import sys, data_cleaning_extraction as dce; '
+            'print([dce.tag_value_hash(value) for value in [u"yes", u"Caf\\u00e9", u""]])')
+    # -R randomizes hash() like Python 3 does by default
+    output = subprocess.check_output([sys.executable, '-R', '-c', code],
+                                     cwd=os.path.dirname(os.path.abspath(dce.__file__)))
+    self.assertEqual(output.strip(), str([dce.tag_value_hash(value) for value in values]))
+    self.assertEqual(dce.tag_value_hash('yes'), dce.tag_value_hash(u'yes'))
+
+  def test_distinct_values_estimate(self):
+    counts = dce.KeyStatistics()
+    for i in range(20000):
+      counts.count += 1
+      counts.insert(dce.tag_value_hash(u'value %d' % (i % 10000)))
+    self.assertTrue(9000 <= counts.distinct() <= 11000, counts.distinct())
+
+  def test_parallel_and_checkpointed_runs_count_the_same(self):
+    benchmark.generate_osm('synthetic.osm', nodes=2000)
+    dce.process_map('synthetic.osm', False, tag_stats=True)
+    expected = read_outputs('csv')
+    self.assertTrue(len(expected['tag_stats'].splitlines()) > 1)
+
+    dce.process_map('synthetic.osm', False, workers=2, tag_stats=True)
+    self.assertEqual(read_outputs('csv'), expected)
+
+    checkpoint_bytes = dce.CHECKPOINT_BYTES
+    dce.CHECKPOINT_BYTES = os.path.getsize('synthetic.osm') // 4
+    try:
+      dce.process_map('synthetic.osm', False, checkpoint=True, tag_stats=True)
+    finally:
+      dce.CHECKPOINT_BYTES = checkpoint_bytes
+    self.assertEqual(read_outputs('csv'), expected)
+
+
+HISTORY = u"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <node id="2" lat="38.8" lon="-77.0" user="b" uid="2" version="3"
+   changeset="3" timestamp="2017-03-01T00:00:00Z" visible="true">
+  <tag k="phone" v="202.555.0102"/>
+ </node>
+ <node id="1" lat="38.9" lon="-77.0" user="a" uid="1" version="1"
+   changeset="1" timestamp="2017-01-01T00:00:00Z" visible="true">
+  <tag k="name" v="first"/>
+ </node>
+ <node id="1" user="a" uid="1" version="2" changeset="2" timestamp="2017-02-01T00:00:00Z" visible="false"/>
+ <node id="2" user="a" uid="1" version="2" changeset="2" timestamp="2017-02-01T00:00:00Z" visible="false"/>
+ <node id="2" lat="38.9" lon="-77.0" user="a" uid="1" version="1"
+   changeset="1" timestamp="2017-01-01T00:00:00Z" visible="true"/>
+</osm>
+"""
+
+
+class DedupTest(TempDirTestCase):
+
+  def setUp(self):
+    super(DedupTest, self).setUp()
+    self.run_size = dce.DEDUP_RUN_SIZE
+    self.merge_fanin = dce.DEDUP_MERGE_FANIN
+    write_file('history.osm', HISTORY)
+
+  def tearDown(self):
+    dce.DEDUP_RUN_SIZE = self.run_size
+    dce.DEDUP_MERGE_FANIN = self.merge_fanin
+    super(DedupTest, self).tearDown()
+
+  def rows(self, table):
+    return read_outputs('csv')[table].decode('utf-8').splitlines()[1:]
+
+  def test_latest_versions(self):
+    stats = dce.process_map('history.osm', False, dedup='latest', tag_stats=True)
+    self.assertEqual(self.rows('node'), ['2,38.8,-77.0,b,2,3,3,2017-03-01T00:00:00Z'])
+    self.assertEqual(self.rows('node_tags'), ['2,phone,2025550102,regular'])
+    self.assertEqual(self.rows('element_history'), [])
+    self.assertEqual(self.rows('tag_stats'), ['node,phone,regular,1,1'])
+    self.assertEqual(stats.dedup.summary(), {'versions': 5, 'elements': 1, 'deleted': 1, 'dropped': 4})
+
+  def test_history_ends_at_deletions(self):
+    dce.process_map('history.osm', False, dedup='history')
+    self.assertEqual(self.rows('element_history'), [
+      'node,1,1,1,a,1,2017-01-01T00:00:00Z,2017-02-01T00:00:00Z',
+      'node,2,1,1,a,1,2017-01-01T00:00:00Z,2017-02-01T00:00:00Z',
+      'node,2,3,3,b,2,2017-03-01T00:00:00Z,'])
+
+  def test_spilled_runs_merge_like_memory(self):
+    benchmark.history_osm('versions.osm', write_file('fixture.osm', FIXTURE), versions=3)
+    dce.process_map('versions.osm', False, dedup='history')
+    expected = read_outputs('csv')
+
+    dce.DEDUP_RUN_SIZE = 2
+    dce.DEDUP_MERGE_FANIN = 2
+    dce.process_map('versions.osm', False, dedup='history')
+    self.assertEqual(read_outputs('csv'), expected)
+
+  def test_deleted_versions_are_skipped_without_dedup(self):
+    dce.process_map('history.osm', False)
+    self.assertEqual(len(self.rows('node')), 3)
+
+
+class RulesTest(unittest.TestCase):
+
+  def test_rewrites_make_one_pass(self):
+    rewrite = dce.compile_rewrites([{'literal': 'a', 'replace': 'b'}, {'literal': 'b', 'replace': 'c'},
+                                    {'literal': 'ab', 'replace': 'X'}, {'pattern': '[0-9]+', 'replace': '#'}])
+    self.assertEqual(rewrite(u'aab b12'), u'bX c#')
+
+  def test_same_replacement_everywhere(self):
+    rewrite = dce.compile_rewrites([{'literal': 'tel:', 'replace': ''}, {'pattern': '[- .()]', 'replace': ''}])
+    self.assertEqual(rewrite(u'tel: (202) 555-0101'), u'2025550101')
+    self.assertEqual(dce.compile_rewrites([]), None)
+
+  def test_groups_of_every_pattern_are_expanded(self):
+    rewrite = dce.compile_rewrites([
+      {'literal': 'St.', 'replace': 'Street'},
+      {'pattern': r'(\d+)-(\d+)', 'replace': r'\2 to \g<1>'},
+      {'pattern': r'#(?P<unit>\w+)', 'replace': r'Unit \g<unit> (\g<0>)'},
+      {'pattern': r'(x)(y)?', 'replace': r'\1\\'}])
+    self.assertEqual(rewrite(u'12-34 St. #4b xy'), u'34 to 12 Street Unit 4b (#4b) x\\')
+
+  def test_backreferences_of_every_pattern(self):
+    rewrites = [{'literal': 'q', 'replace': 'Q'}, {'pattern': r'(\d)-(\d)', 'replace': r'\2\1'},
+                {'pattern': r'(\w)\1', 'replace': r'<\1>'}, {'pattern': r'(x)(y)?(?(2)z|w)', 'replace': '!'}]
+    rewrite = dce.compile_rewrites(rewrites)
+    self.assertEqual(rewrite(u'aabbx 1-2 q xyz xw'), u'<a><b>x 21 Q ! !')
+    self.assertEqual(rewrite(u'aabbx'), re.sub(r'(\w)\1', r'<\1>', u'aabbx'))
+
+  def test_group_names_must_differ(self):
+    for rewrites in ([{'pattern': '(?P<unit>#)', 'replace': ''}, {'pattern': '(?P<unit>No)', 'replace': ''}],
+                     [{'literal': 'a', 'replace': ''}, {'pattern': '(?P<literal>b)', 'replace': ''}]):
+      try:
+        dce.compile_rule({'name': 'fix_units', 'keys': ['addr:unit'], 'rewrites': rewrites})
+      except ValueError as error:
+        self.assertTrue('fix_units' in str(error), str(error))
+      else:
+        self.fail('the group names of %r were accepted' % rewrites)
+
+  def test_invalid_rules_are_rejected(self):
+    self.assertRaises(ValueError, dce.compile_rewrites, [{'pattern': '(?i)st', 'replace': 'Street'}])
+    self.assertRaises(ValueError, dce.compile_rule, {'name': 'typo', 'keys': ['phone'], 'rewrite': []})
+    self.assertRaises(ValueError, dce.compile_rule, {'name': 'missing', 'keys': ['phone'], 'normalizer': 'none'})
+
+  def test_default_rules(self):
+    self.assertEqual(dce.fix_phone(u'+1 (202) 555-0101'), u'2025550101')
+    self.assertEqual(dce.fix_phone(u'New Customer: 202.555.0102 ext. 3'), u'2025550102')
+    self.assertEqual(dce.fix_pharmacy(u'CVS/Pharmacy'), u'CVS')
+    self.assertEqual(dce.fix_pharmacy(u'Rite-Aid pharmacy'), u'RiteAid')
+    self.assertEqual(dce.fix_county(u'Montgomery, MD'), u'Montgomery')
+
+
+if __name__ == '__main__':
+  unittest.main()